@@ -1,14 +1,16 @@
 from flask import Flask, request, jsonify, make_response, Response, stream_with_context
 from werkzeug.exceptions import BadRequest
 
+import click
 import serverless_wsgi
 
-import os
-import time
+import json
 import traceback
 
-from services import util, summarizer
-from lib import db, log
+import config
+
+from services import audio_processor, fingerprint, jobs, transcripts, util, summarizer
+from lib import activity_log, db, log, metrics
 
 app = Flask(__name__)
 
@@ -21,6 +23,91 @@ def home():
     logger.info("Default route")
     return jsonify({"message": "Hi there! Welcome to One click summarizer."})
 
+@app.route("/metrics")
+def get_metrics():
+    return jsonify(metrics.snapshot())
+
+# Status of the background audio job of an article, and its audio url when done
+@app.route("/audio/<id>")
+def audio(id):
+    item = None if db.is_internal_key(id) else db.get_summary_table().get(id, consistent_read=True)
+    if not item:
+        return make_response(jsonify({"error": "Article not found"}), 404)
+    audio_url = util.presigned_audio_url(id, item) if item.get("audio_summary_url") else None
+    return jsonify({
+        "id": id,
+        "audio_status": audio_processor.AUDIO_DONE if audio_url else item.get("audio_status"),
+        "audio_url": audio_url,
+    })
+
+# Summaries of several articles at once, e.g. the reading list of a user. Known articles are read with batch gets,
+# and new ones with a transcript are summarized by background "summary" jobs. Poll again for their result
+#  body: {"urls": [url, ...]} or {"items": [{"url": url, "transcript": transcript}, ...]}, user_id, instructions, audio
+#  statuses: done (with the summary fields), queued, blocked, missing (no summary and no transcript to make one)
+@app.route('/batch', methods=['POST'])
+def batch():
+    logger.info("batch route")
+
+    body = request.get_json()
+    if body is None:
+        raise BadRequest("No JSON body received")
+
+    entries = body.get("items") or [{"url": url} for url in body.get("urls") or []]
+    user_id = body.get("user_id")
+    instructions = body.get("instructions")  # optional - will use the default if not provided
+    include_audio = body.get("audio")  # optional - will assume false if not provided
+
+    # validate the input
+    if not entries:
+        raise BadRequest("urls or items are required")
+    if len(entries) > config.BATCH_MAX_URLS:
+        raise BadRequest(f"At most {config.BATCH_MAX_URLS} urls are allowed")
+    if not all(isinstance(entry, dict) and entry.get("url") for entry in entries):
+        raise BadRequest("URL is required")
+
+    id_instructions = instructions if instructions is not None else "default"
+    id_audio = include_audio if include_audio is not None else "false"
+    ids = [util.generate_id(entry["url"], id_instructions, id_audio) for entry in entries]
+    items = db.get_summary_table().batch_get(ids)
+    items.update(util.find_legacy_articles({id: entry["url"] for entry, id in zip(entries, ids) if id not in items},
+                                           id_instructions, id_audio))
+
+    results = []
+    for entry, id in zip(entries, ids):
+        url = entry["url"]
+        item = items.get(id)
+        if item and item.get("text_summary"):
+            results.append(batch_done_result(user_id, id, url, item))
+            continue
+        if not util.is_worth(id, url):
+            results.append({"id": id, "url": url, "status": "blocked"})
+            continue
+        transcript = entry.get("transcript")
+        if not transcript or len(str(transcript)) < 100:
+            results.append({"id": id, "url": url, "status": "missing"})
+            continue
+        clean_url = util.clean_url(url)
+        status, queued = summarizer.request_summary(user_id, id, clean_url, transcript, instructions, include_audio)
+        if queued:
+            util.log_user_activity(user_id, id, clean_url, "CREATE", source_url=url)
+        if status == summarizer.SUMMARY_DONE:
+            # Summarized since the batch get
+            results.append(batch_done_result(user_id, id, url, db.get_summary_table().get(id, consistent_read=True)))
+            continue
+        results.append({"id": id, "url": url, "status": status})
+
+    return jsonify({"results": results})
+
+
+# Result of /batch for a summarized article. "error" when its audio url can't be presigned, the summary is not
+# queued again for that
+def batch_done_result(user_id, id, url, item):
+    response = util.summary_response(id, item)
+    if response is None:
+        return {"id": id, "url": url, "status": "error"}
+    util.log_user_activity(user_id, id, item["url"], source_url=url)
+    return {**response, "url": url, "status": "done"}
+
 @app.route('/stream', methods=['POST'])
 @stream_with_context
 def stream():
@@ -36,6 +123,8 @@ def stream():
     user_id = body.get("user_id")
     instructions = body.get("instructions")  # optional - will use the default if not provided
     include_audio = body.get("audio")  # optional - will assume false if not provided
+    fan_out = body.get("fan_out")  # optional - will use config.STREAM_FAN_OUT if not provided
+    stream_tokens = body.get("stream_tokens")  # optional - will use config.STREAM_TOKENS if not provided
 
     # validate the input
     if not url:
@@ -53,9 +142,8 @@ def stream():
         "X-Accel-Buffering": "no"  # Disable buffering for Nginx
     }
 
-    # ID is a hash of the clean url after removing query params
+    # ID is a hash of the canonical url, see util.clean_url
     clean_url = util.clean_url(url)
-    # TODO P1 - Audio should be generated in the background and be responded in an async way
     # TODO P2 - Stream the response back in a continuous way, using websocket like approach
     # Unique id for the article is generated to cache in the DB. When ID changes, new summary is performed. Hence the importance of Id
     # TODO THINK - Do we want to include instructions and include_audio in the ID ?
@@ -63,23 +151,27 @@ def stream():
     # check if this article exists in the db, and return the object
     item = None
     if is_test is None:
-        item = db.get_summary_table().get(id)
+        item = util.get_article(id, url, instructions, include_audio)
 
-        if item and item["text_summary"]:
+        if item and item.get("text_summary"):
             logger.info(f"article {id} found in the DB. Returning")
+            # e.g. the audio job failed. Queue it again once due, the client polls GET /audio/<id>
+            if include_audio and config.AUDIO_IN_BACKGROUND and audio_processor.audio_due(item):
+                if audio_processor.request_audio(id, item["text_summary"], item.get("audio_attempts", 0)):
+                    item["audio_status"] = audio_processor.AUDIO_QUEUED
             # Log that this user has requested for this article
-            util.log_user_activity(user_id, id, clean_url)
-            return Response(util.build_response(id, item), headers=headers)
+            util.log_user_activity(user_id, id, clean_url, source_url=url)
+            return Response(util.stream_event(util.build_response(id, item), stream_tokens), headers=headers)
 
     # If summary url is not present, continue processing again
     # check if its worth the effort
-    isWorth = util.is_worth(id, clean_url)
+    isWorth = util.is_worth(id, url)
 
     if isWorth:
         logger.info(f"Article {id} doesn't exist and its worth. Going to summarize")
         try:
-            util.log_user_activity(user_id, id, clean_url, "CREATE")
-            return Response(summarizer.process_in_stream(user_id, id, clean_url, transcript, instructions, include_audio, item), headers=headers)
+            util.log_user_activity(user_id, id, clean_url, "CREATE", source_url=url)
+            return Response(summarizer.process_once(user_id, id, clean_url, transcript, instructions, include_audio, item, fan_out, stream_tokens), headers=headers)
         except Exception as e:
             traceback.print_exc()
             # Return a not found response if the audio file doesn't exist
@@ -129,9 +221,8 @@ def summarize():
         "X-Accel-Buffering": "no"  # Disable buffering for Nginx
     }
 
-    # ID is a hash of the clean url after removing query params
+    # ID is a hash of the canonical url, see util.clean_url
     clean_url = util.clean_url(url)
-    # TODO P1 - Audio should be generated in the background and be responded in an async way
     # TODO P2 - Stream the response back in a continuous way, using websocket like approach
     # Unique id for the article is generated to cache in the DB. When ID changes, new summary is performed. Hence the importance of Id
     # TODO THINK - Do we want to include instructions and include_audio in the ID ?
@@ -139,22 +230,22 @@ def summarize():
     # check if this article exists in the db, and return the object
     item = None
     if is_test is None:
-        item = db.get_summary_table().get(id)
+        item = util.get_article(id, url)
 
         if item and item.get("text_summary"):
             logger.info(f"article {id} found in the DB. Returning")
             # Log that this user has requested for this article
-            util.log_user_activity(user_id, id, clean_url)
+            util.log_user_activity(user_id, id, clean_url, source_url=url)
             return Response(util.build_response(id, item), headers=headers)
 
     # If summary url is not present, continue processing again
     # check if its worth the effort
-    isWorth = util.is_worth(id, clean_url)
+    isWorth = util.is_worth(id, url)
 
     if isWorth:
         logger.info(f"Article {id} doesn't exist and its worth. Going to summarize")
         try:
-            util.log_user_activity(user_id, id, clean_url, "CREATE")
+            util.log_user_activity(user_id, id, clean_url, "CREATE", source_url=url)
             return Response(summarizer.text_summary(user_id, id, clean_url, transcript, item), headers=headers)
         except Exception as e:
             traceback.print_exc()
@@ -205,9 +296,8 @@ def inference():
         "X-Accel-Buffering": "no"  # Disable buffering for Nginx
     }
 
-    # ID is a hash of the clean url after removing query params
+    # ID is a hash of the canonical url, see util.clean_url
     clean_url = util.clean_url(url)
-    # TODO P1 - Audio should be generated in the background and be responded in an async way
     # TODO P2 - Stream the response back in a continuous way, using websocket like approach
     # Unique id for the article is generated to cache in the DB. When ID changes, new summary is performed. Hence the importance of Id
     # TODO THINK - Do we want to include instructions and include_audio in the ID ?
@@ -215,7 +305,7 @@ def inference():
     # check if this article exists in the db, and return the object
     item = None
     if is_test is None:
-        item = db.get_summary_table().get(id)
+        item = util.get_article(id, url)
         logger.info(f"article {id} found in the DB")
 
         if item and item.get("audio_summary_url"):
@@ -224,12 +314,12 @@ def inference():
 
     # If summary url is not present, continue processing again
     # check if its worth the effort
-    isWorth = util.is_worth(id, clean_url)
+    isWorth = util.is_worth(id, url)
 
     if isWorth:
         logger.info(f"Article {id} doesn't exist and its worth. Going to do inference")
         try:
-            util.log_user_activity(user_id, id, clean_url, "CREATE")
+            util.log_user_activity(user_id, id, clean_url, "CREATE", source_url=url)
             return Response(summarizer.inference(user_id, id, clean_url, transcript, include_audio, item), headers=headers)
         except Exception as e:
             traceback.print_exc()
@@ -248,10 +338,69 @@ def inference():
         )
 
 
+# Creates the DynamoDB tables of the stage, when missing. Run once per stage, e.g. sls wsgi flask --command "bootstrap-tables"
+@app.cli.command("bootstrap-tables")
+def bootstrap_tables():
+    db.bootstrap_tables()
+
+
+# Moves the transcripts of the existing summaries out of the items (see services/transcripts.py), and reports the
+# read units saved. Run it with --dry-run first for the report only
+@app.cli.command("migrate-transcripts")
+@click.option("--dry-run", is_flag=True)
+@click.option("--segments", default=4, help="Parallel scan segments")
+@click.option("--max-read-units", type=float, default=None, help="Read units per second to stay under")
+def migrate_transcripts(dry_run, segments, max_read_units):
+    report = transcripts.migrate(dry_run, segments, max_read_units)
+    saved = report["read_units_before"] - report["read_units_after"]
+    print(json.dumps(report))
+    print(f"{report['migrated']} of {report['items']} items {'to migrate' if dry_run else 'migrated'} "
+          f"({report['inline']} inline, {report['s3']} in S3). Read units of reading every item once: "
+          f"{report['read_units_before']:.1f} -> {report['read_units_after']:.1f} "
+          f"({saved / report['read_units_before'] * 100 if report['read_units_before'] else 0:.0f}% less)")
+
+
+# Rebuilds the near-duplicate index from the SimHashes of the articles, e.g. after a change of NEAR_DUP_MAX_DISTANCE
+@app.cli.command("reindex-fingerprints")
+@click.option("--segments", default=4, help="Parallel scan segments")
+@click.option("--max-read-units", type=float, default=None, help="Read units per second to stay under")
+def reindex_fingerprints(segments, max_read_units):
+    print(f"{fingerprint.reindex(segments, max_read_units)} articles indexed")
+
+
+# Invocations that are not HTTP requests, for both entry points. Warming events only keep the container up: use them
+# to open the tables before the next request (the WSGI adapter then skips them). SQS events carry the background jobs,
+# when JOB_QUEUE_BACKEND is sqs. Returns the result of an SQS event, None for the events left to the WSGI adapter
+def handle_event(event):
+    if event.get("source") in ["aws.events", "serverless-plugin-warmup"]:
+        db.warm_tables(config.DB_WARM_TABLES)
+    if jobs.is_sqs_event(event):
+        return jobs.handle_sqs_event(event)
+    return None
+
+
 def handler(event, context):
+    result = handle_event(event)
+    if result is not None:
+        return result
     # TODO - Check how to pass the headers from API gateway when required.
     if "headers" not in event:
         event["headers"] = {}
-    return serverless_wsgi.handle_request(app, event, context)
+    response = serverless_wsgi.handle_request(app, event, context)
+    activity_log.flush_after_invocation()
+    return response
+
+
+# Response streaming variant of the handler. The runtime passes a writable response stream (see lambda_stream_runtime.py)
+def stream_handler(event, context, response_stream):
+    result = handle_event(event)
+    if result is not None:
+        # The partial batch response of SQS, as the whole payload
+        response_stream.write(json.dumps(result))
+        return
+    if "headers" not in event:
+        event["headers"] = {}
+    serverless_wsgi.handle_request_streaming(app, event, context, response_stream)
+    activity_log.flush_after_invocation()
 
 
@@ -0,0 +1,44 @@
+"""
+Per-request overhead of creating boto3 clients, against getting them from the lib.aws registry.
+
+Each "request" gets an S3 client and signs a presigned URL, like build_response does on a cache hit.
+Signing is local, so no AWS account or network is needed.
+
+> python bench/bench_aws_clients.py [requests]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+import boto3
+
+from lib import aws
+
+
+def per_call_client():
+    return boto3.client("s3")
+
+
+def registry_client():
+    return aws.get_client("s3")
+
+
+def run(name, get_client, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        get_client().generate_presigned_url(
+            "get_object", Params={"Bucket": "pp-audio-output", "Key": f"dev/{i}.mp3"}, ExpiresIn=3600)
+    elapsed = time.perf_counter() - started
+    print(f"{name:>16}: {elapsed * 1000 / requests:.3f}ms per request ({requests} requests)")
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    run("boto3.client", per_call_client, requests)
+    run("aws.get_client", registry_client, requests)
@@ -0,0 +1,62 @@
+"""
+Throughput of the blocklist matcher (services.blocklist) against util.match_regex_list, at 10k patterns.
+
+Most patterns are anchored on a publisher or app host, like config.BLACKLIST_URLS, and some are generic.
+
+> python bench/bench_blocklist.py [patterns] [urls]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services.blocklist import BlocklistMatcher
+
+
+# Same as util.match_regex_list, without importing the flask and AWS dependencies of util
+def match_regex_list(regex_list, input_string):
+    for pattern in regex_list:
+        if re.search(pattern, input_string):
+            return True
+    return False
+
+
+def patterns(count, rng):
+    result = []
+    for i in range(count):
+        if i % 20 == 0:
+            result.append(rf"/section{i}/private/")
+        else:
+            result.append(rf"(www\.)?publisher{i}\.com/app{i % 7}/" if i % 3 else rf"publisher{i}\.co\.uk/feed/")
+    return result
+
+
+def urls(count, pattern_count, rng):
+    return [f"https://www.publisher{rng.randrange(pattern_count * 2)}.com/app{rng.randrange(7)}/story/{i}?utm_source=x"
+            for i in range(count)]
+
+
+def run(name, match, sample):
+    started = time.perf_counter()
+    matched = sum(1 for url in sample if match(url))
+    elapsed = time.perf_counter() - started
+    print(f"{name:>16}: {len(sample) / elapsed:10.0f} urls/s ({elapsed * 1e6 / len(sample):8.1f}us per url, {matched} matched)")
+    return matched
+
+
+if __name__ == "__main__":
+    pattern_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    url_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(1)
+    blocklist = patterns(pattern_count, rng)
+    sample = urls(url_count, pattern_count, rng)
+
+    started = time.perf_counter()
+    matcher = BlocklistMatcher(blocklist)
+    print(f"compiled {pattern_count} patterns in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    fast = run("BlocklistMatcher", matcher.matches, sample)
+    slow = run("match_regex_list", lambda url: match_regex_list(blocklist, url), sample[:max(1, url_count // 20)])
@@ -0,0 +1,66 @@
+"""
+Time and read units of listing the summary table: the old single scan, against the paginated scan of DB.list,
+serial and with parallel segments, with and without the projection that leaves the transcript out.
+
+The old scan stops at the first 1 MB page, so it returns only part of the items.
+Runs against DynamoDB Local (see README), on a throwaway table.
+
+> python bench/bench_db_scan.py [articles] [transcript_kb] [segments]
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib import db, metrics
+
+FIELDS = ["user_id", "url", "dateCreated", "text_summary", "tone", "sentiment", "key_topics", "time_saved"]
+
+
+def article(transcript_kb):
+    return {
+        "user_id": "bench",
+        "id": uuid.uuid4().hex,
+        "url": "https://example.com/article",
+        "transcript": "x" * transcript_kb * 1024,
+        "text_summary": "s" * 2048,
+        "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+    }
+
+
+def single_scan(impl):
+    response = impl._table.scan(ReturnConsumedCapacity="TOTAL")
+    metrics.incr("db.scan.pages")
+    metrics.incr("db.scan.read_units", response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+    return response["Items"]
+
+
+def run(name, scan):
+    pages, read_units = metrics.get("db.scan.pages"), metrics.get("db.scan.read_units")
+    started = time.perf_counter()
+    count = sum(1 for _ in scan())
+    elapsed = time.perf_counter() - started
+    print(f"{name:>32}: items={count} pages={metrics.get('db.scan.pages') - pages} "
+          f"read_units={metrics.get('db.scan.read_units') - read_units:.1f} time={elapsed * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    articles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    transcript_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    segments = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    dynamodb = db.create_dynamodb_resource(local=True)
+    table = db.create_table(dynamodb, f"bench_scan_{uuid.uuid4().hex[:8]}")
+    try:
+        impl = db.DynamoDBImpl(table)
+        impl.batch_write(article(transcript_kb) for _ in range(articles))
+        run("single scan (before)", lambda: single_scan(impl))
+        run("paginated", lambda: impl.list())
+        run("paginated, no transcript", lambda: impl.list(projection=FIELDS))
+        run(f"{segments} segments", lambda: impl.list(segments=segments))
+        run(f"{segments} segments, no transcript", lambda: impl.list(segments=segments, projection=FIELDS))
+        run(f"{segments} segments, 100 units/s", lambda: impl.list(segments=segments, max_read_units=100))
+    finally:
+        table.delete()
@@ -0,0 +1,93 @@
+"""
+Write units and latency of the summarizer's DB writes, before and after the UpdateItem API.
+
+"before" replays the three addOrUpdate calls of process_in_stream (get_item + full put_item each),
+"after" the three attribute level update calls of save_changes.
+Runs against DynamoDB Local (see README), on a throwaway table.
+
+> python bench/bench_db_writes.py [articles] [transcript_kb]
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib import db
+
+
+# Proxy of the table resource that asks for the consumed capacity of every call, and adds it up
+class CapacityRecorder(object):
+    def __init__(self, table):
+        self._table = table
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._table, name)
+        if name not in ("get_item", "put_item", "update_item"):
+            return method
+
+        def call(**kwargs):
+            response = method(ReturnConsumedCapacity="TOTAL", **kwargs)
+            consumed = response.get("ConsumedCapacity", {})
+            self.read_units += consumed.get("ReadCapacityUnits", consumed.get("CapacityUnits", 0) if name == "get_item" else 0)
+            self.write_units += consumed.get("WriteCapacityUnits", consumed.get("CapacityUnits", 0) if name != "get_item" else 0)
+            self.calls += 1
+            return response
+        return call
+
+
+def article(transcript_kb):
+    return {
+        "user_id": "bench",
+        "id": uuid.uuid4().hex,
+        "url": "https://example.com/article",
+        "transcript": "x" * transcript_kb * 1024,
+        "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+    }
+
+
+STEPS = [
+    {"text_summary": "s" * 2048},
+    {"tone": "formal", "sentiment": "neutral", "tweet": "t" * 200, "key_topics": ["a", "b", "c"]},
+    {"audio_summary_url": "s3://bucket/dev/2024-01-01/id/summary/id_summary.mp3"},
+]
+
+
+def before(impl, item):
+    for step in STEPS:
+        item.update(step)
+        impl.addOrUpdate(item)
+
+
+def after(impl, item):
+    impl.update(item["id"], {**{k: v for k, v in item.items() if k != "id"}, **STEPS[0]})
+    for step in STEPS[1:]:
+        impl.update(item["id"], step)
+
+
+def run(name, flow, table, articles, transcript_kb):
+    recorder = CapacityRecorder(table)
+    impl = db.DynamoDBImpl(recorder)
+    started = time.perf_counter()
+    for _ in range(articles):
+        flow(impl, article(transcript_kb))
+    elapsed = time.perf_counter() - started
+    print(f"{name:>6}: calls={recorder.calls} read_units={recorder.read_units:.1f} write_units={recorder.write_units:.1f} "
+          f"latency/article={elapsed * 1000 / articles:.1f}ms")
+
+
+if __name__ == "__main__":
+    articles = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    transcript_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    dynamodb = db.create_dynamodb_resource(local=True)
+    table = db.create_table(dynamodb, f"bench_writes_{uuid.uuid4().hex[:8]}")
+    try:
+        run("before", before, table, articles, transcript_kb)
+        run("after", after, table, articles, transcript_kb)
+    finally:
+        table.delete()
@@ -0,0 +1,79 @@
+"""
+Recall of the near-duplicate index (services/fingerprint.py) as the table grows: random SimHashes are indexed,
+then near-duplicates of indexed articles, up to NEAR_DUP_MAX_DISTANCE bits away, are looked up with find_similar.
+Also reports the articles read per lookup and the largest index record.
+
+The summary table is an in-memory stand-in, so that large tables can be simulated without DynamoDB.
+
+> python bench/bench_dedupe_recall.py [articles] [lookups]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import config
+from lib import db
+from services import fingerprint
+
+
+class MemoryTable(db.DB):
+    def __init__(self):
+        self.items = {}
+        self.reads = 0
+
+    def get(self, id, consistent_read=False):
+        self.reads += 1
+        return self.items.get(id)
+
+    def batch_get(self, ids, consistent_read=False):
+        self.reads += len(ids)
+        return {id: self.items[id] for id in ids if id in self.items}
+
+    def add_to_set(self, id, field, values, max_size=None):
+        values_set = self.items.setdefault(id, {"id": id}).setdefault(field, set())
+        if max_size is not None and len(values_set) >= max_size:
+            return False
+        values_set.update(values)
+        return True
+
+
+def flip_bits(value, bits):
+    for position in random.sample(range(fingerprint.SIMHASH_BITS), bits):
+        value ^= 1 << position
+    return value
+
+
+if __name__ == "__main__":
+    articles = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(1)
+    table = MemoryTable()
+    db.set_table("summary", table)
+    variant = fingerprint.variant("default", "false")
+
+    started = time.perf_counter()
+    hashes = []
+    for i in range(articles):
+        value = random.getrandbits(fingerprint.SIMHASH_BITS)
+        hashes.append(value)
+        table.items[f"a{i}"] = {"id": f"a{i}", "text_summary": "s", "simhash": fingerprint.to_hex(value), "variant": variant}
+        # index_article without its thread pool, to fill the table faster
+        for key in fingerprint.band_keys(value):
+            table.add_to_set(key, "ids", [fingerprint.index_entry(f"a{i}", value)], config.NEAR_DUP_BAND_MAX_IDS)
+    print(f"{articles} articles indexed in {time.perf_counter() - started:.1f}s, "
+          f"{len(fingerprint.band_keys(0))} tables, NEAR_DUP_MAX_DISTANCE={config.NEAR_DUP_MAX_DISTANCE}")
+
+    for bits in range(1, config.NEAR_DUP_MAX_DISTANCE + 1):
+        found, reads = 0, 0
+        for _ in range(lookups):
+            i = random.randrange(articles)
+            table.reads = 0
+            similar = fingerprint.find_similar("query", flip_bits(hashes[i], bits), variant)
+            found += similar is not None and similar["id"] == f"a{i}"
+            reads += table.reads
+        print(f"{bits} bits apart: recall {found / lookups:.1%}, {reads / lookups:.1f} records read per lookup")
+    largest = max(len(item.get("ids", ())) for item in table.items.values())
+    print(f"largest index record: {largest} entries")
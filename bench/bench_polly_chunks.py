@@ -0,0 +1,60 @@
+"""
+Wall-clock time of the audio synthesis of a summary: one synthesize_speech call for the whole text against
+the chunked path of services.audio_processor (sentence chunks synthesized on the polly pool).
+
+Polly is replaced by a stand-in whose latency grows with the text length, like the neural engine,
+so no AWS account is needed. Note that real Polly rejects single calls above 3000 billed characters.
+
+> python bench/bench_polly_chunks.py [base_latency_ms] [latency_per_1k_chars_ms]
+"""
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services import audio_processor, chunking
+import config
+
+WORDS = ("the coalition agreement was supposed to stabilise the party brokered by the first minister in august "
+         "it at first appeared a masterstroke allowing the government a majority in parliament").split()
+
+
+class FakePolly(object):
+    def __init__(self, base_latency, latency_per_char):
+        self.base_latency = base_latency
+        self.latency_per_char = latency_per_char
+
+    def synthesize_speech(self, Text, **kwargs):
+        time.sleep(self.base_latency + self.latency_per_char * len(Text))
+        return {"AudioStream": io.BytesIO(b"\xff\xfb" * len(Text))}
+
+
+def summary(size, rng):
+    sentences = []
+    while sum(len(sentence) + 1 for sentence in sentences) < size:
+        sentences.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25))).capitalize() + ".")
+    return " ".join(sentences)[:size]
+
+
+if __name__ == "__main__":
+    base_latency = (float(sys.argv[1]) if len(sys.argv) > 1 else 150) / 1000
+    latency_per_char = (float(sys.argv[2]) if len(sys.argv) > 2 else 400) / 1000 / 1000
+    polly = FakePolly(base_latency, latency_per_char)
+    rng = random.Random(1)
+    print(f"chunks of {config.POLLY_CHUNK_CHARS} chars, {config.POLLY_WORKERS} workers")
+    for size in (1000, 2500, 5000, 7500, 10000):
+        text = summary(size, rng)
+        started = time.perf_counter()
+        with audio_processor.synthesize_speech(text, polly)["AudioStream"] as audio_stream:
+            single = audio_stream.read()
+        single_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        chunks = chunking.split_text(text, config.POLLY_CHUNK_CHARS, count=len)
+        chunked = audio_processor.synthesize_chunks(chunks, polly)
+        chunked_elapsed = time.perf_counter() - started
+        print(f"{size:6d} chars: single call {single_elapsed:5.2f}s, {len(chunks)} chunks {chunked_elapsed:5.2f}s "
+              f"({single_elapsed / chunked_elapsed:4.1f}x), {len(single)} / {len(chunked)} bytes")
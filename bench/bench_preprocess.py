@@ -0,0 +1,50 @@
+"""
+Throughput of the transcript normalisation (services.preprocess) on large inputs.
+
+Builds transcripts the way the browser extension sends them: paragraphs with runs of whitespace,
+each repeated with different spacing, plus nav/footer boilerplate. Doubles the size on every run,
+so the time per MB shows that the pass stays linear.
+
+> python bench/bench_preprocess.py [max_mb]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services import chunking, preprocess
+
+WORDS = ("the coalition agreement was supposed to stabilise party brokered by first minister in august at first "
+         "appeared masterstroke allowing government majority parliament greens policy budget vote election").split()
+BOILERPLATE = ["Skip to content", "Subscribe", "Sign in", "Share this article", "Advertisement", "All rights reserved 2024"]
+
+
+def transcript(size_in_bytes, seed=1):
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < size_in_bytes:
+        paragraph = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+        for _ in range(rng.randint(1, 3)):  # the same paragraph, with different whitespace
+            variant = paragraph.replace(" ", "   ", rng.randint(1, 5))
+            parts.append(variant)
+            size += len(variant)
+        if rng.random() < 0.3:
+            parts.append(rng.choice(BOILERPLATE))
+    return "\n".join(parts)
+
+
+if __name__ == "__main__":
+    max_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size_mb = 0.125
+    while size_mb <= max_mb:
+        text = transcript(int(size_mb * 1024 * 1024))
+        started = time.perf_counter()
+        cleaned, stats = preprocess.normalize(text)
+        elapsed = time.perf_counter() - started
+        saved = chunking.count_tokens(text) - chunking.count_tokens(cleaned)
+        print(f"{size_mb:>6.3f}MB: {elapsed * 1000:8.1f}ms ({elapsed * 1000 / size_mb:6.1f}ms/MB) "
+              f"tokens saved={saved} ({saved * 100 // max(1, chunking.count_tokens(text))}%) {stats}")
+        size_mb *= 2
@@ -0,0 +1,78 @@
+"""
+Cost of serializing the response of a cache hit: the previous build_response (conditional spreads and json.dumps of
+the whole response), against the blob serialized once per revision, with only the audio url and status patched in.
+Both with json, and with orjson when it is installed.
+
+The presigned audio url is a constant here, as it is cached too (see util.presign).
+
+> python bench/bench_response.py [requests] [summary_words]
+"""
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services import util
+
+AUDIO_URL = "https://pp-audio-output.s3.amazonaws.com/dev/audio/" + "a" * 64 + ".mp3?X-Amz-Signature=" + "f" * 64
+
+
+def item(summary_words):
+    return {
+        "id": "a" * 64,
+        "user_id": "bench",
+        "url": "example.com/news/2024/04/26/article",
+        "transcript_z": b"x" * 2048,
+        "text_summary": " ".join(["word"] * summary_words),
+        "summary_bullets": ["A bullet point of the summary"] * 5,
+        "tone": "formal",
+        "sentiment": "neutral",
+        "key_topics": ["budget", "coalition", "vote"],
+        "time_saved": Decimal(4),
+        "audio_summary_url": "s3://pp-audio-output/dev/audio/" + "a" * 64 + ".mp3",
+        "revision": Decimal(3),
+    }
+
+
+# build_response as it was, with Decimal support so that it can run on an item read from DynamoDB
+def before(id, item):
+    audio_url = util.presigned_audio_url(id, item) if item.get("audio_summary_url") else None
+    return json.dumps({
+        "id": id,
+        "audio_url": audio_url,
+        **({"tone": item["tone"]} if "tone" in item else {}),
+        **({"sentiment": item["sentiment"]} if "sentiment" in item else {}),
+        **({"key_topics": item["key_topics"]} if "key_topics" in item else {}),
+        **({"text_summary": item["text_summary"]} if "text_summary" in item else {}),
+        **({"summary_bullets": item["summary_bullets"]} if "summary_bullets" in item else {}),
+        **({"time_saved": item["time_saved"]} if "time_saved" in item else {}),
+        **({"audio_status": item["audio_status"]} if "audio_status" in item else {}),
+        "clean_url": item["url"],
+    }, default=util._json_default)
+
+
+def run(name, build, item, requests):
+    build(item["id"], item)  # the first request serializes the blob
+    started = time.perf_counter()
+    for _ in range(requests):
+        build(item["id"], item)
+    elapsed = time.perf_counter() - started
+    print(f"{name:>24}: {elapsed * 1e6 / requests:7.2f}us per response")
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    summary_words = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    article = item(summary_words)
+    with patch("services.util.presigned_audio_url", lambda id, item: AUDIO_URL):
+        assert json.loads(before(article["id"], article)) == json.loads(util.build_response(article["id"], article))
+        run("before", before, article, requests)
+        if util.orjson is not None:
+            run("blob, orjson", util.build_response, article, requests)
+        with patch("services.util.orjson", None):
+            util._response_blobs.clear()
+            run("blob, json", util.build_response, article, requests)
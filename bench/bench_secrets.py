@@ -0,0 +1,60 @@
+"""
+Latency of reading a secret on a cold start and on the following requests: Secrets Manager in another region
+(us-west-1 from us-east-1, as today) against a replica in the same region, and with and without the cache of
+lib.secret_store.
+
+Secrets Manager is replaced by a stand-in that sleeps for the round trips of a call: a new connection pays
+the TCP and TLS handshakes (3 round trips) on top of the request itself.
+
+> python bench/bench_secrets.py [cross_region_rtt_ms] [same_region_rtt_ms] [requests]
+"""
+import json
+import os
+import sys
+import time
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib import secret_store
+
+
+class FakeSecretsManager(object):
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.connected = False
+        self.calls = 0
+
+    def get_secret_value(self, SecretId):
+        time.sleep(self.rtt * (1 if self.connected else 4))
+        self.connected = True
+        self.calls += 1
+        return {"SecretString": json.dumps({SecretId: "sk-bench"})}
+
+
+def run(name, rtt, requests, cached):
+    client = FakeSecretsManager(rtt)
+    store = secret_store.SecretStore("bench", ttl=3600, refresh_ahead=300)
+    with patch("lib.aws.get_client", return_value=client):
+        started = time.perf_counter()
+        store.get("OPENAI_API_KEY")
+        cold = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(requests):
+            if not cached:
+                store.invalidate()
+            store.get("OPENAI_API_KEY")
+        warm = time.perf_counter() - started
+    print(f"{name:>28}: cold start {cold * 1000:6.1f}ms, next {requests} reads {warm * 1000:8.1f}ms, {client.calls} calls")
+    return cold
+
+
+if __name__ == "__main__":
+    cross_region_rtt = (float(sys.argv[1]) if len(sys.argv) > 1 else 65) / 1000
+    same_region_rtt = (float(sys.argv[2]) if len(sys.argv) > 2 else 2) / 1000
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    os.environ.pop("OPENAI_API_KEY", None)  # or the store would use it, without calling Secrets Manager
+    run("cross-region, no cache", cross_region_rtt, requests, cached=False)
+    before = run("cross-region, cached", cross_region_rtt, requests, cached=True)
+    after = run("same-region replica, cached", same_region_rtt, requests, cached=True)
+    print(f"saved on a cold start with a replica: {(before - after) * 1000:.1f}ms")
@@ -0,0 +1,143 @@
+"""
+Cold start of the lambda handler, with local stand-ins for OpenAI, DynamoDB and S3 (no AWS account needed).
+
+Every run is a fresh python process, like a new container. It reports
+ - the time to import app, and the first and second GET / through app.handler
+ - the first POST /stream (summary and inference, without audio), against the stand-ins
+ - the cost of each lazy initialisation (init.* timings of lib.profiling), run after the requests
+Then one python -X importtime run, summarized by lib.profiling, shows which imports dominate.
+
+> python bench/cold_start.py [runs]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+# No credentials, so that any unexpected AWS call fails the run instead of reaching an account
+ENV = {**os.environ, "ENVIRONMENT": "production", "AWS_DEFAULT_REGION": "us-east-1",
+       "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_EC2_METADATA_DISABLED": "true"}
+
+TRANSCRIPT = " ".join(f"Sentence {i} of the article about the coalition agreement and the budget vote." for i in range(60))
+
+
+def http_event(method, path, body=None):
+    return {"version": "2.0", "rawPath": path, "rawQueryString": "", "headers": {"content-type": "application/json"},
+            "body": json.dumps(body) if body is not None else "", "isBase64Encoded": False,
+            "requestContext": {"http": {"method": method}}}
+
+
+# Runs in the child process, with the stand-ins installed once app is imported
+def child():
+    started = time.perf_counter()
+    import app
+    imported = time.perf_counter() - started
+
+    from types import SimpleNamespace
+    from lib import activity_log, db, metrics
+    from lib.cache import TTLCache
+    from services import summarizer
+
+    class FakeOpenAI(object):
+        def __init__(self):
+            self.chat = SimpleNamespace(completions=self)
+
+        def create(self, messages, **kwargs):
+            content = '{"tone": "formal", "sentiment": "neutral", "tweet": "A tweet", "key_topics": ["budget"]}' \
+                if "JSON" in messages[0]["content"] else "A summary of the article."
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    class FakeTable(db.DB):
+        def __init__(self):
+            self.items = {}
+
+        def get(self, id, consistent_read=False):
+            return dict(self.items[id]) if id in self.items else None
+
+        def update(self, id, fields, condition=None, condition_names=None, condition_values=None, remove=()):
+            item = self.items.setdefault(id, {"id": id})
+            item.update(fields)
+            for name in remove:
+                item.pop(name, None)
+            return fields
+
+        def batch_get(self, ids, consistent_read=False):
+            return {id: dict(self.items[id]) for id in ids if id in self.items}
+
+        def add_to_set(self, id, field, values, max_size=None):
+            self.items.setdefault(id, {"id": id}).setdefault(field, set()).update(values)
+            return True
+
+        def acquire_lease(self, key, owner, ttl):
+            return True
+
+        def release_lease(self, key, owner):
+            return True
+
+        def renew_lease(self, key, owner, ttl):
+            return True
+
+    class FakeS3(object):
+        def put_object(self, **kwargs):
+            pass
+
+    summarizer._client = FakeOpenAI()
+    db.set_table("summary", db.CachedDB(FakeTable(), TTLCache("summary", 100, 60)))
+    activity_log._ACTIVITY_LOG = activity_log.ActivityLog("bench", 100, 100, 60, 10, s3_client=FakeS3())
+
+    timings = {"import": imported}
+    for name, event in [("first GET /", http_event("GET", "/")), ("second GET /", http_event("GET", "/")),
+                        ("first POST /stream", http_event("POST", "/stream", {"url": "https://example.com/a", "transcript": TRANSCRIPT, "instructions": "default", "audio": "", "fan_out": False})),
+                        ("second POST /stream", http_event("POST", "/stream", {"url": "https://example.com/b", "transcript": TRANSCRIPT, "instructions": "default", "audio": "", "fan_out": False}))]:
+        started = time.perf_counter()
+        response = app.handler(event, {})
+        timings[name] = time.perf_counter() - started
+        assert response["statusCode"] == 200, response
+    # The stand-ins skip the real initialisers. Run them now, short of any network call, to see what they cost:
+    # the OpenAI client (with a stand-in secret), boto3 and the clients of the services we use
+    from lib import aws
+    from services import util
+    util.get_secret = lambda secret_name="OPENAI_API_KEY": "sk-bench"
+    summarizer._client = None
+    summarizer.get_openai_client()
+    for service in ["s3", "sqs"]:
+        aws.get_client(service)
+    aws.get_client("polly", region_name="us-east-1")
+    aws.get_resource("dynamodb")
+    inits = {name: timing["max_ms"] for name, timing in metrics.snapshot()["timings"].items() if name.startswith("init.")}
+    print(json.dumps({"timings": timings, "inits": inits}))
+
+
+def run_child():
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], env=ENV, cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        child()
+        sys.exit(0)
+
+    from lib import profiling
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = [run_child() for _ in range(runs)]
+    print(f"median of {runs} fresh processes")
+    for name in results[0]["timings"]:
+        print(f"  {name:>28}: {statistics.median(r['timings'][name] for r in results) * 1000:8.1f}ms")
+    print("lazy initialisations (first run)")
+    for name, ms in sorted(results[0]["inits"].items(), key=lambda entry: -entry[1]):
+        print(f"  {name:>28}: {ms:8.1f}ms")
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], env=ENV, cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    report = profiling.summarize_import_times(result.stderr, top=12)
+    print(f"imports: {report['total_us'] / 1000:.1f}ms, slowest packages (self time)")
+    for us, package in report["packages"]:
+        print(f"  {package:>28}: {us / 1000:8.1f}ms")
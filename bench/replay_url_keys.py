@@ -0,0 +1,103 @@
+"""
+Replays the user activity logs through the url canonicalisation (services.url_canonical), and reports how many
+distinct article keys and cache hits we get compared to the previous rule, which only dropped the query.
+
+Reads the batches written by lib.activity_log (.ndjson.gz) and the older one-event .json files, from local paths
+or an s3://bucket/prefix. The url of an event is source_url when logged, article_url otherwise.
+Without logs, --sample replays generated variants of a few articles.
+
+> python bench/replay_url_keys.py <path or s3://bucket/prefix>... | --sample
+"""
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlparse, urlunparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services import url_canonical
+
+
+# util.clean_url before the canonicalisation
+def previous_clean_url(url):
+    return urlunparse(urlparse(url)._replace(query=""))
+
+
+def parse_events(name, body):
+    if name.endswith(".gz"):
+        body = gzip.decompress(body)
+    for line in body.decode("utf-8").splitlines():
+        if line.strip():
+            yield json.loads(line)
+
+
+def local_events(path):
+    paths = [path]
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for name in paths:
+        if name.endswith((".ndjson.gz", ".ndjson", ".json")):
+            with open(name, "rb") as f:
+                yield from parse_events(name, f.read())
+
+
+def s3_events(url):
+    from lib import aws
+    bucket_name, _, prefix = url[5:].partition("/")
+    s3 = aws.get_client("s3")
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield from parse_events(obj["Key"], s3.get_object(Bucket=bucket_name, Key=obj["Key"])["Body"].read())
+
+
+def sample_urls(count, seed=1):
+    rng = random.Random(seed)
+    variants = [
+        "https://www.{site}/{path}", "https://{site}/{path}/", "https://{site}/{path}?utm_source=twitter&utm_medium=social",
+        "https://{site}/{path}#comments", "https://www.{site}/{path}?fbclid=IwAR0x", "https://{site}/{path}/amp",
+        "https://www.google.com/amp/s/{site}/{path}.amp", "https://{site}/{path}?ref=newsletter#top",
+    ]
+    articles = [(f"publisher{i % 40}.com", f"news/2024/story-{i}") for i in range(count // 10 or 1)]
+    for _ in range(count):
+        site, path = rng.choice(articles)
+        yield {"source_url": rng.choice(variants).format(site=site, path=path)}
+
+
+def replay(events):
+    urls = [event.get("source_url") or event.get("article_url") for event in events]
+    urls = [url for url in urls if url]
+    previous = defaultdict(set)
+    started = time.perf_counter()
+    keys = [url_canonical.canonicalize(url) for url in urls]
+    elapsed = time.perf_counter() - started
+    for url, key in zip(urls, keys):
+        previous[key].add(previous_clean_url(url))
+
+    total = len(urls)
+    distinct_before = len({previous_clean_url(url) for url in urls})
+    distinct_after = len(set(keys))
+    print(f"{total} requests, canonicalised in {elapsed * 1000:.1f}ms ({url_canonical.canonicalize.cache_info()})")
+    if not total:
+        return
+    # A request is a hit when its key was seen before, i.e. on a warm cache every distinct key is summarized once
+    print(f"  previous clean_url: {distinct_before:6d} keys, hit rate {(total - distinct_before) / total:6.1%}")
+    print(f"  canonical url     : {distinct_after:6d} keys, hit rate {(total - distinct_after) / total:6.1%}")
+    merged = sorted(previous.items(), key=lambda entry: -len(entry[1]))[:5]
+    for key, variants in merged:
+        if len(variants) > 1:
+            print(f"  {len(variants)} variants -> {key}")
+
+
+if __name__ == "__main__":
+    if not sys.argv[1:]:
+        sys.exit(__doc__)
+    if sys.argv[1] == "--sample":
+        events = list(sample_urls(int(sys.argv[2]) if len(sys.argv) > 2 else 5000))
+    else:
+        events = [event for source in sys.argv[1:]
+                  for event in (s3_events(source) if source.startswith("s3://") else local_events(source))]
+    replay(events)
@@ -0,0 +1,76 @@
+"""
+Local harness for Lambda response streaming.
+
+Runs a stand-in of the /stream pipeline (three slow steps, like summary, inference and audio)
+through the buffered serverless_wsgi handler and the streaming one, for payload v1 and v2 events.
+Prints when the first body chunk reached the client and when the pipeline completed.
+
+> python bench/stream_first_byte.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from flask import Flask, Response, stream_with_context
+
+import serverless_wsgi
+
+STEP_DELAY_IN_SEC = 0.5
+
+app = Flask(__name__)
+
+
+@app.route("/stream", methods=["POST"])
+@stream_with_context
+def stream():
+    def steps():
+        for step in ["summary", "inference", "audio"]:
+            time.sleep(STEP_DELAY_IN_SEC)
+            yield json.dumps({"step": step}) + "\n\n"
+    return Response(steps(), headers={"Content-Type": "text/event-stream"})
+
+
+# Records when each chunk is written to the response stream
+class RecordingStream(object):
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((time.perf_counter() - self.started, data))
+
+
+def v1_event():
+    return {"httpMethod": "POST", "path": "/stream", "headers": {"Content-Type": "application/json"},
+            "body": "{}", "isBase64Encoded": False, "requestContext": {}}
+
+
+def v2_event():
+    return {"version": "2.0", "rawPath": "/stream", "rawQueryString": "",
+            "headers": {"content-type": "application/json"}, "body": "{}", "isBase64Encoded": False,
+            "requestContext": {"http": {"method": "POST"}}}
+
+
+def run(name, event):
+    started = time.perf_counter()
+    serverless_wsgi.handle_request(app, event, {})
+    buffered = time.perf_counter() - started
+
+    stream = RecordingStream()
+    serverless_wsgi.handle_request_streaming(app, event, {}, stream)
+    completed = time.perf_counter() - stream.started
+    prelude = stream.writes[0][1].split(serverless_wsgi.STREAMING_PRELUDE_DELIMITER)[0]
+    first_chunk = stream.writes[1][0]
+
+    print(f"{name}: prelude={prelude.decode()}")
+    print(f"{name}: buffered first byte={buffered:.2f}s | streaming first chunk={first_chunk:.2f}s, "
+          f"completed={completed:.2f}s, chunks={len(stream.writes) - 1}")
+    assert first_chunk < completed - STEP_DELAY_IN_SEC, "first chunk should arrive before the pipeline completes"
+
+
+if __name__ == "__main__":
+    run("payload v1", v1_event())
+    run("payload v2", v2_event())
@@ -1,8 +1,60 @@
+import os
+
 DEFAULT_USERNAME = "default"
 S3_BUCKET_AUDIO_OUTPUT = "pp-audio-output"
 S3_BUCKET_ACTIVITY_LOGS = "essence-activity-logs"
+# Transcripts are kept out of the summary items (see services/transcripts.py): in the item, compressed, up to
+# TRANSCRIPT_INLINE_MAX_BYTES (one read unit), and in S3_BUCKET_TRANSCRIPTS otherwise
+S3_BUCKET_TRANSCRIPTS = os.getenv("S3_BUCKET_TRANSCRIPTS", S3_BUCKET_AUDIO_OUTPUT)
+TRANSCRIPT_INLINE_MAX_BYTES = int(os.getenv("TRANSCRIPT_INLINE_MAX_BYTES", "4096"))
+TRANSCRIPT_COMPRESSION_LEVEL = int(os.getenv("TRANSCRIPT_COMPRESSION_LEVEL", "6"))
+# Part size of the streamed S3 uploads. Smaller streams are sent in one put_object. S3 parts are 5MB minimum
+S3_UPLOAD_PART_SIZE = int(os.getenv("S3_UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+# Audio summaries longer than a chunk are synthesized in chunks, split on sentences, POLLY_WORKERS at a time.
+# A Polly request takes at most 3000 billed characters
+POLLY_CHUNK_CHARS = int(os.getenv("POLLY_CHUNK_CHARS", "1500"))
+POLLY_WORKERS = int(os.getenv("POLLY_WORKERS", "4"))
+POLLY_MAX_ATTEMPTS = int(os.getenv("POLLY_MAX_ATTEMPTS", "3"))
+POLLY_RETRY_BACKOFF_IN_SEC = float(os.getenv("POLLY_RETRY_BACKOFF_IN_SEC", "0.5"))
+# Audio summaries are generated by background jobs, and polled with GET /audio/<id>. False generates them in the request
+AUDIO_IN_BACKGROUND = os.getenv("AUDIO_IN_BACKGROUND", "true").lower() == "true"
+# A queued or running audio job older than this is considered lost, and may be queued again. Above the lambda timeout
+AUDIO_JOB_STALE_IN_SEC = int(os.getenv("AUDIO_JOB_STALE_IN_SEC", "120"))
+# Jobs queued for the audio of an article, retries of failed or lost jobs included. A failed job is queued again after
+# AUDIO_RETRY_BACKOFF_IN_SEC, doubled after every attempt
+AUDIO_MAX_ATTEMPTS = int(os.getenv("AUDIO_MAX_ATTEMPTS", "3"))
+AUDIO_RETRY_BACKOFF_IN_SEC = int(os.getenv("AUDIO_RETRY_BACKOFF_IN_SEC", "300"))
+# A queued summary job older than this is considered lost, and may be queued again by the batch endpoint
+SUMMARY_JOB_STALE_IN_SEC = int(os.getenv("SUMMARY_JOB_STALE_IN_SEC", "600"))
+# Most urls resolved by one POST /batch
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "100"))
+# Background jobs backend (services.jobs): inprocess (thread pool) or sqs
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "inprocess")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL")
+# Endpoint of a local SQS-compatible service, e.g. http://localhost:9324 for ElasticMQ
+JOB_QUEUE_ENDPOINT_URL = os.getenv("JOB_QUEUE_ENDPOINT_URL")
 MAX_WAIT_TIME = 300
 SLEEP_TIME_IN_SEC = 3
+# Longest wait of a request for the summary of another one, in the process or in another container. Below the lambda
+# timeout (60 s in serverless.yml), so the waiting request can still respond
+SUMMARY_WAIT_IN_SEC = int(os.getenv("SUMMARY_WAIT_IN_SEC", "50"))
+# "In progress" lease on an article being summarized. Must outlive the lambda timeout, so that a live lease is never taken over
+LEASE_TTL_IN_SEC = 90
+# The holder renews its lease this often while it works, e.g. on long documents or without a lambda timeout (gunicorn)
+LEASE_RENEW_INTERVAL_IN_SEC = int(os.getenv("LEASE_RENEW_INTERVAL_IN_SEC", "30"))
+# Transcripts whose SimHashes are at most this many bits apart are near-duplicates, and share the summary.
+# The index has C(k + 3, 3) tables for k bits: 20 for 3, 35 for 4. Run `flask reindex-fingerprints` after a change
+NEAR_DUP_MAX_DISTANCE = int(os.getenv("NEAR_DUP_MAX_DISTANCE", "3"))
+# Most articles kept in one record of the index
+NEAR_DUP_BAND_MAX_IDS = int(os.getenv("NEAR_DUP_BAND_MAX_IDS", "200"))
+NEAR_DUP_INDEX_WORKERS = int(os.getenv("NEAR_DUP_INDEX_WORKERS", "8"))
+# /stream runs the summary, inference and audio steps concurrently. Opt-in, per request with "fan_out" or here
+STREAM_FAN_OUT = os.getenv("STREAM_FAN_OUT", "false").lower() == "true"
+FAN_OUT_WORKERS = 8
+# /stream forwards the summary token by token as SSE events. Can be overridden per request with "stream_tokens"
+# All the events of the response are then SSE events: "summary_delta", "item" and "error"
+STREAM_TOKENS = False
 # These are regex patterns that could be used to do selective matches.
 # For gmail, the regex pattern will match the inbox, but will not match individual emails
 BLACKLIST_URLS = [
@@ -13,3 +65,74 @@ BLACKLIST_URLS = [
     r"linkedin\.com/feed/",
     r"mail\.google\.com/mail/u/0/#inbox(?!/)",
 ]
+# More blocklist patterns, loaded on top of BLACKLIST_URLS and reloaded when they change. A file path or an s3:// url
+BLOCKLIST_SOURCE = os.getenv("BLOCKLIST_SOURCE")
+BLOCKLIST_RELOAD_INTERVAL_IN_SEC = int(os.getenv("BLOCKLIST_RELOAD_INTERVAL_IN_SEC", "60"))
+# Per-site rules of the canonical article url (services.url_canonical). The query is dropped, except these params,
+# "*" keeps all the params but the tracking ones. Rules apply to the host and its subdomains
+URL_QUERY_PARAMS = {
+    "news.ycombinator.com": ["id"],
+    "youtube.com": ["v"],
+    "google.com": ["q"],
+    "medium.com": ["p"],
+}
+# Hosts whose fragment identifies the content, e.g. the email id in gmail urls
+URL_KEEP_FRAGMENT = {"mail.google.com"}
+URL_CANONICAL_CACHE_SIZE = int(os.getenv("URL_CANONICAL_CACHE_SIZE", "4096"))
+# Articles summarized before the canonical urls are stored under the id of their previous url. A miss reads that id
+# too, and copies the article to its new id. Costs one more read per miss, turn it off once the articles are copied
+LEGACY_ID_FALLBACK = os.getenv("LEGACY_ID_FALLBACK", "true").lower() == "true"
+# Check that the tables exist when they are first used, and create them if not. Off in production, where the tables
+# are created once with the bootstrap-tables command (see lib/db.py), to keep DescribeTable off the first request
+DB_CHECK_TABLES = os.getenv("DB_CHECK_TABLES", str(os.getenv("ENVIRONMENT", "LOCAL") == "LOCAL")).lower() == "true"
+# Retries of the keys or requests left unprocessed by DynamoDB batch calls, with exponential backoff
+DB_BATCH_MAX_ATTEMPTS = int(os.getenv("DB_BATCH_MAX_ATTEMPTS", "5"))
+DB_BATCH_BACKOFF_IN_SEC = float(os.getenv("DB_BATCH_BACKOFF_IN_SEC", "0.05"))
+# Tables opened and read once by warming events, so that the next request finds the connections ready
+DB_WARM_TABLES = os.getenv("DB_WARM_TABLES", "summary").split(",")
+# In-process read-through cache of the summary table
+SUMMARY_CACHE_MAX_ITEMS = int(os.getenv("SUMMARY_CACHE_MAX_ITEMS", "1024"))
+SUMMARY_CACHE_TTL_IN_SEC = int(os.getenv("SUMMARY_CACHE_TTL_IN_SEC", "300"))
+SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC = int(os.getenv("SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC", "5"))
+# Buffered user activity logs, flushed to S3_BUCKET_ACTIVITY_LOGS in gzipped NDJSON batches
+ACTIVITY_LOG_MAX_EVENTS = int(os.getenv("ACTIVITY_LOG_MAX_EVENTS", "10000"))
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", "500"))
+ACTIVITY_LOG_FLUSH_INTERVAL_IN_SEC = int(os.getenv("ACTIVITY_LOG_FLUSH_INTERVAL_IN_SEC", "60"))
+ACTIVITY_LOG_IDLE_FLUSH_IN_SEC = int(os.getenv("ACTIVITY_LOG_IDLE_FLUSH_IN_SEC", "10"))
+# Flush all pending events at the end of each lambda invocation. Can be turned off when an extension is attached to the
+# function, as lambda then sends SIGTERM before shutting it down and the events left are flushed then
+ACTIVITY_LOG_FLUSH_EACH_INVOCATION = os.getenv("ACTIVITY_LOG_FLUSH_EACH_INVOCATION", "true").lower() == "true"
+# Secrets (lib.secret_store). SECRETS_REGION can point to a replica of the secrets in the region of the function,
+# to avoid a cross-region call (serverless.yml sets it from the secretsRegion param). Secrets set as environment
+# variables, or in SECRETS_FILE (JSON), are used as is
+SECRETS_REGION = os.getenv("SECRETS_REGION", "us-west-1")
+SECRETS_TTL_IN_SEC = int(os.getenv("SECRETS_TTL_IN_SEC", "3600"))
+SECRETS_REFRESH_AHEAD_IN_SEC = int(os.getenv("SECRETS_REFRESH_AHEAD_IN_SEC", "300"))
+SECRETS_FILE = os.getenv("SECRETS_FILE")
+# Logs every lazy initialisation (clients, secrets, tables) with its time. See lib/profiling.py
+PROFILE_COLD_START = os.getenv("PROFILE_COLD_START", "false").lower() == "true"
+# Shared AWS clients (lib.aws)
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "32"))
+AWS_TCP_KEEPALIVE = os.getenv("AWS_TCP_KEEPALIVE", "true").lower() == "true"
+AWS_CONNECT_TIMEOUT_IN_SEC = int(os.getenv("AWS_CONNECT_TIMEOUT_IN_SEC", "5"))
+AWS_READ_TIMEOUT_IN_SEC = int(os.getenv("AWS_READ_TIMEOUT_IN_SEC", "60"))
+AWS_RETRY_MODE = os.getenv("AWS_RETRY_MODE", "adaptive")  # legacy, standard or adaptive
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "3"))
+# Presigned audio URLs are reused until this margin before they expire
+PRESIGNED_URL_SAFETY_MARGIN_IN_SEC = int(os.getenv("PRESIGNED_URL_SAFETY_MARGIN_IN_SEC", "600"))
+PRESIGNED_URL_CACHE_MAX_ITEMS = int(os.getenv("PRESIGNED_URL_CACHE_MAX_ITEMS", "4096"))
+# Also store the presigned URL on the summary item, for cold containers
+PRESIGNED_URL_ON_ITEM = os.getenv("PRESIGNED_URL_ON_ITEM", "false").lower() == "true"
+# Serialized responses of the cache hits, one per revision of an article (see util.response_blob).
+# RESPONSE_BLOB_ON_ITEM also stores them on the summary item, for cold containers, at the cost of larger reads
+RESPONSE_BLOB_CACHE_MAX_ITEMS = int(os.getenv("RESPONSE_BLOB_CACHE_MAX_ITEMS", "4096"))
+RESPONSE_BLOB_CACHE_TTL_IN_SEC = int(os.getenv("RESPONSE_BLOB_CACHE_TTL_IN_SEC", "3600"))
+RESPONSE_BLOB_ON_ITEM = os.getenv("RESPONSE_BLOB_ON_ITEM", "false").lower() == "true"
+# Long-document mode: transcripts over the threshold are summarized in chunks, then reduced
+LONG_DOC_MODE = os.getenv("LONG_DOC_MODE", "true").lower() == "true"
+LONG_DOC_THRESHOLD_TOKENS = int(os.getenv("LONG_DOC_THRESHOLD_TOKENS", "8000"))
+LONG_DOC_CHUNK_TOKENS = int(os.getenv("LONG_DOC_CHUNK_TOKENS", "3000"))
+LONG_DOC_CHUNK_SUMMARY_TOKENS = int(os.getenv("LONG_DOC_CHUNK_SUMMARY_TOKENS", "600"))
+LONG_DOC_WORKERS = int(os.getenv("LONG_DOC_WORKERS", "4"))
+LONG_DOC_CACHE_MAX_ITEMS = int(os.getenv("LONG_DOC_CACHE_MAX_ITEMS", "2048"))
+LONG_DOC_CACHE_TTL_IN_SEC = int(os.getenv("LONG_DOC_CACHE_TTL_IN_SEC", "86400"))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Minimal custom runtime loop for Lambda response streaming.
+
+The managed Python runtime only supports buffered responses, so this loop talks to the
+Lambda Runtime API directly and posts the response with the streaming response mode.
+The handler is called as `handler(event, context, response_stream)` and every write goes
+out as an HTTP chunk.
+
+Usage (as the image entrypoint and command, the entrypoint of the Lambda base image starts the managed runtime):
+> python lambda_stream_runtime.py app.stream_handler
+"""
+import http.client
+import importlib
+import json
+import os
+import sys
+import traceback
+
+import serverless_wsgi
+
+RUNTIME_API_VERSION = "2018-06-01"
+
+
+class LambdaContext(object):
+    def __init__(self, request_id, headers):
+        self.aws_request_id = request_id
+        self.invoked_function_arn = headers.get("Lambda-Runtime-Invoked-Function-Arn")
+        self.deadline_ms = int(headers.get("Lambda-Runtime-Deadline-Ms", "0"))
+        self.function_name = os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+        self.memory_limit_in_mb = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+
+
+# Writable response stream, sends every write as an HTTP chunk to the Runtime API
+class ResponseStream(object):
+    def __init__(self, runtime_api, request_id):
+        self._conn = http.client.HTTPConnection(runtime_api)
+        self._conn.putrequest("POST", f"/{RUNTIME_API_VERSION}/runtime/invocation/{request_id}/response")
+        self._conn.putheader("Lambda-Runtime-Function-Response-Mode", "streaming")
+        self._conn.putheader("Content-Type", serverless_wsgi.STREAMING_CONTENT_TYPE)
+        self._conn.putheader("Transfer-Encoding", "chunked")
+        self._conn.putheader("Trailer", "Lambda-Runtime-Function-Error-Type, Lambda-Runtime-Function-Error-Body")
+        self._conn.endheaders()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data:
+            self._conn.send(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def close(self, error=None):
+        trailers = b""
+        if error:
+            # Errors after the first chunk can only be reported as trailers
+            body = json.dumps({"errorMessage": str(error), "errorType": type(error).__name__})
+            trailers = b"Lambda-Runtime-Function-Error-Type: %s\r\nLambda-Runtime-Function-Error-Body: %s\r\n" % (
+                type(error).__name__.encode("utf-8"), body.encode("utf-8"))
+        self._conn.send(b"0\r\n" + trailers + b"\r\n")
+        self._conn.getresponse().read()
+        self._conn.close()
+
+
+def load_handler(fqn):
+    module_name, function_name = fqn.rsplit(".", 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def main(fqn):
+    runtime_api = os.environ["AWS_LAMBDA_RUNTIME_API"]
+    handler = load_handler(fqn)
+
+    while True:
+        conn = http.client.HTTPConnection(runtime_api)
+        conn.request("GET", f"/{RUNTIME_API_VERSION}/runtime/invocation/next")
+        next_response = conn.getresponse()
+        event = json.loads(next_response.read())
+        request_id = next_response.getheader("Lambda-Runtime-Aws-Request-Id")
+        context = LambdaContext(request_id, next_response.headers)
+        conn.close()
+
+        response_stream = ResponseStream(runtime_api, request_id)
+        try:
+            handler(event, context, response_stream)
+            response_stream.close()
+        except Exception as e:
+            traceback.print_exc()
+            response_stream.close(e)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "app.stream_handler")
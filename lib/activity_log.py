@@ -0,0 +1,167 @@
+import atexit
+import gzip
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import deque
+
+import config
+from lib import aws, log, metrics
+
+logger = log.setup_logger()
+stage = os.environ.get("STAGE", "dev")
+
+
+# Process wide, bounded buffer of user activity events.
+# Events are flushed to S3 as one gzipped, newline-delimited JSON object per batch, when
+#  - the batch size is reached
+#  - the oldest event is older than the flush interval
+#  - no event was added for the idle interval (warm container with no traffic)
+#  - the process shuts down
+# On lambda, the flusher thread is frozen between invocations, see flush_after_invocation.
+# When the buffer is full, new events are dropped and counted, instead of blocking the request.
+class ActivityLog(object):
+    def __init__(self, bucket_name, max_events, batch_size, flush_interval, idle_interval, s3_client=None,
+                 clock=time.monotonic):
+        self.bucket_name = bucket_name
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.idle_interval = idle_interval
+        self._s3 = s3_client
+        self._clock = clock
+        self._events = deque()  # (appended at, event)
+        self._newest_at = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one upload at a time, keeps the batches in order
+        self._wakeup = threading.Condition(self._lock)
+        self._flusher = None
+
+    def append(self, event):
+        with self._lock:
+            if len(self._events) >= self.max_events:
+                metrics.incr("activity_log.dropped")
+                return False
+            now = self._clock()
+            self._events.append((now, event))
+            self._newest_at = now
+            metrics.incr("activity_log.appended")
+            if len(self._events) >= self.batch_size:
+                self._wakeup.notify()
+            self._start_flusher()
+        return True
+
+    # Flushes if a size or time limit is reached. Meant to be called at the end of an invocation,
+    # as lambda freezes the flusher thread between invocations
+    def flush_if_due(self):
+        if self._is_due(self._clock()):
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._events.popleft()[1] for _ in range(min(self.batch_size, len(self._events)))]
+                if not batch:
+                    return
+                self._upload(batch)
+
+    def pending(self):
+        return len(self._events)
+
+    # The age of the buffer is the age of its oldest remaining event, so a partial flush restarts the interval
+    def _is_due(self, now):
+        if not self._events:
+            return False
+        oldest_at = self._events[0][0]
+        return (len(self._events) >= self.batch_size
+                or now - oldest_at >= self.flush_interval
+                or now - self._newest_at >= self.idle_interval)
+
+    def _upload(self, batch):
+        body = gzip.compress("".join(json.dumps(event) + "\n" for event in batch).encode("utf-8"))
+        folder_by_day = time.strftime("%Y-%m-%d", time.localtime())  # One folder per day
+        key = f"{stage}/{folder_by_day}/{time.strftime('%Y%m%d%H%M%S', time.localtime())}-{uuid.uuid4().hex}.ndjson.gz"
+        try:
+            with metrics.timed("activity_log.flush"):
+                self._client().put_object(Bucket=self.bucket_name, Key=key, Body=body,
+                                          ContentType="application/x-ndjson", ContentEncoding="gzip")
+            metrics.incr("activity_log.flushed_batches")
+            metrics.incr("activity_log.flushed_events", len(batch))
+        except Exception as e:
+            logger.error(f"Error flushing {len(batch)} activity events to S3: {e}")
+            metrics.incr("activity_log.flush_failures")
+            metrics.incr("activity_log.dropped", len(batch))
+
+    def _client(self):
+        if self._s3 is None:
+            self._s3 = aws.get_client("s3")
+        return self._s3
+
+    # Called with the lock held
+    def _start_flusher(self):
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._run_flusher, name="activity-log-flusher", daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            with self._lock:
+                if not self._is_due(self._clock()):
+                    self._wakeup.wait(timeout=min(self.flush_interval, self.idle_interval))
+                due = self._is_due(self._clock())
+            if due:
+                self.flush()
+
+
+_ACTIVITY_LOG = None
+_ACTIVITY_LOG_LOCK = threading.Lock()
+
+
+def get_activity_log():
+    global _ACTIVITY_LOG
+    if _ACTIVITY_LOG is None:
+        with _ACTIVITY_LOG_LOCK:
+            if _ACTIVITY_LOG is None:
+                _ACTIVITY_LOG = ActivityLog(
+                    config.S3_BUCKET_ACTIVITY_LOGS,
+                    max_events=config.ACTIVITY_LOG_MAX_EVENTS,
+                    batch_size=config.ACTIVITY_LOG_BATCH_SIZE,
+                    flush_interval=config.ACTIVITY_LOG_FLUSH_INTERVAL_IN_SEC,
+                    idle_interval=config.ACTIVITY_LOG_IDLE_FLUSH_IN_SEC,
+                )
+                _install_shutdown_hooks(_ACTIVITY_LOG)
+    return _ACTIVITY_LOG
+
+
+# Called at the end of each invocation. Lambda freezes the flusher thread between invocations, and only sends SIGTERM
+# before shutting the runtime down when an extension is registered, which this function does not do. So everything
+# pending is flushed, unless ACTIVITY_LOG_FLUSH_EACH_INVOCATION is turned off (an extension is attached to the
+# function), in which case only what is due is flushed and the rest is left to the shutdown hooks.
+def flush_after_invocation():
+    activity_log = get_activity_log()
+    if config.ACTIVITY_LOG_FLUSH_EACH_INVOCATION:
+        activity_log.flush()
+    else:
+        activity_log.flush_if_due()
+
+
+# Flush what is left when the process exits: gunicorn sends SIGTERM to its workers, and Lambda sends it before
+# shutting the runtime down when an extension is registered.
+def _install_shutdown_hooks(activity_log):
+    atexit.register(activity_log.flush)
+    if threading.current_thread() is not threading.main_thread():
+        return
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def on_sigterm(signum, frame):
+        activity_log.flush()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
@@ -0,0 +1,70 @@
+import threading
+
+import config
+from lib import profiling
+
+# Process wide registry of boto3 clients and resources.
+# Creating a client costs tens of milliseconds and a new connection pool, so every module gets them from here.
+# They are created lazily on first use, once per (service, region, options).
+# Clients are thread safe once created. Creation goes through one session, under a lock, as sessions are not.
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = {}
+
+
+def client_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=config.AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=config.AWS_TCP_KEEPALIVE,
+        connect_timeout=config.AWS_CONNECT_TIMEOUT_IN_SEC,
+        read_timeout=config.AWS_READ_TIMEOUT_IN_SEC,
+        retries={"mode": config.AWS_RETRY_MODE, "max_attempts": config.AWS_MAX_ATTEMPTS},
+    )
+
+
+def get_client(service_name, region_name=None, **kwargs):
+    key = (service_name, region_name, tuple(sorted(kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                with profiling.timed_init(f"aws.{service_name}"):
+                    client = _get_session().client(service_name, region_name=region_name, config=client_config(), **kwargs)
+                _clients[key] = client
+    return client
+
+
+def get_resource(service_name, region_name=None, **kwargs):
+    key = (service_name, region_name, tuple(sorted(kwargs.items())))
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                with profiling.timed_init(f"aws.{service_name}_resource"):
+                    resource = _get_session().resource(service_name, region_name=region_name, config=client_config(), **kwargs)
+                _resources[key] = resource
+    return resource
+
+
+# Drops every client and resource, e.g. after the credentials changed
+def reset():
+    global _session
+    with _lock:
+        _clients.clear()
+        _resources.clear()
+        _session = None
+
+
+# Called with the lock held. boto3 is imported here rather than at the top, as its import is the largest part
+# of a cold start, and routes like / or warming events don't need it
+def _get_session():
+    global _session
+    if _session is None:
+        with profiling.timed_init("boto3"):
+            import boto3.session
+            _session = boto3.session.Session()
+    return _session
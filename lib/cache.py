@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+
+from lib import metrics
+
+
+# Bounded in-process cache with LRU and TTL eviction. Thread safe.
+# Hits, misses and evictions are counted in lib.metrics as cache.<name>.<counter>
+class TTLCache(object):
+    def __init__(self, name, max_size, ttl, clock=time.monotonic):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    # Returns (True, value) on a hit and (False, None) on a miss. A cached None is a hit.
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self._clock():
+                    self._entries.move_to_end(key)
+                    self._count("hit")
+                    return True, value
+                del self._entries[key]
+                self._count("expired")
+        self._count("miss")
+        return False, None
+
+    # Same as lookup, without counting it or refreshing the LRU position
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock():
+                return True, entry[1]
+        return False, None
+
+    def get(self, key, default=None):
+        hit, value = self.lookup(key)
+        return value if hit else default
+
+    # ttl overrides the default TTL of the cache, for this entry
+    def set(self, key, value, ttl=None):
+        expires_at = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._count("eviction")
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        prefix = f"cache.{self.name}."
+        return {
+            "size": len(self),
+            **{counter: metrics.get(prefix + counter) for counter in ["hit", "miss", "expired", "eviction"]},
+        }
+
+    def _count(self, counter):
+        metrics.incr(f"cache.{self.name}.{counter}")
@@ -1,15 +1,20 @@
 from datetime import datetime
+import copy
+import math
 import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
-import boto3
-from botocore.exceptions import ClientError
-from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
 import config
+from lib import aws, metrics, profiling
+from lib.cache import TTLCache
 
-_SUMMARY_TABLE = None
-_USER_TABLE = None
-_USER_ACTIVITY_TABLE = None
 
 # Using environment variable to determine local or production deployment
 environment = os.getenv('ENVIRONMENT', 'LOCAL')  # Default to 'LOCAL' if not set
@@ -19,15 +24,38 @@ summary_table_name = "content_summary_" + stage
 user_table_name = "user_" + stage
 user_activity_table_name = "user_activity_" + stage
 
+# Limits of BatchGetItem and BatchWriteItem, in keys or requests per call
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+
+# Internal records (leases, etc) live in the same tables as the articles, keyed as "<kind>#<id>".
+# Article ids are sha256 hex digests, so they never contain the separator.
+INTERNAL_KEY_SEP = "#"
+
+def internal_key(kind, id):
+    return f"{kind}{INTERNAL_KEY_SEP}{id}"
+
+# Attribute of the expiry time of the internal records, in epoch seconds. It is the TTL attribute of the tables
+TTL_ATTRIBUTE = "expires_at"
+
+# Whether an internal record is past its expiry time. DynamoDB deletes expired records late, so they can still be read
+def is_expired(record, now=None):
+    expires_at = record.get(TTL_ATTRIBUTE)
+    return expires_at is not None and expires_at <= (time.time() if now is None else now)
+
+def is_internal_key(id):
+    return INTERNAL_KEY_SEP in id
+
+
 def create_dynamodb_resource(local=False):
     if local:
-        return boto3.resource('dynamodb', 
+        return aws.get_resource('dynamodb',
                               endpoint_url='http://localhost:8000',
                               region_name='us-west-2',
                               aws_access_key_id='anything',  # DynamoDB Local doesn't care about these values
                               aws_secret_access_key='anything')
     else:
-        return boto3.resource('dynamodb')
+        return aws.get_resource('dynamodb')
 
 
 def check_table_exists(dynamodb, table_name):
@@ -55,83 +83,209 @@ def create_table(dynamodb, table_name):
     )
     # Wait until the table exists.
     table.meta.client.get_waiter('table_exists').wait(TableName=table_name)
+    # Internal records (leases, chunk summaries) are deleted by DynamoDB once past their expires_at. The deletion
+    # can lag by days, so readers still check expires_at
+    table.meta.client.update_time_to_live(
+        TableName=table_name, TimeToLiveSpecification={'Enabled': True, 'AttributeName': TTL_ATTRIBUTE})
     print(f"Table {table_name} created successfully.")
     return table  # Return the newly created table object.
 
 
-# Creates and provide the Singleton instance of the DB impl for Summary table
-def get_summary_table():
-    global _SUMMARY_TABLE
-    if _SUMMARY_TABLE is None:
-        dynamodb = create_dynamodb_resource(local=(environment == 'LOCAL'))
+# Creates the table if it doesn't exist. Meant for local runs and the bootstrap-tables command, not for requests:
+# it costs a DescribeTable call, and a blocking wait when the table is created
+def ensure_table(dynamodb, table_name):
+    # Try to get the table if it exists
+    table = check_table_exists(dynamodb, table_name)
+
+    if table is None:
+        print(f"Table {table_name} does not exist. Creating table...")
+        table = create_table(dynamodb, table_name)
+    return table
+
+
+# Registry of the tables, by kind. Each table is opened once per process, on first use, under its own lock.
+# With config.DB_CHECK_TABLES (the default locally), opening a table creates it when missing. Otherwise (production)
+# the configured name is trusted and opening makes no API call; run the bootstrap-tables command to create them.
+TABLE_NAMES = {
+    "summary": summary_table_name,
+    "user": user_table_name,
+    # NOTE - Not using this now - writing to s3 directly.
+    "user_activity": user_activity_table_name,
+}
+_tables = {}
+_table_locks = {kind: threading.Lock() for kind in TABLE_NAMES}
+
+
+def get_table(kind):
+    table = _tables.get(kind)
+    if table is None:
+        with _table_locks[kind]:
+            table = _tables.get(kind)
+            if table is None:
+                with profiling.timed_init(f"table.{kind}"):
+                    table = open_table(kind, check=config.DB_CHECK_TABLES)
+                _tables[kind] = table
+    return table
+
+
+def open_table(kind, check=False):
+    dynamodb = create_dynamodb_resource(local=(environment == 'LOCAL'))
+    table_name = TABLE_NAMES[kind]
+    table = DynamoDBImpl(ensure_table(dynamodb, table_name) if check else dynamodb.Table(table_name))
+    if kind == "summary":
+        return CachedDB(table, TTLCache("summary", config.SUMMARY_CACHE_MAX_ITEMS, config.SUMMARY_CACHE_TTL_IN_SEC),
+                        complete=is_summarized)
+    return table
+
+
+# Replaces a table of the registry, e.g. with a stand-in for benchmarks
+def set_table(kind, table):
+    with _table_locks[kind]:
+        _tables[kind] = table
+
+
+# Opens the tables concurrently, and makes a first read on each, so that the connections are set up
+# before the first request. Used for warming events. Returns the time taken by each table, in seconds
+def warm_tables(kinds=None):
+    def warm(kind):
+        started = time.perf_counter()
+        try:
+            get_table(kind).get(internal_key("warmup", kind))
+        except Exception as e:
+            print(f"Exception warming table {kind}: {e}")
+            return None
+        return time.perf_counter() - started
 
-        # Try to get the table if it exists
-        table = check_table_exists(dynamodb, summary_table_name)
+    kinds = list(kinds or TABLE_NAMES)
+    with ThreadPoolExecutor(max_workers=len(kinds), thread_name_prefix="warm-table") as pool:
+        return dict(zip(kinds, pool.map(warm, kinds)))
 
-        if table is None:
-            print(f"Table {summary_table_name} does not exist. Creating table...")
-            table = create_table(dynamodb, summary_table_name)
 
-        _SUMMARY_TABLE = DynamoDBImpl(table)
-    return _SUMMARY_TABLE
+# Creates the missing tables, concurrently. Run once per stage, with the bootstrap-tables command
+def bootstrap_tables():
+    dynamodb = create_dynamodb_resource(local=(environment == 'LOCAL'))
+    with ThreadPoolExecutor(max_workers=len(TABLE_NAMES), thread_name_prefix="bootstrap-table") as pool:
+        list(pool.map(lambda table_name: ensure_table(dynamodb, table_name), TABLE_NAMES.values()))
 
 
-# Creates and provide the Singleton instance of the DB impl for User table
-def get_user_table():
-    global _USER_TABLE
-    if _USER_TABLE is None:
-        dynamodb = create_dynamodb_resource(local=(environment == 'LOCAL'))
+def get_summary_table():
+    return get_table("summary")
 
-        # Try to get the table if it exists
-        table = check_table_exists(dynamodb, user_table_name)
 
-        if table is None:
-            print(f"Table {user_table_name} does not exist. Creating table...")
-            table = create_table(dynamodb, user_table_name)
+def get_user_table():
+    return get_table("user")
 
-        _USER_TABLE = DynamoDBImpl(table)
-    return _USER_TABLE
 
-# Creates and provide the Singleton instance of the DB impl for USER_ACTIVITY table
-# NOTE - Not using this now - writing to s3 directly.
 def get_user_activity_table():
-    global _USER_ACTIVITY_TABLE
-    if _USER_ACTIVITY_TABLE is None:
-        dynamodb = create_dynamodb_resource(local=(environment == 'LOCAL'))
-
-        # Try to get the table if it exists
-        table = check_table_exists(dynamodb, user_activity_table_name)
-
-        if table is None:
-            print(f"Table {user_activity_table_name} does not exist. Creating table...")
-            table = create_table(dynamodb, user_activity_table_name)
-
-        _USER_ACTIVITY_TABLE = DynamoDBImpl(table)
-    return _USER_ACTIVITY_TABLE
+    return get_table("user_activity")
 
 
 # DB interface
 class DB(object):
-    def list(self):
+    # Iterates over all the items
+    def list(self, **kwargs):
         pass
 
     def add(self, item):
         pass
 
-    def get(self, id):
+    def get(self, id, consistent_read=False):
         pass
 
     def delete(self, id):
         pass
 
+    # Items by id, for the ids found
+    def batch_get(self, ids, consistent_read=False):
+        pass
+
+    # Puts the items and deletes the ids. Returns the number of requests that could not be processed
+    def batch_write(self, items=(), delete_ids=()):
+        pass
+
 # DynamoDB implementation of the DB Interface
 class DynamoDBImpl(DB):
     def __init__(self, table_resource):
         self._table = table_resource
 
-    def list(self):
-        response = self._table.scan()
-        return response['Items']
+    # Streams the items of the table, page by page, following LastEvaluatedKey (a single scan stops at 1 MB)
+    #  - segments > 1 scans the segments in parallel, one worker each. Items come in the order the pages arrive
+    #  - projection: the attributes to read, e.g. all but the transcript. Read units and the 1 MB of a page are
+    #    counted on the whole items either way, but much less is sent over the wire and parsed
+    #  - max_read_units: read units per second to stay under, paced on the ConsumedCapacity of every page
+    #  - internal records (leases, fingerprint bands...) are skipped, unless include_internal
+    def list(self, segments=1, projection=None, max_read_units=None, page_size=None, include_internal=False):
+        kwargs = {'ReturnConsumedCapacity': 'TOTAL'}
+        if projection:
+            names = {f'#p{i}': name for i, name in enumerate(dict.fromkeys(['id', *projection]))}
+            kwargs.update(ProjectionExpression=', '.join(names), ExpressionAttributeNames=names)
+        if page_size:
+            kwargs['Limit'] = page_size
+        limiter = ReadRateLimiter(max_read_units) if max_read_units else None
+
+        if segments > 1:
+            pages = self._parallel_scan_pages(segments, kwargs, limiter)
+        else:
+            pages = self._scan_pages(kwargs, limiter)
+        for page in pages:
+            for item in page:
+                if include_internal or not is_internal_key(item['id']):
+                    yield item
+
+    def _scan_pages(self, kwargs, limiter=None, stop=None):
+        while True:
+            response = self._table.scan(**kwargs)
+            read_units = response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+            metrics.incr("db.scan.pages")
+            metrics.incr("db.scan.read_units", read_units)
+            yield response['Items']
+            if 'LastEvaluatedKey' not in response or (stop is not None and stop.is_set()):
+                return
+            kwargs = {**kwargs, 'ExclusiveStartKey': response['LastEvaluatedKey']}
+            if limiter:
+                limiter.consume(read_units)
+
+    # Each segment is scanned by a worker, which hands its pages over through a bounded queue, so that a slow
+    # consumer holds the workers back instead of piling the table up in memory. Stops the workers when the
+    # consumer stops early
+    def _parallel_scan_pages(self, segments, kwargs, limiter):
+        pages = queue.Queue(maxsize=segments * 2)
+        stop = threading.Event()
+        done = object()
+
+        def scan(segment):
+            try:
+                for page in self._scan_pages({**kwargs, 'Segment': segment, 'TotalSegments': segments}, limiter, stop):
+                    while not stop.is_set():
+                        try:
+                            pages.put(page, timeout=0.1)
+                            break
+                        except queue.Full:
+                            pass
+            except Exception as e:
+                pages.put(e)
+            finally:
+                pages.put(done)
+
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="scan") as pool:
+            for segment in range(segments):
+                pool.submit(scan, segment)
+            try:
+                running = segments
+                while running:
+                    page = pages.get()
+                    if page is done:
+                        running -= 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        yield page
+            finally:
+                stop.set()
+                # Unblocks the workers waiting for room in the queue, so that the pool can shut down
+                while running:
+                    if pages.get() is done:
+                        running -= 1
 
     def add(self, item):
         try:
@@ -147,17 +301,66 @@ class DynamoDBImpl(DB):
         return None
         
     # Returns the item if found. Returns None if not found
-    def get(self, id):
+    def get(self, id, consistent_read=False):
         response = self._table.get_item(
             Key={
                 'id': id
-            }
+            },
+            ConsistentRead=consistent_read
         )
         if 'Item' in response:
             return response['Item']
         else:
             return None
 
+    # Reads the ids BATCH_GET_LIMIT at a time. Keys left unprocessed by DynamoDB (throttling, or the 16 MB response
+    # limit) are retried with exponential backoff, up to config.DB_BATCH_MAX_ATTEMPTS
+    def batch_get(self, ids, consistent_read=False):
+        ids = list(dict.fromkeys(ids))  # a batch can't have the same key twice
+        items = {}
+        for start in range(0, len(ids), BATCH_GET_LIMIT):
+            request = {self._table.name: {
+                'Keys': [{'id': id} for id in ids[start:start + BATCH_GET_LIMIT]],
+                'ConsistentRead': consistent_read,
+            }}
+            unprocessed = self._batch_with_retries(self._table.meta.client.batch_get_item, request, 'UnprocessedKeys',
+                                                   lambda response: items.update(
+                                                       (item['id'], item) for item in response['Responses'].get(self._table.name, [])))
+            if unprocessed:
+                metrics.incr("db.batch_get.unprocessed", len(unprocessed[self._table.name]['Keys']))
+                print(f"Keys left unprocessed reading a batch from DynamoDB: {len(unprocessed[self._table.name]['Keys'])}")
+        return items
+
+    # Writes BATCH_WRITE_LIMIT requests at a time, retrying the unprocessed ones like batch_get
+    def batch_write(self, items=(), delete_ids=()):
+        requests = {item['id']: {'PutRequest': {'Item': to_dynamodb(item)}} for item in items}
+        requests.update({id: {'DeleteRequest': {'Key': {'id': id}}} for id in delete_ids})
+        requests = list(requests.values())  # one request per key, the last one wins
+        left = 0
+        for start in range(0, len(requests), BATCH_WRITE_LIMIT):
+            request = {self._table.name: requests[start:start + BATCH_WRITE_LIMIT]}
+            unprocessed = self._batch_with_retries(self._table.meta.client.batch_write_item, request, 'UnprocessedItems')
+            if unprocessed:
+                left += len(unprocessed[self._table.name])
+        if left:
+            metrics.incr("db.batch_write.unprocessed", left)
+            print(f"Requests left unprocessed writing a batch to DynamoDB: {left}")
+        return left
+
+    # Calls the batch operation until nothing is left unprocessed. Returns what is still unprocessed after the last attempt
+    def _batch_with_retries(self, operation, request, unprocessed_key, on_response=None):
+        for attempt in range(config.DB_BATCH_MAX_ATTEMPTS):
+            if attempt:
+                metrics.incr("db.batch.retry")
+                time.sleep(config.DB_BATCH_BACKOFF_IN_SEC * 2 ** (attempt - 1) * random.uniform(0.5, 1))
+            response = operation(RequestItems=request)
+            if on_response:
+                on_response(response)
+            request = response.get(unprocessed_key)
+            if not request:
+                return None
+        return request
+
     # Returns True if succesfully deleted. Returns False on error 
     def delete(self, id):
         try:
@@ -192,3 +395,295 @@ class DynamoDBImpl(DB):
             print(f"Exception updating/adding Item in DynamoDB {e}")
             return None
 
+    # Sets only the given fields of the item in a single UpdateItem call, creating the item if it doesn't exist.
+    # condition is an optional ConditionExpression. Its placeholders go in condition_names and condition_values.
+    # remove lists the attributes to delete in the same call.
+    # Returns the updated attributes if successful, None otherwise (including when the condition fails).
+    def update(self, id, fields, condition=None, condition_names=None, condition_values=None, remove=()):
+        names = dict(condition_names or {})
+        values = dict(condition_values or {})
+        assignments = []
+        for i, (name, value) in enumerate(fields.items()):
+            if name == 'id':
+                continue
+            names[f"#f{i}"] = name
+            values[f":v{i}"] = to_dynamodb(value)
+            assignments.append(f"#f{i} = :v{i}")
+        removals = []
+        for i, name in enumerate(remove):
+            names[f"#r{i}"] = name
+            removals.append(f"#r{i}")
+        if not assignments and not removals:
+            return {}
+
+        expression = []
+        if assignments:
+            expression.append("SET " + ", ".join(assignments))
+        if removals:
+            expression.append("REMOVE " + ", ".join(removals))
+        kwargs = {
+            'Key': {'id': id},
+            'UpdateExpression': " ".join(expression),
+            'ExpressionAttributeNames': names,
+            'ReturnValues': "UPDATED_NEW",
+        }
+        if values:
+            kwargs['ExpressionAttributeValues'] = values
+        if condition:
+            kwargs['ConditionExpression'] = condition
+        try:
+            response = self._table.update_item(**kwargs)
+            return response.get('Attributes', {})
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                print(f"Condition failed updating Item {id} in DynamoDB")
+            else:
+                print(f"Exception updating Item in DynamoDB {e}")
+            return None
+        except Exception as e:
+            print(f"Exception updating Item in DynamoDB {e}")
+            return None
+
+    # Adds the values to a string set attribute of the item, creating both if they don't exist
+    # With max_size, the values are not added once the set has max_size elements, and False is returned
+    def add_to_set(self, id, field, values, max_size=None):
+        kwargs = {}
+        if max_size is not None:
+            kwargs['ConditionExpression'] = "attribute_not_exists(#f) OR size(#f) < :max"
+        try:
+            self._table.update_item(
+                Key={'id': id},
+                UpdateExpression="ADD #f :v",
+                ExpressionAttributeNames={'#f': field},
+                ExpressionAttributeValues={':v': set(values), **({':max': max_size} if max_size is not None else {})},
+                **kwargs
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                print(f"Exception adding to set of Item in DynamoDB {e}")
+            return False
+
+    # Takes the "in progress" lease for a key, if nobody holds it or the current lease has expired.
+    # Returns True if the lease was acquired by this owner.
+    def acquire_lease(self, key, owner, ttl):
+        now = int(time.time())
+        try:
+            self._table.put_item(
+                Item={'id': internal_key("lease", key), 'owner': owner, 'expires_at': now + ttl},
+                ConditionExpression="attribute_not_exists(id) OR expires_at < :now",
+                ExpressionAttributeValues={':now': now}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    # Extends the lease held by this owner to ttl from now. Returns False if the lease was taken over, or on an error
+    def renew_lease(self, key, owner, ttl):
+        try:
+            self._table.update_item(
+                Key={'id': internal_key("lease", key)},
+                UpdateExpression="SET expires_at = :expires_at",
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': owner, ':expires_at': int(time.time()) + ttl}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                print(f"Lease {key} was taken over by another owner")
+            else:
+                print(f"Exception renewing lease {key} in DynamoDB {e}")
+            return False
+        except BotoCoreError as e:
+            print(f"Exception renewing lease {key} in DynamoDB {e}")
+            return False
+
+    # Releases the lease, only if it is still held by this owner. Returns False if it wasn't released: taken over
+    # by another owner, or an error. Errors are not raised, as the lease expires on its own after its TTL and the
+    # caller releases it on its way out, once the work is done
+    def release_lease(self, key, owner):
+        try:
+            self._table.delete_item(
+                Key={'id': internal_key("lease", key)},
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': owner}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                print(f"Lease {key} was taken over by another owner")
+            else:
+                print(f"Exception releasing lease {key} in DynamoDB {e}")
+            return False
+        except BotoCoreError as e:
+            print(f"Exception releasing lease {key} in DynamoDB {e}")
+            return False
+
+
+
+# Whether an item of the summary table is final: an article with its summary, or an internal record. Articles still
+# being summarized, e.g. queued by /batch, change in other containers
+def is_summarized(item):
+    return is_internal_key(item["id"]) or bool(item.get("text_summary"))
+
+
+# Read-through cache in front of a DB implementation.
+# Items found are cached for the TTL of the cache, not found results for config.SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC.
+# So are the items that complete(item) says are not final yet, when given.
+# Writes go through the cache, deletes invalidate it. Callers get copies, so mutating a returned item doesn't touch the cache.
+# Methods not overridden here are delegated to the wrapped implementation.
+class CachedDB(DB):
+    def __init__(self, db, cache, complete=None):
+        self._db = db
+        self._cache = cache
+        self._complete = complete
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def list(self, **kwargs):
+        return self._db.list(**kwargs)
+
+    # A consistent read always goes to the table, and refreshes the cache
+    def get(self, id, consistent_read=False):
+        hit, entry = (False, None) if consistent_read else self._cache.lookup(id)
+        if hit:
+            item, read_units = entry
+            metrics.incr(f"cache.{self._cache.name}.read_units_saved", read_units)
+            return copy.deepcopy(item)
+
+        item = self._db.get(id, consistent_read)
+        self._store(id, item)
+        return copy.deepcopy(item)
+
+    def add(self, item):
+        result = self._db.add(item)
+        if result:
+            self._store(result["id"], result)
+        elif item:
+            self._cache.invalidate(item["id"])
+        return result
+
+    def addOrUpdate(self, item):
+        result = self._db.addOrUpdate(item)
+        if result:
+            self._store(result["id"], result)
+        else:
+            self._cache.invalidate(item["id"])
+        return result
+
+    def delete(self, id):
+        self._cache.invalidate(id)
+        return self._db.delete(id)
+
+    # Merges the updated fields into the cached item, if there is one. Invalidates the entry otherwise.
+    def update(self, id, fields, condition=None, condition_names=None, condition_values=None, remove=()):
+        result = self._db.update(id, fields, condition, condition_names, condition_values, remove)
+        hit, entry = self._cache.peek(id)
+        if result is not None and hit and entry[0]:
+            item = {k: v for k, v in {**entry[0], **result}.items() if k not in remove}
+            self._store(id, item)
+        else:
+            self._cache.invalidate(id)
+        return result
+
+    def add_to_set(self, id, field, values, max_size=None):
+        self._cache.invalidate(id)
+        return self._db.add_to_set(id, field, values, max_size)
+
+    # Cached items are served from the cache, and only the others are read, in batches
+    def batch_get(self, ids, consistent_read=False):
+        items = {}
+        missing = []
+        for id in dict.fromkeys(ids):
+            hit, entry = (False, None) if consistent_read else self._cache.lookup(id)
+            if not hit:
+                missing.append(id)
+            elif entry[0]:
+                metrics.incr(f"cache.{self._cache.name}.read_units_saved", entry[1])
+                items[id] = copy.deepcopy(entry[0])
+        if missing:
+            found = self._db.batch_get(missing, consistent_read)
+            for id in missing:
+                self._store(id, found.get(id))
+            items.update(found)
+        return items
+
+    def batch_write(self, items=(), delete_ids=()):
+        items = list(items)
+        # Unprocessed requests are not reported by id, so the cache is invalidated rather than written through
+        for id in [item['id'] for item in items] + list(delete_ids):
+            self._cache.invalidate(id)
+        return self._db.batch_write(items, delete_ids)
+
+    def stats(self):
+        return {**self._cache.stats(), "read_units_saved": metrics.get(f"cache.{self._cache.name}.read_units_saved")}
+
+    def _store(self, id, item):
+        if item and self._complete and not self._complete(item):
+            self._cache.set(id, (copy.deepcopy(item), read_units(item)), ttl=config.SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC)
+        elif item:
+            self._cache.set(id, (copy.deepcopy(item), read_units(item)))
+        else:
+            self._cache.set(id, (None, 0.5), ttl=config.SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC)
+
+
+# Paces a scan to stay under a number of read units per second, across the workers of a parallel scan
+class ReadRateLimiter(object):
+    def __init__(self, units_per_sec, clock=time.monotonic, sleep=time.sleep):
+        self.units_per_sec = units_per_sec
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._started = None
+        self._consumed = 0.0
+
+    # Records the units of a call, and waits until the rate since the start is back under the limit
+    def consume(self, units):
+        with self._lock:
+            now = self._clock()
+            if self._started is None:
+                self._started = now
+            self._consumed += units
+            wait = self._consumed / self.units_per_sec - (now - self._started)
+        if wait > 0:
+            metrics.timing("db.scan.throttled", wait)
+            self._sleep(wait)
+
+
+# boto3 rejects floats, numbers must be Decimal. Converts them, in nested values too
+def to_dynamodb(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamodb(v) for v in value]
+    return value
+
+
+# Approximate read units of an eventually consistent GetItem for this item: 0.5 per started 4 KB
+def read_units(item):
+    return max(1, math.ceil(item_size(item) / 4096)) * 0.5
+
+
+# Approximate size of an item as DynamoDB counts it: the attribute names, plus the lengths of strings and binaries.
+# Numbers are counted at their largest (21 bytes)
+def item_size(value):
+    if isinstance(value, dict):
+        return sum(len(str(name).encode("utf-8")) + item_size(v) for name, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(1 + item_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(getattr(value, "value", None), bytes):  # boto3 Binary
+        return len(value.value)
+    if value is None or isinstance(value, bool):
+        return 1
+    return 21
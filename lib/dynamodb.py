@@ -1,7 +1,7 @@
-import boto3
+from lib import aws
 
-# Initialize DynamoDB client
-dynamodb = boto3.client('dynamodb')
+# Get the shared DynamoDB client
+dynamodb = aws.get_client('dynamodb')
 
 # Define table name
 table_name = 'YourTableName'
@@ -3,6 +3,9 @@ import logging, sys
 def setup_logger():
     """Set up and return a logger with the given name."""
     logger = logging.getLogger("PP_BACKEND")
+    # Every module calls this at import. The handler is added once, or each line would be logged once per module
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
 
     # Create a stream handler that outputs to sys.stdout
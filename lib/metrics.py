@@ -0,0 +1,49 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Process wide counters and timings. On a warm container these accumulate across requests,
+# and are exposed through the /metrics route.
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def timing(name, seconds):
+    with _lock:
+        count, total, slowest = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(slowest, seconds))
+
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, time.perf_counter() - start)
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot():
+    with _lock:
+        timings = {
+            name: {"count": count, "avg_ms": round(total * 1000 / count, 3), "max_ms": round(slowest * 1000, 3)}
+            for name, (count, total, slowest) in _timings.items()
+        }
+        return {"counters": dict(_counters), "timings": timings}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
@@ -0,0 +1,50 @@
+import re
+import time
+from contextlib import contextmanager
+
+import config
+from lib import log, metrics
+
+logger = log.setup_logger()
+
+# Cold start profiling. Heavy resources (clients, secrets, tables) are created lazily, in timed_init blocks,
+# so their cost shows in /metrics as init.<name> timings.
+# With PROFILE_COLD_START, every initialisation is also logged as it happens. For the imports themselves,
+# set PYTHONPROFILEIMPORTTIME=1 on the function: python then writes the import time of every module to stderr,
+# which summarize_import_times turns into a report (see bench/cold_start.py)
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+@contextmanager
+def timed_init(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.timing(f"init.{name}", elapsed)
+        if config.PROFILE_COLD_START:
+            logger.info(f"Initialised {name} in {elapsed * 1000:.1f}ms")
+
+
+# Parses the output of python -X importtime. Returns the top level imports, and the slowest packages
+# with their cumulative time in microseconds, slowest first
+def summarize_import_times(stderr, top=15):
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((int(cumulative_us), int(self_us), len(indent) // 2, module))
+
+    # A top level import includes the time of everything it imported first
+    top_level = sorted(((us, module) for us, _, depth, module in entries if depth == 0), reverse=True)
+    packages = {}
+    for _, self_us, _, module in entries:
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return {
+        "total_us": sum(us for us, _ in top_level),
+        "top_level": top_level[:top],
+        "packages": sorted(((us, package) for package, us in packages.items()), reverse=True)[:top],
+    }
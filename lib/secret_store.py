@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+
+import config
+from lib import aws, log, metrics, profiling
+
+logger = log.setup_logger()
+
+# Secrets provider with an in-memory TTL cache.
+#  - For development and tests, a secret set as an environment variable, or in the JSON file of config.SECRETS_FILE,
+#    is used as is, without calling AWS
+#  - Otherwise it is read from Secrets Manager in config.SECRETS_REGION, and cached for SECRETS_TTL_IN_SEC.
+#    SECRETS_REFRESH_AHEAD_IN_SEC before it expires, a background thread fetches it again, so requests don't wait.
+#    If Secrets Manager fails once the secret has expired, the last value is kept (e.g. during an outage)
+# Secrets are stored as a JSON key-value pair, with the key same as the secret name. Plain strings work too.
+class SecretStore(object):
+    def __init__(self, region_name, ttl, refresh_ahead, secrets_file=None, clock=time.monotonic):
+        self.region_name = region_name
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.secrets_file = secrets_file
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cache = {}  # name -> (value, fetched_at)
+        self._refreshing = set()
+
+    def get(self, name):
+        local = self._local(name)
+        if local is not None:
+            return local
+
+        entry = self._cache.get(name)
+        if entry is not None:
+            age = self._clock() - entry[1]
+            if age < self.ttl:
+                metrics.incr("secrets.hit")
+                if age >= self.ttl - self.refresh_ahead:
+                    self._refresh_in_background(name)
+                return entry[0]
+
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry is not None and self._clock() - entry[1] < self.ttl:
+                return entry[0]
+            metrics.incr("secrets.miss")
+            try:
+                return self._fetch(name)
+            except Exception as e:
+                if entry is None:
+                    raise
+                metrics.incr("secrets.stale")
+                logger.error(f"Error refreshing secret {name}, keeping the expired value: {e}")
+                return entry[0]
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(name, None)
+
+    def _local(self, name):
+        if name in os.environ:
+            return os.environ[name]
+        if self.secrets_file and os.path.exists(self.secrets_file):
+            with open(self.secrets_file, "r") as f:
+                return json.load(f).get(name)
+        return None
+
+    def _fetch(self, name):
+        client = aws.get_client("secretsmanager", region_name=self.region_name)
+        with profiling.timed_init(f"secret.{name}"):
+            response = client.get_secret_value(SecretId=name)
+        value = parse_secret(name, response)
+        self._cache[name] = (value, self._clock())
+        return value
+
+    def _refresh_in_background(self, name):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                value = parse_secret(name, aws.get_client("secretsmanager", region_name=self.region_name).get_secret_value(SecretId=name))
+                with self._lock:
+                    self._cache[name] = (value, self._clock())
+                metrics.incr("secrets.refresh")
+            except Exception as e:
+                metrics.incr("secrets.refresh_failure")
+                logger.error(f"Error refreshing secret {name} in the background: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        threading.Thread(target=refresh, name=f"secret-refresh-{name}", daemon=True).start()
+
+
+def parse_secret(name, response):
+    secret = response["SecretString"] if "SecretString" in response else response["SecretBinary"]
+    try:
+        values = json.loads(secret)
+    except ValueError:
+        return secret
+    return values[name] if isinstance(values, dict) else secret
+
+
+_SECRET_STORE = None
+_SECRET_STORE_LOCK = threading.Lock()
+
+
+def get_secret_store():
+    global _SECRET_STORE
+    if _SECRET_STORE is None:
+        with _SECRET_STORE_LOCK:
+            if _SECRET_STORE is None:
+                _SECRET_STORE = SecretStore(config.SECRETS_REGION, config.SECRETS_TTL_IN_SEC,
+                                            config.SECRETS_REFRESH_AHEAD_IN_SEC, config.SECRETS_FILE)
+    return _SECRET_STORE
+
+
+def get_secret(name):
+    return get_secret_store().get(name)
@@ -0,0 +1,53 @@
+import threading
+
+
+# In-process single-flight: the first caller for a key becomes the leader, later callers get an event
+# that is set when the leader is done. The result itself is shared through the DB, not through this class.
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    # Returns None when the caller is the leader for the key, the event to wait on otherwise
+    def acquire(self, key):
+        with self._lock:
+            event = self._calls.get(key)
+            if event is not None:
+                return event
+            self._calls[key] = threading.Event()
+            return None
+
+    def release(self, key):
+        with self._lock:
+            event = self._calls.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+# Renews a lease of the table (see DynamoDBImpl.acquire_lease) every interval, on a daemon thread, until stopped.
+# Keeps a lease from expiring under a long run, e.g. the map-reduce of a long document, and being taken over
+class LeaseRenewer(object):
+    def __init__(self, table, key, owner, ttl, interval):
+        self._table = table
+        self._key = key
+        self._owner = owner
+        self._ttl = ttl
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"lease-{key}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if not self._table.renew_lease(self._key, self._owner, self._ttl):
+                return
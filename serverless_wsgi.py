@@ -12,6 +12,7 @@ import io
 import json
 import os
 import sys
+from itertools import chain
 from urllib.parse import urlencode, unquote, unquote_plus
 
 from werkzeug.datastructures import Headers, iter_multi_items
@@ -28,6 +29,11 @@ TEXT_MIME_TYPES = [
     "image/svg+xml",
 ]
 
+# Content type and delimiter of the HTTP integration format used by Lambda response streaming.
+# The JSON prelude with status and headers is followed by 8 NUL bytes and then the raw body.
+STREAMING_CONTENT_TYPE = "application/vnd.awslambda.http-integration-response"
+STREAMING_PRELUDE_DELIMITER = b"\x00" * 8
+
 
 def all_casings(input_string):
     """
@@ -193,6 +199,15 @@ def handle_request(app, event, context):
 
 
 def handle_payload_v1(app, event, context):
+    environ = environ_payload_v1(event, context)
+
+    response = Response.from_app(app, environ)
+    returndict = generate_response(response, event)
+
+    return returndict
+
+
+def environ_payload_v1(event, context):
     if "multiValueHeaders" in event and event["multiValueHeaders"]:
         headers = Headers(event["multiValueHeaders"])
     else:
@@ -242,15 +257,20 @@ def handle_payload_v1(app, event, context):
         "serverless.context": context,
     }
 
-    environ = setup_environ_items(environ, headers)
+    return setup_environ_items(environ, headers)
+
+
+def handle_payload_v2(app, event, context):
+    environ = environ_payload_v2(event, context)
 
     response = Response.from_app(app, environ)
+
     returndict = generate_response(response, event)
 
     return returndict
 
 
-def handle_payload_v2(app, event, context):
+def environ_payload_v2(event, context):
     headers = Headers(event["headers"])
 
     script_name = get_script_name(headers, event.get("requestContext", {}))
@@ -298,13 +318,7 @@ def handle_payload_v2(app, event, context):
         "serverless.context": context,
     }
 
-    environ = setup_environ_items(environ, headers)
-
-    response = Response.from_app(app, environ)
-
-    returndict = generate_response(response, event)
-
-    return returndict
+    return setup_environ_items(environ, headers)
 
 
 def handle_lambda_integration(app, event, context):
@@ -356,3 +370,93 @@ def handle_lambda_integration(app, event, context):
         raise RuntimeError(json.dumps(returndict))
 
     return returndict
+
+
+def generate_streaming_prelude(status, headers, event):
+    """Build the JSON prelude that precedes the body of a streamed response.
+    Payload v2 carries cookies separately, payload v1 follows the header
+    style of the incoming event, as in `generate_response`.
+    """
+    status_code = int(status.split(" ", 1)[0])
+    prelude = {"statusCode": status_code}
+
+    if event.get("version") == "2.0":
+        prelude["cookies"] = headers.get_all("Set-Cookie")
+        headers = Headers([(k, v) for k, v in headers.items() if k.lower() != "set-cookie"])
+        prelude["headers"] = {key: ", ".join(headers.get_all(key)) for key in headers.keys()}
+    elif "multiValueHeaders" in event and event["multiValueHeaders"]:
+        prelude["multiValueHeaders"] = group_headers(headers)
+    else:
+        prelude["headers"] = split_headers(headers)
+
+    return json.dumps(prelude).encode("utf-8") + STREAMING_PRELUDE_DELIMITER
+
+
+def stream_request(app, event, context):
+    """Run the WSGI app for a payload v1 or v2 event without draining its
+    iterator. Yields the prelude first and then every body chunk as soon as
+    the app produces it.
+    """
+    if event.get("version") == "2.0":
+        environ = environ_payload_v2(event, context)
+    else:
+        environ = environ_payload_v1(event, context)
+
+    app_rv, app_iter, status, headers = start_wsgi_app(app, environ)
+    try:
+        yield generate_streaming_prelude(status, Headers(headers), event)
+        for chunk in app_iter:
+            if chunk:
+                yield chunk
+    finally:
+        if hasattr(app_rv, "close"):
+            app_rv.close()
+
+
+def start_wsgi_app(app, environ):
+    """Call the WSGI app and return its status and headers, with an iterator
+    over the body. Unlike `run_wsgi_app`, which always pulls the first chunk,
+    the body is only iterated when the app didn't call `start_response` yet,
+    so the prelude can be sent before the first chunk is generated.
+    """
+    response = []
+    buffer = []
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and response:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response[:] = [status, headers]
+        return buffer.append
+
+    app_rv = app(environ, start_response)
+    app_iter = iter(app_rv)
+    while not response:
+        buffer.append(next(app_iter))
+    return app_rv, chain(buffer, app_iter), response[0], response[1]
+
+
+def handle_request_streaming(app, event, context, response_stream):
+    """Response streaming variant of `handle_request`.
+
+    `response_stream` is the writable Lambda response stream. Each WSGI
+    chunk is written to it as it is produced, so `stream_with_context`
+    views reach the client before the whole response is generated.
+    Events that can't be streamed (warming, non-proxy integration, ALB)
+    are handled as buffered responses and written in one go.
+    """
+    if event.get("source") in ["aws.events", "serverless-plugin-warmup"]:
+        print("Lambda warming event received, skipping handler")
+        return
+
+    if (
+            event.get("version") is None
+            and event.get("isBase64Encoded") is None
+            and event.get("requestPath") is not None
+    ) or is_alb_event(event):
+        response_stream.write(json.dumps(handle_request(app, event, context)).encode("utf-8"))
+        return
+
+    for chunk in stream_request(app, event, context):
+        response_stream.write(chunk)
+        if hasattr(response_stream, "flush"):
+            response_stream.flush()
@@ -1,13 +1,18 @@
-from gtts import gTTS
-
+import hashlib
+import io
+import random
 import time
 import os
-import boto3
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from services import util
+from botocore.exceptions import ClientError
+
+from services import chunking, jobs, util
+from lib import aws, db, log, metrics
 import config
 
+logger = log.setup_logger()
+
 # def text_to_audio_fb(video_id, text):
 #     model = VitsModel.from_pretrained("facebook/mms-tts-eng")
 #     tokenizer = AutoTokenizer.from_pretrained("facebook/mms-tts-eng")
@@ -26,7 +31,7 @@ import config
 
 #     return url, summary_audio_file
 
-polly = boto3.client('polly', region_name='us-east-1')
+polly_region = "us-east-1"
 output_format = "mp3"
 
 # Set the voice ID (for a list of available voices, refer to the documentation)
@@ -34,30 +39,184 @@ voice_id = "Matthew"
 engine = "neural"
 
 
+# Audio is stored by content: the key is a hash of the normalised text and of the voice, engine and format.
+# The same summary (regenerated, retried, or shared by the variants of an article) is synthesized only once,
+# and the audio_summary_url of all the articles points to the shared object
+def audio_key(text, voice, engine, format):
+    normalized = " ".join(text.split())
+    digest = hashlib.sha256(f"{engine}|{voice}|{format}|{normalized}".encode("utf-8")).hexdigest()
+    return f"audio/{digest}.{format}"
+
+
+# The s3 url of the audio already synthesized for this key, None if there is none yet
+def cached_audio(key):
+    if util.s3_object_exists(config.S3_BUCKET_AUDIO_OUTPUT, key):
+        metrics.incr("audio_cache.hit")
+        logger.info(f"Audio {key} already synthesized. Reusing it")
+        return util.s3_url(config.S3_BUCKET_AUDIO_OUTPUT, key)
+    metrics.incr("audio_cache.miss")
+    return None
+
+
 def text_to_audio_gtts(id, text):
-    summary_audio_file = f"{id}_summary.mp3"
+    key = audio_key(text, "en", "gtts", "mp3")
+    cached = cached_audio(key)
+    if cached:
+        return cached
+    from gtts import gTTS  # only used by this backend, not worth its import time on every cold start
     tts = gTTS(text, lang='en', slow=False)
-    file_path = f"/tmp/{summary_audio_file}"
-    tts.save(file_path)
+    # gTTS writes to a file-like object, kept in memory rather than in /tmp
+    buffer = io.BytesIO()
+    tts.write_to_fp(buffer)
+    buffer.seek(0)
+    return util.upload_stream_to_s3(buffer, config.S3_BUCKET_AUDIO_OUTPUT, key)
+
+# Summaries longer than a Polly request are split on sentences, and the chunks are synthesized concurrently.
+# Polly mp3 output is plain MPEG frames, so the chunks are joined in order into one mp3
+_polly_pool = ThreadPoolExecutor(max_workers=config.POLLY_WORKERS, thread_name_prefix="polly")
 
-    folder_by_day = time.strftime("%Y-%m-%d", time.localtime()) # One folder per day
-    index, url = util.upload_to_s3(file_path, config.S3_BUCKET_AUDIO_OUTPUT, f"{folder_by_day}/{id}/summary/{summary_audio_file}")
-    return url, file_path
 
 def text_to_audio_polly(id, text):
-    response = polly.synthesize_speech(
+    key = audio_key(text, voice_id, engine, output_format)
+    cached = cached_audio(key)
+    if cached:
+        return cached
+
+    chunks = chunking.split_text(text, config.POLLY_CHUNK_CHARS, count=len)
+    if len(chunks) <= 1:
+        response = synthesize_speech(text)
+        # The audio stream is piped to S3 part by part, without a local copy
+        with response["AudioStream"] as audio_stream:
+            return util.upload_stream_to_s3(audio_stream, config.S3_BUCKET_AUDIO_OUTPUT, key)
+
+    audio = synthesize_chunks(chunks)
+    return util.upload_stream_to_s3(io.BytesIO(audio), config.S3_BUCKET_AUDIO_OUTPUT, key)
+
+
+def synthesize_speech(text, polly=None):
+    polly = polly or aws.get_client("polly", region_name=polly_region)
+    return polly.synthesize_speech(
     Text=text,
     OutputFormat=output_format,
     VoiceId=voice_id,
     Engine=engine
     )
 
-    summary_audio_file = f"{id}_summary.mp3"
-    file_path = f"/tmp/{summary_audio_file}"
-    file = open(file_path, "wb")
-    file.write(response["AudioStream"].read())
-    file.close()
 
-    folder_by_day = time.strftime("%Y-%m-%d", time.localtime()) # One folder per day
-    index, url = util.upload_to_s3(file_path, config.S3_BUCKET_AUDIO_OUTPUT, f"{folder_by_day}/{id}/summary/{summary_audio_file}")
-    return url, file_path
+# Synthesizes the chunks on the polly pool, and returns the audio of all the chunks, in order
+def synthesize_chunks(chunks, polly=None, pool=None):
+    pool = pool or _polly_pool
+    futures = {pool.submit(synthesize_chunk, chunk, polly): index for index, chunk in enumerate(chunks)}
+    audio = [None] * len(chunks)
+    for future in as_completed(futures):
+        audio[futures[future]] = future.result()
+    metrics.incr("polly.chunks", len(chunks))
+    return b"".join(audio)
+
+
+# Audio of one chunk. Retried with exponential backoff, as reading the audio stream can fail after botocore
+# is done with its own retries of the call. Client errors like an invalid text are not retried
+def synthesize_chunk(text, polly=None):
+    for attempt in range(1, config.POLLY_MAX_ATTEMPTS + 1):
+        try:
+            with synthesize_speech(text, polly)["AudioStream"] as audio_stream:
+                return audio_stream.read()
+        except Exception as e:
+            if attempt == config.POLLY_MAX_ATTEMPTS or not is_retryable(e):
+                metrics.incr("polly.chunk_failure")
+                raise
+            metrics.incr("polly.chunk_retry")
+            delay = config.POLLY_RETRY_BACKOFF_IN_SEC * 2 ** (attempt - 1)
+            logger.warning(f"Polly chunk failed on attempt {attempt}, retrying in {delay:.1f}s: {e}")
+            time.sleep(delay * (0.5 + random.random() / 2))
+
+
+def is_retryable(error):
+    if isinstance(error, ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 500)
+        return status >= 500 or "Throttl" in code
+    return True
+
+
+# Audio summaries are generated in the background, as "audio" jobs. The state of the job is kept on the article,
+# in audio_status (queued, running, done or failed) and audio_status_at. Conditional updates of the state make
+# the job idempotent: it is queued once, and runs once even when it is delivered more than once
+AUDIO_QUEUED = "queued"
+AUDIO_RUNNING = "running"
+AUDIO_DONE = "done"
+AUDIO_FAILED = "failed"
+AUDIO_STATE_NAMES = {"#status": "audio_status", "#at": "audio_status_at"}
+
+
+# Seconds to wait before a failed job is queued again, doubled after every attempt
+def retry_backoff(attempts):
+    return config.AUDIO_RETRY_BACKOFF_IN_SEC * 2 ** max(attempts - 1, 0)
+
+
+# Whether request_audio may queue the job of the item, checked on the item at hand (e.g. a cached one) to skip
+# the conditional write when it would fail anyway. Mirrors the condition of request_audio
+def audio_due(item, now=None):
+    now = int(time.time()) if now is None else now
+    if item.get("audio_summary_url"):
+        return False
+    status, at, attempts = item.get("audio_status"), item.get("audio_status_at", 0), int(item.get("audio_attempts", 0))
+    if status is None:
+        return True
+    if attempts >= config.AUDIO_MAX_ATTEMPTS:
+        return False
+    if status == AUDIO_FAILED:
+        return at < now - retry_backoff(attempts)
+    return at < now - config.AUDIO_JOB_STALE_IN_SEC
+
+
+# Queues the audio job of an article, unless it already has audio or its job is queued or running.
+# A job that stayed queued or running for longer than AUDIO_JOB_STALE_IN_SEC is considered lost, and queued again.
+# A failed one is queued again after retry_backoff(). Both stop after AUDIO_MAX_ATTEMPTS jobs, counted in
+# audio_attempts: attempts is its value on the item the caller read, 0 for a new article.
+# Returns True if a job was queued
+def request_audio(id, text, attempts=0):
+    now, attempts = int(time.time()), int(attempts)
+    queued = db.get_summary_table().update(
+        id, {"audio_status": AUDIO_QUEUED, "audio_status_at": now, "audio_attempts": attempts + 1},
+        condition="attribute_not_exists(audio_summary_url) AND (attribute_not_exists(#status) OR "
+                  "((attribute_not_exists(#attempts) OR #attempts < :max_attempts) AND "
+                  "((#status = :failed AND #at < :retry) OR (#status <> :failed AND #at < :stale))))",
+        condition_names={**AUDIO_STATE_NAMES, "#attempts": "audio_attempts"},
+        condition_values={":failed": AUDIO_FAILED, ":stale": now - config.AUDIO_JOB_STALE_IN_SEC,
+                          ":retry": now - retry_backoff(attempts), ":max_attempts": config.AUDIO_MAX_ATTEMPTS})
+    if queued is None:
+        return False
+    jobs.enqueue("audio", id, {"text": text})
+    return True
+
+
+# Handler of the audio jobs. The job claims the article by moving it to running, so a duplicate delivery skips it
+def audio_job(id, payload):
+    table = db.get_summary_table()
+    now = int(time.time())
+    claimed = table.update(
+        id, {"audio_status": AUDIO_RUNNING, "audio_status_at": now},
+        condition="attribute_not_exists(audio_summary_url) AND "
+                  "(#status IN (:queued, :failed) OR (#status = :running AND #at < :stale))",
+        condition_names=AUDIO_STATE_NAMES,
+        condition_values={":queued": AUDIO_QUEUED, ":failed": AUDIO_FAILED, ":running": AUDIO_RUNNING,
+                          ":stale": now - config.AUDIO_JOB_STALE_IN_SEC})
+    if claimed is None:
+        item = table.get(id, consistent_read=True) or {}
+        if item.get("audio_summary_url") or item.get("audio_status") == AUDIO_DONE:
+            metrics.incr("jobs.audio.duplicate")
+            return
+        # Still running elsewhere. Failing lets SQS deliver it again later, in case that run dies
+        raise RuntimeError(f"Audio of {id} is being generated by another job")
+
+    text = payload.get("text") or (table.get(id, consistent_read=True) or {}).get("text_summary")
+    try:
+        audio_file_url = text_to_audio_polly(id, text)
+    except Exception:
+        table.update(id, {"audio_status": AUDIO_FAILED, "audio_status_at": int(time.time())})
+        raise
+    table.update(id, {"audio_summary_url": audio_file_url, "audio_status": AUDIO_DONE, "audio_status_at": int(time.time())})
+
+
+jobs.register("audio", audio_job)
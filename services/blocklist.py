@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+import time
+from urllib.parse import unquote
+
+from lib import aws, log, metrics
+import config
+
+logger = log.setup_logger()
+
+# Matcher for the url blocklist. The patterns are regexes searched in the url, like config.BLACKLIST_URLS.
+# Patterns starting with a host (e.g. google\.com/search) are indexed by that host, and only run for urls that
+# contain the host or one of its subdomains, anywhere: as the host of the url, or e.g. in a redirect parameter
+# (?to=https://youtube.com/...), percent-encoded or not. All the patterns of a host are compiled into one alternation.
+# The other patterns, and those with a top-level | (each side may name another host) or with unescaped dots in
+# the host, are compiled into one alternation that runs for every url.
+# Unlike the plain search of match_regex_list, the host of an indexed pattern has to start a domain label of the url:
+# youtube\.com/ matches youtube.com/ and m.youtube.com/, but not notyoutube.com/.
+
+HOST_PREFIX = re.compile(r"^((?:[a-z0-9-]+\\\.)+[a-z]{2,})(?=$|/|:|\()", re.IGNORECASE)
+# Scheme and www prefixes that may come before the host, e.g. ^https?://(www\.)?example\.com/
+OPTIONAL_PREFIX = re.compile(r"^\^?(?:https\??:(?:\\?/){2})?(?:\((?:\?:)?www\\?\.\)\?)?", re.IGNORECASE)
+# Domains in a url, e.g. www.youtube.com in the host or in a query parameter
+DOMAIN = re.compile(r"[a-z0-9-]+(?:\.[a-z0-9-]+)+")
+
+
+# Whether the pattern is an alternation at its top level, e.g. example\.com/a|other\.org/b. Unbalanced parentheses
+# count as one too, so that the pattern is never indexed
+def has_top_level_alternation(pattern):
+    depth, in_class, escaped = 0, False, False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth < 0:
+                return True
+        elif char == "|" and depth == 0:
+            return True
+    return depth != 0
+
+
+# The host a pattern is anchored on, None if it doesn't start with one or can't be indexed by it
+def pattern_host(pattern):
+    if has_top_level_alternation(pattern):
+        return None
+    match = HOST_PREFIX.match(pattern[OPTIONAL_PREFIX.match(pattern).end():])
+    if not match:
+        return None
+    return match.group(1).replace("\\.", ".").lower()
+
+
+# The domains found in the url, and all their parent domains, e.g. www.google.com, google.com, com
+def url_hosts(url):
+    url = url.lower()
+    hosts = set()
+    for text in {url, unquote(url)}:
+        for domain in DOMAIN.findall(text):
+            labels = domain.split(".")
+            hosts.update(".".join(labels[i:]) for i in range(len(labels)))
+    return hosts
+
+
+def compile_patterns(patterns):
+    if not patterns:
+        return []
+    try:
+        return [re.compile("|".join(f"(?:{pattern})" for pattern in patterns))]
+    except re.error:
+        # e.g. the same group name in two patterns. Compile them one by one, dropping the invalid ones
+        compiled = []
+        for pattern in patterns:
+            try:
+                compiled.append(re.compile(pattern))
+            except re.error as e:
+                logger.error(f"Invalid blocklist pattern {pattern}: {e}")
+        return compiled
+
+
+class BlocklistMatcher(object):
+    def __init__(self, patterns):
+        by_host = {}
+        generic = []
+        for pattern in dict.fromkeys(patterns):
+            host = pattern_host(pattern)
+            if host:
+                by_host.setdefault(host, []).append(pattern)
+            else:
+                generic.append(pattern)
+        self.size = len(by_host) + len(generic)
+        self._by_host = {host: compile_patterns(host_patterns) for host, host_patterns in by_host.items()}
+        self._generic = compile_patterns(generic)
+
+    def matches(self, url):
+        for host in url_hosts(url):
+            for regex in self._by_host.get(host, ()):
+                if regex.search(url):
+                    return True
+        return any(regex.search(url) for regex in self._generic)
+
+
+# Blocklist of config.BLACKLIST_URLS plus the patterns of config.BLOCKLIST_SOURCE (a file path or an s3:// url,
+# one pattern per line, # for comments). The source is checked for changes every BLOCKLIST_RELOAD_INTERVAL_IN_SEC,
+# and reloaded without a redeploy. On errors, the last loaded patterns are kept.
+class ReloadingBlocklist(object):
+    def __init__(self, base_patterns, source=None, reload_interval=60):
+        self.base_patterns = list(base_patterns)
+        self.source = source
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0
+        self._matcher = BlocklistMatcher(self.base_patterns)
+
+    def matcher(self):
+        if self.source and time.monotonic() - self._checked_at >= self.reload_interval:
+            with self._lock:
+                if time.monotonic() - self._checked_at >= self.reload_interval:
+                    self._checked_at = time.monotonic()
+                    self._reload()
+        return self._matcher
+
+    def matches(self, url):
+        return self.matcher().matches(url)
+
+    def _reload(self):
+        try:
+            version = self._source_version()
+            if version == self._version:
+                return
+            patterns = [line.strip() for line in self._read_source().splitlines()]
+            patterns = [pattern for pattern in patterns if pattern and not pattern.startswith("#")]
+            with metrics.timed("blocklist.compile"):
+                self._matcher = BlocklistMatcher(self.base_patterns + patterns)
+            self._version = version
+            metrics.incr("blocklist.reload")
+            logger.info(f"Blocklist reloaded from {self.source}, {len(patterns)} patterns")
+        except Exception as e:
+            metrics.incr("blocklist.reload_failure")
+            logger.error(f"Error reloading the blocklist from {self.source}: {e}")
+
+    def _source_version(self):
+        if self.source.startswith("s3://"):
+            bucket_name, key = self.source[5:].split("/", 1)
+            return aws.get_client("s3").head_object(Bucket=bucket_name, Key=key)["ETag"]
+        return os.stat(self.source).st_mtime_ns
+
+    def _read_source(self):
+        if self.source.startswith("s3://"):
+            bucket_name, key = self.source[5:].split("/", 1)
+            return aws.get_client("s3").get_object(Bucket=bucket_name, Key=key)["Body"].read().decode("utf-8")
+        with open(self.source, "r") as f:
+            return f.read()
+
+
+_BLOCKLIST = None
+_BLOCKLIST_LOCK = threading.Lock()
+
+
+def get_blocklist():
+    global _BLOCKLIST
+    if _BLOCKLIST is None:
+        with _BLOCKLIST_LOCK:
+            if _BLOCKLIST is None:
+                _BLOCKLIST = ReloadingBlocklist(config.BLACKLIST_URLS, config.BLOCKLIST_SOURCE, config.BLOCKLIST_RELOAD_INTERVAL_IN_SEC)
+    return _BLOCKLIST
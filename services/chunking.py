@@ -0,0 +1,74 @@
+import re
+import threading
+
+# tiktoken is optional. Without it, tokens are estimated from the text length
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+PARAGRAPH_SPLIT = re.compile(r"\n\s*\n|\n")
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if tiktoken is None:
+        # Roughly 4 characters or 3/4 of a word per token in English text
+        return max(len(text) // 4, len(text.split()) * 4 // 3)
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+def _encoding(model):
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(model)
+            if encoding is None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+                _encodings[model] = encoding
+    return encoding
+
+
+# Splits the text in chunks of at most max_tokens, on paragraph boundaries when possible,
+# then on sentence boundaries, and on words only for sentences that are longer than a chunk.
+# count measures a piece of text, count_tokens by default. len splits on characters instead
+def split_text(text, max_tokens, model="gpt-3.5-turbo", count=None):
+    count = count or (lambda piece: count_tokens(piece, model))
+    chunks = []
+    current, current_tokens = [], 0
+    for piece, tokens in _pieces(text, max_tokens, count):
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _pieces(text, max_tokens, count):
+    for paragraph in PARAGRAPH_SPLIT.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = count(paragraph)
+        if tokens <= max_tokens:
+            yield paragraph, tokens
+            continue
+        for sentence in SENTENCE_SPLIT.split(paragraph):
+            tokens = count(sentence)
+            if tokens <= max_tokens:
+                yield sentence, tokens
+                continue
+            words = sentence.split()
+            step = max(1, len(words) * max_tokens // tokens)
+            for i in range(0, len(words), step):
+                part = " ".join(words[i:i + step])
+                yield part, count(part)
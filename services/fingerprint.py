@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import itertools
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import db, log, metrics
+from services import transcripts
+import config
+
+logger = log.setup_logger()
+
+# Near-duplicate detection of transcripts, so that the same story syndicated on several sites
+# (or reached through AMP/mobile urls) reuses the summary that already exists.
+#
+# Each transcript gets a 64 bit SimHash of its word shingles. Similar texts have SimHashes that differ in a few bits.
+# The index uses permuted tables (Manku et al., "Detecting near-duplicates for web crawling"): the SimHash is split
+# in k + 3 blocks, for k = NEAR_DUP_MAX_DISTANCE. Two SimHashes at most k bits apart differ in at most k blocks, so
+# they are equal on at least 3 of them. There is one table per choice of 3 blocks (20 for k = 3), and the key of a
+# table is the value of its 3 blocks, about 32 bits wide, so that unrelated articles rarely share a key.
+# Each "simhash#<table>-<key>" record keeps "<id>:<simhash>" entries, so that the candidates are ranked by their
+# distance before any article is read. Records are capped at NEAR_DUP_BAND_MAX_IDS entries.
+
+SIMHASH_BITS = 64
+KEY_BLOCKS = 3
+SHINGLE_SIZE = 3
+MIN_SHINGLES = 50  # Too short to fingerprint reliably
+MAX_CANDIDATES = 20
+
+_index_pool = ThreadPoolExecutor(max_workers=config.NEAR_DUP_INDEX_WORKERS, thread_name_prefix="simhash-index")
+
+# Fields of an existing article that are reused by its near-duplicates
+SUMMARY_FIELDS = ["text_summary", "summary_bullets", "time_saved", "depth", "tone", "sentiment", "tweet", "key_topics", "audio_summary_url"]
+
+
+# None for texts with fewer than min_shingles distinct shingles
+def simhash(text, min_shingles=MIN_SHINGLES):
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    if len(shingles) < min_shingles:
+        return None
+
+    # Count the set bits of every position, with strided slices over the concatenated binary strings of the shingle hashes
+    bits = "".join(format(int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big"), "064b") for s in shingles)
+    threshold = len(shingles) / 2
+    fingerprint = 0
+    for position in range(SIMHASH_BITS):
+        fingerprint = (fingerprint << 1) | (bits[position::SIMHASH_BITS].count("1") > threshold)
+    return fingerprint
+
+
+def to_hex(fingerprint):
+    return format(fingerprint, "016x")
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+# (offset, width) of the blocks of a SimHash, the remainder spread over the first ones
+@functools.lru_cache(maxsize=None)
+def blocks(max_distance):
+    count = max_distance + KEY_BLOCKS
+    spans, offset = [], 0
+    for block in range(count):
+        width = SIMHASH_BITS // count + (block < SIMHASH_BITS % count)
+        spans.append((offset, width))
+        offset += width
+    return spans
+
+
+# Keys of the tables of the index. Two fingerprints at most max_distance bits apart share at least one key
+def band_keys(fingerprint, max_distance=None):
+    spans = blocks(config.NEAR_DUP_MAX_DISTANCE if max_distance is None else max_distance)
+    keys = []
+    for table, chosen in enumerate(itertools.combinations(spans, KEY_BLOCKS)):
+        value = 0
+        for offset, width in chosen:
+            value = (value << width) | ((fingerprint >> offset) & ((1 << width) - 1))
+        keys.append(db.internal_key("simhash", f"{table}-{value:x}"))
+    return keys
+
+
+def index_entry(id, fingerprint):
+    return f"{id}:{to_hex(fingerprint)}"
+
+
+# Candidate ids within max_distance bits of the fingerprint, closest first, from the entries of the index records
+def rank_candidates(id, fingerprint, entries, max_distance):
+    distances = {}
+    for entry in entries:
+        candidate, _, candidate_hex = entry.rpartition(":")
+        if not candidate or candidate == id:
+            continue
+        distance = hamming(fingerprint, int(candidate_hex, 16))
+        if distance <= max_distance and distance < distances.get(candidate, max_distance + 1):
+            distances[candidate] = distance
+    return sorted(distances, key=lambda candidate: (distances[candidate], candidate))
+
+
+# The same transcript summarized with different instructions or audio settings is a different article
+def variant(instructions, include_audio):
+    return hashlib.sha256(f"{instructions}|{include_audio}".encode()).hexdigest()[:16]
+
+
+# Returns the closest existing article with a summary, within NEAR_DUP_MAX_DISTANCE bits. None if there is none
+def find_similar(id, fingerprint, article_variant):
+    if fingerprint is None:
+        return None
+
+    table = db.get_summary_table()
+    start = time.perf_counter()
+    records = table.batch_get(band_keys(fingerprint))
+    entries = [entry for record in records.values() for entry in record.get("ids", [])]
+    candidates = rank_candidates(id, fingerprint, entries, config.NEAR_DUP_MAX_DISTANCE)[:MAX_CANDIDATES]
+
+    best = None
+    items = table.batch_get(candidates) if candidates else {}
+    for candidate in candidates:
+        item = items.get(candidate)
+        if item and item.get("text_summary") and item.get("variant") == article_variant:
+            best = item
+            break
+
+    metrics.timing("dedupe.lookup", time.perf_counter() - start)
+    metrics.incr("dedupe.lookup")
+    if best:
+        metrics.incr("dedupe.hit")
+        logger.info(f"article {id} is a near-duplicate of {best['id']} ({hamming(fingerprint, int(best['simhash'], 16))} bits apart)")
+    return best
+
+
+# Stores the summary of the similar article under the id of this one, and returns the new item
+def reuse_summary(item, similar):
+    fields = {field: similar[field] for field in SUMMARY_FIELDS if field in similar}
+    fields["duplicate_of"] = similar["id"]
+    fields["revision"] = item.get("revision", 0) + 1  # see util.response_blob
+    item = {**item, **fields}
+    db.get_summary_table().update(item["id"], {k: v for k, v in transcripts.stored_item(item).items() if k != "id"})
+    return item
+
+
+# Adds the article to every table of the index, concurrently. A full record is left as is: its key is already
+# shared by NEAR_DUP_BAND_MAX_IDS articles, and the other tables still index this one
+def index_article(id, fingerprint):
+    if fingerprint is None:
+        return
+    table = db.get_summary_table()
+    entry = index_entry(id, fingerprint)
+    added = list(_index_pool.map(lambda key: table.add_to_set(key, "ids", [entry], max_size=config.NEAR_DUP_BAND_MAX_IDS),
+                                 band_keys(fingerprint)))
+    if not all(added):
+        metrics.incr("dedupe.band_full", added.count(False))
+
+
+# Indexes the articles that have a SimHash, e.g. after a change of NEAR_DUP_MAX_DISTANCE or of the index layout.
+# Returns the number of articles indexed
+def reindex(segments=1, max_read_units=None):
+    count = 0
+    projection = ["simhash", "text_summary"]
+    for item in db.get_summary_table().list(segments=segments, projection=projection, max_read_units=max_read_units):
+        if item.get("simhash") and item.get("text_summary"):
+            index_article(item["id"], int(item["simhash"], 16))
+            count += 1
+    return count
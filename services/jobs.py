@@ -0,0 +1,98 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import aws, log, metrics
+import config
+
+logger = log.setup_logger()
+
+# Background jobs. A job is a kind, the id of the article it works on, and a JSON payload.
+# Handlers are registered per kind, and must be idempotent: a job may run more than once (SQS delivers at least once,
+# and a request may enqueue a job that is already queued). Two backends, picked by config.JOB_QUEUE_BACKEND:
+#  - inprocess: a thread pool in this process. For gunicorn and local runs
+#  - sqs: an SQS queue, consumed by the lambda through app.handler. JOB_QUEUE_ENDPOINT_URL points it
+#    to a local SQS-compatible service (e.g. ElasticMQ) when needed
+_handlers = {}
+
+
+def register(kind, handler):
+    _handlers[kind] = handler
+
+
+def run(kind, id, payload):
+    handler = _handlers.get(kind)
+    if handler is None:
+        raise ValueError(f"No handler for job {kind}")
+    with metrics.timed(f"jobs.{kind}"):
+        handler(id, payload)
+
+
+class InProcessQueue(object):
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def enqueue(self, kind, id, payload=None):
+        metrics.incr(f"jobs.{kind}.enqueued")
+        return self._pool.submit(self._run, kind, id, payload or {})
+
+    def _run(self, kind, id, payload):
+        try:
+            run(kind, id, payload)
+        except Exception as e:
+            metrics.incr(f"jobs.{kind}.failure")
+            logger.error(f"Job {kind} {id} failed: {e}")
+
+
+class SQSQueue(object):
+    def __init__(self, queue_url, endpoint_url=None):
+        self.queue_url = queue_url
+        self.endpoint_url = endpoint_url
+
+    def enqueue(self, kind, id, payload=None):
+        kwargs = {"endpoint_url": self.endpoint_url} if self.endpoint_url else {}
+        aws.get_client("sqs", **kwargs).send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps({"kind": kind, "id": id, "payload": payload or {}}),
+        )
+        metrics.incr(f"jobs.{kind}.enqueued")
+
+
+# Runs the jobs of an SQS event. The failed messages are reported back as batch item failures,
+# so that SQS retries only them (the event source needs ReportBatchItemFailures)
+def handle_sqs_event(event):
+    failures = []
+    for record in event["Records"]:
+        try:
+            message = json.loads(record["body"])
+            run(message["kind"], message["id"], message.get("payload") or {})
+        except Exception as e:
+            metrics.incr("jobs.failure")
+            logger.error(f"Job of message {record.get('messageId')} failed: {e}")
+            failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": failures}
+
+
+def is_sqs_event(event):
+    records = event.get("Records") if isinstance(event, dict) else None
+    return bool(records) and records[0].get("eventSource") == "aws:sqs"
+
+
+_QUEUE = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_queue():
+    global _QUEUE
+    if _QUEUE is None:
+        with _QUEUE_LOCK:
+            if _QUEUE is None:
+                if config.JOB_QUEUE_BACKEND == "sqs":
+                    _QUEUE = SQSQueue(config.JOB_QUEUE_URL, config.JOB_QUEUE_ENDPOINT_URL)
+                else:
+                    _QUEUE = InProcessQueue(config.JOB_WORKERS)
+    return _QUEUE
+
+
+def enqueue(kind, id, payload=None):
+    return get_queue().enqueue(kind, id, payload)
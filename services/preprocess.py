@@ -0,0 +1,83 @@
+import re
+
+from lib import log, metrics
+from services import chunking, fingerprint
+
+logger = log.setup_logger()
+
+# Normalisation of the transcripts sent by the browser extension, before they go to GPT.
+# Collapses whitespace, drops boilerplate lines (nav, footer, cookie banners) and exact or near-duplicate paragraphs.
+# Runs in one pass over the paragraphs: exact duplicates are found through a set of normalised keys,
+# near-duplicates through the SimHash bands of the paragraphs seen so far.
+
+WHITESPACE = re.compile(r"\s+")
+NON_WORD = re.compile(r"\W+")
+LINE_SPLIT = re.compile(r"\n")
+
+# Lines shorter than this are checked against BOILERPLATE. Longer ones are content
+BOILERPLATE_MAX_LENGTH = 80
+# Whole lines made of a known phrase, with trailing punctuation or arrows ("Read more »"). A sentence that only starts
+# with one of the words ("Recommended doses...", "Newsletter sales...") is content
+YEAR = r"\d{4}(\s?[-–]\s?\d{4})?"
+BOILERPLATE = re.compile(
+    r"^(advertisement|sponsored( content)?|skip to (main )?content|(main )?menu|home|search|sign (in|up|out)|log ?(in|out)|"
+    r"register|subscribe( now| today)?|subscribe to (our|the) (newsletters?|channel|podcast)|"
+    r"((sign up|subscribe) (for|to) )?(our |the )?(free |daily |weekly )?newsletters?|"
+    r"share( this( article| story)?)?( on \w+)?|(follow|like) us( on \w+( and \w+)?)?|print|email|comments?|"
+    r"read more( (stories|articles|news|here))?|related( (articles|stories|posts|content|topics))?|"
+    r"recommended( for you| (articles|stories|reading|videos))?|(accept|reject)( all)? cookies|"
+    r"cookie (policy|settings|preferences)|manage (cookies|cookie settings)|privacy policy|"
+    r"terms (of (use|service)|and conditions)|all rights reserved( " + YEAR + r")?|"
+    r"(©|copyright( ©)?|\(c\)) " + YEAR + r"( [\w&.,'-]+){0,6}?(\W+all rights reserved)?|"
+    r"back to top|loading\W*|advertise with us|contact us|about us)\W*$",
+    re.IGNORECASE,
+)
+
+# Paragraphs need this many shingles to be compared for near-duplicates
+NEAR_DUP_MIN_SHINGLES = 12
+NEAR_DUP_MAX_DISTANCE = 3
+
+
+def normalize(text):
+    paragraphs = []
+    seen_keys = set()
+    seen_bands = {}
+    stats = {"boilerplate": 0, "duplicates": 0, "near_duplicates": 0}
+
+    for line in LINE_SPLIT.split(text):
+        paragraph = WHITESPACE.sub(" ", line).strip()
+        if not paragraph:
+            continue
+        if len(paragraph) < BOILERPLATE_MAX_LENGTH and BOILERPLATE.match(paragraph):
+            stats["boilerplate"] += 1
+            continue
+
+        key = NON_WORD.sub("", paragraph.lower())
+        if key in seen_keys:
+            stats["duplicates"] += 1
+            continue
+        seen_keys.add(key)
+
+        paragraph_fingerprint = fingerprint.simhash(paragraph, NEAR_DUP_MIN_SHINGLES)
+        if paragraph_fingerprint is not None:
+            bands = fingerprint.band_keys(paragraph_fingerprint, NEAR_DUP_MAX_DISTANCE)
+            if any(fingerprint.hamming(paragraph_fingerprint, other) <= NEAR_DUP_MAX_DISTANCE
+                   for band in bands for other in seen_bands.get(band, ())):
+                stats["near_duplicates"] += 1
+                continue
+            for band in bands:
+                seen_bands.setdefault(band, []).append(paragraph_fingerprint)
+
+        paragraphs.append(paragraph)
+
+    return "\n\n".join(paragraphs), stats
+
+
+# Normalised transcript for the GPT calls. Reports the tokens saved on every request
+def prepare(transcript):
+    cleaned, stats = normalize(transcript)
+    tokens_saved = chunking.count_tokens(transcript) - chunking.count_tokens(cleaned)
+    metrics.incr("preprocess.requests")
+    metrics.incr("preprocess.tokens_saved", tokens_saved)
+    logger.info(f"Transcript normalised, {tokens_saved} tokens saved per GPT call {stats}")
+    return cleaned
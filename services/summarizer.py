@@ -1,103 +1,323 @@
 import time
 import json
+import hashlib
+import threading
+import uuid
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # from transformers import pipeline
 
-from openai import OpenAI
-
 from services import audio_processor
+from services import chunking
+from services import fingerprint
+from services import jobs
+from services import preprocess
+from services import transcripts
 from services import util
-from lib import db, log
+from lib import db, log, metrics, profiling
+from lib.cache import TTLCache
+from lib.singleflight import LeaseRenewer, SingleFlight
 import config
 
 logger = log.setup_logger()
 
-client = OpenAI(
-    # This is the default and can be omitted
-    api_key=util.get_secret("OPENAI_API_KEY")
-)
+# The OpenAI client is created on first use, not at import: its key comes from Secrets Manager, in another region,
+# and routes like / or warming events never need it
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                with profiling.timed_init("openai"):
+                    from openai import OpenAI
+                    _client = OpenAI(api_key=util.get_secret("OPENAI_API_KEY"))
+    return _client
+
+# Shared pool for the fan-out mode of process_in_stream. Threads are created lazily by the executor
+_fan_out_pool = ThreadPoolExecutor(max_workers=config.FAN_OUT_WORKERS, thread_name_prefix="fan-out")
+
+# Articles being summarized by this process
+_in_flight = SingleFlight()
+
+# Long-document mode. Chunks are summarized on their own pool, as the callers may already run on the fan-out pool
+_chunk_pool = ThreadPoolExecutor(max_workers=config.LONG_DOC_WORKERS, thread_name_prefix="chunk")
+_chunk_summaries = TTLCache("chunk_summary", config.LONG_DOC_CACHE_MAX_ITEMS, config.LONG_DOC_CACHE_TTL_IN_SEC)
+_chunks_in_flight = SingleFlight()
+
+SUMMARY_QUEUED = "queued"
+SUMMARY_DONE = "done"
+SUMMARY_FAILED = "failed"
+
+# Order in which the step results are merged into the item. Keeps the DB record independent of completion order
+STEP_ORDER = ["summary", "inference", "audio"]
 
-# Convenience method to remove unnecessary fields before responding to client
+# Fields of the item that are never sent to the client: stored transcript, fingerprint, revision and job bookkeeping
+NOT_SENT = transcripts.STORED_FIELDS + ("response_blob", "simhash", "variant", "revision", "summary_status",
+                                       "summary_status_at", "audio_status_at", "audio_attempts", "audio_url_presigned")
+
+# Convenience method to remove unnecessary fields before responding to client.
+# Works on a copy, so that the item being persisted keeps its transcript.
 def strip_for_transport(item):
-    if item and item["transcript"]:
+    if not item:
+        return item
+    has_transcript = any(item.get(field) for field in transcripts.FIELDS)
+    item = {k: v for k, v in item.items() if k not in NOT_SENT}
+    if has_transcript:
         item["transcript"] = None
         item["audio_summary_url"] = None
     return item
 
-def process_in_stream(user_id, id, clean_url, transcript, instructions, include_audio, item):
+# Single-flight wrapper of process_in_stream. Only one request summarizes an article at a time:
+#  - within the process, later requests wait for the in-flight one and respond with its result
+#  - across containers, an "in progress" lease record in the summary table makes the others poll for the result.
+#    A lease that expired (e.g. the container died) or was released without a summary is taken over by a poller.
+#    The holder renews its lease while it works. Waits last SUMMARY_WAIT_IN_SEC at most, below the lambda timeout
+def process_once(user_id, id, clean_url, transcript, instructions, include_audio, item, fan_out=None, stream_tokens=None):
+    leader_done = _in_flight.acquire(id)
+    if leader_done is not None:
+        logger.info(f"article {id} is being summarized by this process. Waiting for it")
+        leader_done.wait(config.SUMMARY_WAIT_IN_SEC)
+        existing = db.get_summary_table().get(id)
+        if existing and existing.get("text_summary"):
+            yield util.stream_event(util.build_response(id, existing), stream_tokens)
+            return
+
+    table = db.get_summary_table()
+    owner = str(uuid.uuid4())
+    try:
+        deadline = time.time() + config.SUMMARY_WAIT_IN_SEC
+        while not table.acquire_lease(id, owner, config.LEASE_TTL_IN_SEC):
+            # Another container holds the lease. Poll for its result
+            logger.info(f"article {id} is being summarized elsewhere. Polling")
+            time.sleep(config.SLEEP_TIME_IN_SEC)
+            existing = table.get(id, consistent_read=True)
+            if existing and existing.get("text_summary"):
+                yield util.stream_event(util.build_response(id, existing), stream_tokens)
+                return
+            if time.time() > deadline:
+                yield util.stream_event({"message": "Error, article could not be summarized"}, stream_tokens, "error")
+                return
+
+        renewer = LeaseRenewer(table, id, owner, config.LEASE_TTL_IN_SEC, config.LEASE_RENEW_INTERVAL_IN_SEC).start()
+        try:
+            # The holder of the lease may have finished between our first read, possibly cached, and the acquire
+            existing = table.get(id, consistent_read=True)
+            if existing and existing.get("text_summary"):
+                yield util.stream_event(util.build_response(id, existing), stream_tokens)
+                return
+
+            # The same content may already be summarized under another url
+            prompt = preprocess.prepare(transcript)
+            transcript_fingerprint = fingerprint.simhash(prompt)
+            article_variant = fingerprint.variant(instructions, include_audio)
+            similar = fingerprint.find_similar(id, transcript_fingerprint, article_variant)
+            if similar:
+                item = fingerprint.reuse_summary(item or new_item(user_id, id, clean_url, transcript), similar)
+                yield util.stream_event(util.build_response(id, item), stream_tokens)
+                return
+
+            yield from process_in_stream(user_id, id, clean_url, transcript, instructions, include_audio, item, fan_out, stream_tokens,
+                                         {"simhash": fingerprint.to_hex(transcript_fingerprint) if transcript_fingerprint is not None else None,
+                                          "variant": article_variant}, prompt)
+            summarized = table.get(id)
+            if summarized and summarized.get("text_summary"):
+                fingerprint.index_article(id, transcript_fingerprint)
+        finally:
+            renewer.stop()
+            table.release_lease(id, owner)
+    finally:
+        if leader_done is None:
+            _in_flight.release(id)
+
+
+# extra_fields are persisted along with the new item, e.g. its fingerprint.
+# prompt is the normalised transcript sent to GPT, when the caller already has it
+def process_in_stream(user_id, id, clean_url, transcript, instructions, include_audio, item, fan_out=None, stream_tokens=None, extra_fields=None, prompt=None):
+    prompt = prompt or preprocess.prepare(transcript)
+    persisted = dict(item) if item else {}
     if not item:
-        item = {
-            "user_id": user_id or config.DEFAULT_USERNAME,
-            "id": id,
-            "url": clean_url,
-            "transcript": transcript,
-            "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        }
+        item = new_item(user_id, id, clean_url, transcript)
+    item.update({k: v for k, v in (extra_fields or {}).items() if v is not None})
+
+    if fan_out is None:
+        fan_out = config.STREAM_FAN_OUT
+    if stream_tokens is None:
+        stream_tokens = config.STREAM_TOKENS
+    # Token streaming is built on the fan-out flow, so that inference and audio are not held back by the summary
+    if fan_out or stream_tokens:
+        yield from process_fan_out(id, prompt, include_audio, item, persisted, stream_tokens)
+        return
 
     # Make the GPT call to summarize the transcript and yield immediately
     summary_instructions = build_instructions("summary")
-    summary_para = gpt(transcript, summary_instructions)
+    summary_para = gpt(prompt, summary_instructions)
     if summary_para:
         item["text_summary"] = summary_para
-        db.get_summary_table().addOrUpdate(item)
-        yield json.dumps(strip_for_transport(item)) + "\n\n";
+        save_changes(item, persisted)
+        yield util.json_dumps(strip_for_transport(item)) + "\n\n";
 
     # Make the GPT call to infer other aspects and yield immediately
     inference_instructions = build_instructions("inference")
-    inference = gpt(transcript, inference_instructions)
+    inference = gpt(prompt, inference_instructions)
     try:
-        inference_json = json.loads(inference)
+        inference_json = parse_inference(inference)
         item.update(inference_json)
-        db.get_summary_table().addOrUpdate(item)
-        yield json.dumps(strip_for_transport(item)) + "\n\n";
+        save_changes(item, persisted)
+        yield util.json_dumps(strip_for_transport(item)) + "\n\n";
     except json.JSONDecodeError:
         print("Error: Invalid JSON response from OpenAI API.")
     
     # Create an audio summary and yield
-    if include_audio and summary_para:
-        audio_file_url, audio_file_local = audio_processor.text_to_audio_polly(id, summary_para)
+    if include_audio and summary_para and config.AUDIO_IN_BACKGROUND:
+        yield util.json_dumps({**strip_for_transport(item), **queue_audio(id, summary_para)}) + "\n\n";
+    elif include_audio and summary_para:
+        audio_file_url = audio_processor.text_to_audio_polly(id, summary_para)
         item["audio_summary_url"] = audio_file_url
-        db.get_summary_table().addOrUpdate(item)
+        save_changes(item, persisted)
         audio_url_public = util.generate_audio_url_public(audio_file_url)
         if audio_url_public:
             item["audio_url"] = audio_url_public
-            yield json.dumps(strip_for_transport(item)) + "\n\n";
+            yield util.json_dumps(strip_for_transport(item)) + "\n\n";
+
+
+def new_item(user_id, id, clean_url, transcript):
+    return {
+        "user_id": user_id or config.DEFAULT_USERNAME,
+        "id": id,
+        "url": clean_url,
+        "transcript": transcript,
+        "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    }
+
+
+# Starts the summary and inference GPT calls at once, and the Polly synthesis as soon as the summary is ready.
+# Each result is yielded as soon as it finishes, but the item is always rebuilt in STEP_ORDER
+# so the DB record ends up the same as the serial flow.
+# With stream_tokens, the summary is streamed from OpenAI and every delta is forwarded as an SSE event.
+# The summary is still persisted only once, when the completion is over.
+# prompt is the normalised transcript
+def process_fan_out(id, prompt, include_audio, item, persisted, stream_tokens=False):
+    base = item
+    results = {}
+    extras = {}  # fields that go to the client, but are not persisted
+    futures = {}
+
+    def start(step, fn, *args):
+        futures[_fan_out_pool.submit(fn, *args)] = step
+
+    # Merges the output of a finished step, persists it and returns the event to send. None, when there is nothing to send
+    def complete(step, output):
+        result = step_result(step, output)
+        if result is None:
+            return None
+        results[step] = result
+
+        if step == "summary" and include_audio and config.AUDIO_IN_BACKGROUND:
+            extras.update(queue_audio(id, result["text_summary"]))
+        elif step == "summary" and include_audio:
+            start("audio", audio_processor.text_to_audio_polly, id, result["text_summary"])
+
+        merged = merge_results(base, results)
+        save_changes(merged, persisted)
+
+        if step == "audio":
+            audio_url_public = util.generate_audio_url_public(result["audio_summary_url"])
+            if not audio_url_public:
+                return None
+            extras["audio_url"] = audio_url_public
+        payload = {**strip_for_transport(merged), **extras}
+        if stream_tokens:
+            return util.sse_event(payload, "item")
+        return util.json_dumps(payload) + "\n\n"
+
+    def complete_done(done):
+        for future in sorted(done, key=lambda f: STEP_ORDER.index(futures[f])):
+            event = complete(futures.pop(future), future.result())
+            if event:
+                yield event
+
+    if stream_tokens:
+        start("inference", gpt, prompt, build_instructions("inference"))
+        parts = []
+        try:
+            for delta in gpt_stream(prompt, build_instructions("summary")):
+                parts.append(delta)
+                yield util.sse_event({"id": id, "delta": delta}, "summary_delta")
+                # Don't hold back the steps that finished while the summary is streaming
+                yield from complete_done([f for f in futures if f.done()])
+        except Exception as e:
+            # The deltas sent so far are not a summary, nothing of it is persisted. The inference still completes
+            logger.error(f"Error streaming the summary of {id}: {e}")
+            metrics.incr("stream_tokens.failure")
+            yield util.sse_event({"id": id, "message": "Error, article could not be summarized"}, "error")
+        else:
+            event = complete("summary", "".join(parts).strip())
+            if event:
+                yield event
+    else:
+        start("summary", gpt, prompt, build_instructions("summary"))
+        start("inference", gpt, prompt, build_instructions("inference"))
+
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        yield from complete_done(done)
+
+
+# Converts the raw output of a fan-out step into the fields it contributes to the item. None, when it contributes nothing
+def step_result(step, output):
+    if step == "summary":
+        return {"text_summary": output} if output else None
+    if step == "inference":
+        try:
+            return parse_inference(output)
+        except json.JSONDecodeError:
+            print("Error: Invalid JSON response from OpenAI API.")
+            return None
+    return {"audio_summary_url": output}
+
+
+# The inference JSON of GPT. Its numbers are parsed as Decimal, as DynamoDB doesn't take floats
+def parse_inference(output):
+    return json.loads(output, parse_float=Decimal)
+
+
+def merge_results(item, results):
+    merged = dict(item)
+    for step in STEP_ORDER:
+        if step in results:
+            merged.update(results[step])
+    return merged
 
 
 def text_summary(user_id, id, clean_url, transcript, item):
+    persisted = dict(item) if item else {}
     if not item:
-        item = {
-            "user_id": user_id or config.DEFAULT_USERNAME,
-            "id": id,
-            "url": clean_url,
-            "transcript": transcript,
-            "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        }
+        item = new_item(user_id, id, clean_url, transcript)
 
     # Make the GPT call to summarize the transcript
     summary_instructions = build_instructions("summary")
-    summary_para = gpt(transcript, summary_instructions)
+    summary_para = gpt(preprocess.prepare(transcript), summary_instructions)
     if summary_para:
         item["text_summary"] = summary_para
-        db.get_summary_table().addOrUpdate(item)
-        return json.dumps(strip_for_transport(item))
+        save_changes(item, persisted)
+        return util.json_dumps(strip_for_transport(item))
 
 
 def inference(user_id, id, clean_url, transcript, include_audio, item):
+    persisted = dict(item) if item else {}
     if not item:
-        item = {
-            "user_id": user_id or config.DEFAULT_USERNAME,
-            "id": id,
-            "url": clean_url,
-            "transcript": transcript,
-            "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        }
+        item = new_item(user_id, id, clean_url, transcript)
 
     # Make the GPT call to infer other aspects 
     inference_instructions = build_instructions("inference")
-    inference = gpt(transcript, inference_instructions)
+    inference = gpt(preprocess.prepare(transcript), inference_instructions)
     try:
-        inference_json = json.loads(inference)
+        inference_json = parse_inference(inference)
         # Adding the shortened URL to the tweet response from GPT
         inference_json["tweet"] = inference_json["tweet"] + " - " + util.shorten_url(clean_url)
         item.update(inference_json)
@@ -106,24 +326,140 @@ def inference(user_id, id, clean_url, transcript, include_audio, item):
     
     # Create an audio summary
     audio_file_url = None
-    if include_audio and item.get("text_summary"):
-        audio_file_url, audio_file_local = audio_processor.text_to_audio_polly(id, item["text_summary"])
+    audio_fields = {}
+    if include_audio and item.get("text_summary") and config.AUDIO_IN_BACKGROUND:
+        audio_fields = queue_audio(id, item["text_summary"])
+    elif include_audio and item.get("text_summary"):
+        audio_file_url = audio_processor.text_to_audio_polly(id, item["text_summary"])
         item["audio_summary_url"] = audio_file_url
 
-    db.get_summary_table().addOrUpdate(item)
+    save_changes(item, persisted)
 
     if audio_file_url:
         audio_url_public = util.generate_audio_url_public(audio_file_url)
         if audio_url_public:
             item["audio_url"] = audio_url_public
     
-    return json.dumps(strip_for_transport(item))
+    return util.json_dumps({**strip_for_transport(item), **audio_fields})
+
+# Queues the audio job of the article. Returns the fields that tell the client to poll GET /audio/<id> for the audio
+def queue_audio(id, text):
+    audio_processor.request_audio(id, text)
+    return {"audio_status": audio_processor.AUDIO_QUEUED}
+
+# Articles of the batch endpoint are summarized by background "summary" jobs. The request stores the new article
+# with its transcript, and summary_status / summary_status_at, so that an article is queued only once,
+# unless its job is older than SUMMARY_JOB_STALE_IN_SEC.
+# Returns (status, queued): the summary status of the article (queued, done or failed), and whether this call queued
+# its job. An article already queued, or summarized meanwhile, is reported as read from the table
+def request_summary(user_id, id, clean_url, transcript, instructions, include_audio):
+    table = db.get_summary_table()
+    now = int(time.time())
+    fields = {k: v for k, v in transcripts.stored_item(new_item(user_id, id, clean_url, transcript)).items() if k != "id"}
+    queued = table.update(
+        id, {**fields, "summary_status": SUMMARY_QUEUED, "summary_status_at": now},
+        condition="attribute_not_exists(text_summary) AND (attribute_not_exists(#status) OR #at < :stale)",
+        condition_names={"#status": "summary_status", "#at": "summary_status_at"},
+        condition_values={":stale": now - config.SUMMARY_JOB_STALE_IN_SEC})
+    if queued is None:
+        item = table.get(id, consistent_read=True) or {}
+        if item.get("text_summary"):
+            return SUMMARY_DONE, False
+        return item.get("summary_status", SUMMARY_FAILED), False
+    try:
+        jobs.enqueue("summary", id, {"instructions": instructions, "include_audio": include_audio})
+    except Exception as e:
+        logger.error(f"Error queuing the summary of {id}: {e}")
+        table.update(id, {"summary_status": SUMMARY_FAILED, "summary_status_at": int(time.time())})
+        return SUMMARY_FAILED, False
+    return SUMMARY_QUEUED, True
+
+
+# Handler of the summary jobs. process_once makes sure only one run summarizes the article at a time
+def summary_job(id, payload):
+    table = db.get_summary_table()
+    item = table.get(id, consistent_read=True)
+    if not item or item.get("text_summary"):
+        metrics.incr("jobs.summary.duplicate")
+        return
+    for _ in process_once(item["user_id"], id, item["url"], transcripts.load(item), payload.get("instructions"),
+                          payload.get("include_audio"), item, fan_out=False, stream_tokens=False):
+        pass
+    summarized = table.get(id, consistent_read=True)
+    if not summarized or not summarized.get("text_summary"):
+        table.update(id, {"summary_status": SUMMARY_FAILED, "summary_status_at": int(time.time())})
+        raise RuntimeError(f"Article {id} could not be summarized")
+    table.update(id, {"summary_status": SUMMARY_DONE, "summary_status_at": int(time.time())})
+
+
+jobs.register("summary", summary_job)
+
+# Persists only the fields of the item that differ from what is already persisted, in a single UpdateItem.
+# persisted is the item as last read or written, and is brought up to date.
+# The transcript is stored once, the first time, in the layout of services/transcripts.py
+def save_changes(item, persisted):
+    changed = {k: v for k, v in item.items() if k not in ("id", "transcript") and (k not in persisted or persisted[k] != v)}
+    if item.get("transcript") and not transcripts.is_stored(persisted):
+        changed.update(transcripts.store(item["transcript"]))
+    # A new revision invalidates the serialized responses of the article, see util.response_blob
+    if any(field in changed for field in util.RESPONSE_FIELDS):
+        changed["revision"] = persisted.get("revision", 0) + 1
+        item["revision"] = changed["revision"]
+    if changed:
+        db.get_summary_table().update(item["id"], changed)
+        persisted.update(changed)
+    return item
 
 def gpt(text, instructions):
-    return gpt_with_openai(text, instructions)
+    return gpt_with_openai(condense(text), instructions)
+
+# Long-document mode (map step of a map-reduce). A transcript longer than LONG_DOC_THRESHOLD_TOKENS is split
+# on paragraph/sentence boundaries, and the chunks are summarized concurrently. The final call (the reduce step)
+# then runs with the original instructions on the chunk summaries. Applied again if they are still too long.
+def condense(text, model="gpt-3.5-turbo"):
+    if not config.LONG_DOC_MODE or chunking.count_tokens(text, model) <= config.LONG_DOC_THRESHOLD_TOKENS:
+        return text
+    chunks = chunking.split_text(text, config.LONG_DOC_CHUNK_TOKENS, model)
+    logger.info(f"Long document, summarizing {len(chunks)} chunks")
+    summaries = list(_chunk_pool.map(lambda chunk: summarize_chunk(chunk, model), chunks))
+    condensed = "\n\n".join(summaries)
+    if len(condensed) >= len(text):
+        # The chunk summaries didn't make the text any shorter, keep the text
+        return text
+    if len(chunks) == 1:
+        return condensed
+    return condense(condensed, model)
+
+# Summary of one chunk. Cached in process and in the summary table, so that a retried request doesn't redo the chunks
+# that already succeeded. The summary and inference calls condense the same transcript, so a chunk is summarized only once
+def summarize_chunk(chunk, model="gpt-3.5-turbo"):
+    key = hashlib.sha256(f"{model}|{CHUNK_INSTRUCTIONS}|{chunk}".encode()).hexdigest()
+    summary = _chunk_summaries.get(key)
+    if summary:
+        return summary
+
+    leader_done = _chunks_in_flight.acquire(key)
+    if leader_done is not None:
+        leader_done.wait(config.MAX_WAIT_TIME)
+        summary = _chunk_summaries.get(key)
+        if summary:
+            return summary
+    try:
+        table = db.get_summary_table()
+        record = table.get(db.internal_key("chunk", key))
+        if record and record.get("summary") and not db.is_expired(record):
+            summary = record["summary"]
+        else:
+            summary = gpt_with_openai(chunk, CHUNK_INSTRUCTIONS, model=model, max_tokens=config.LONG_DOC_CHUNK_SUMMARY_TOKENS)
+            table.update(db.internal_key("chunk", key), {"summary": summary, "expires_at": int(time.time()) + config.LONG_DOC_CACHE_TTL_IN_SEC})
+        _chunk_summaries.set(key, summary)
+        return summary
+    finally:
+        if leader_done is None:
+            _chunks_in_flight.release(key)
 
 def gpt_with_openai(text, instructions, model="gpt-3.5-turbo", temperature=0.5, max_tokens=4000):
-    response = client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         messages=[
             {"role": "system", "content": instructions},
             {"role": "user", "content": f"{text}"}
@@ -140,6 +476,33 @@ def gpt_with_openai(text, instructions, model="gpt-3.5-turbo", temperature=0.5,
     print(f"Summary :: {summary}")
     return summary
 
+# Same as gpt, but yields the content deltas as they arrive from the chat completions streaming API
+def gpt_stream(text, instructions, model="gpt-3.5-turbo", temperature=0.5, max_tokens=4000):
+    stream = get_openai_client().chat.completions.create(
+        messages=[
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": f"{condense(text, model)}"}
+        ],
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,  # Adjust for more deterministic output
+        top_p=1,
+        frequency_penalty=0.0,
+        presence_penalty=0.0,
+        stream=True
+    )
+
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+CHUNK_INSTRUCTIONS = """You are given one part of a longer article. Summarize this part accurately and concisely, 
+    keeping the key individuals, firms, or entities, important concepts, and significant data points. 
+    Don't add an introduction or a conclusion, as the summaries of all the parts will be combined."""
+
 def build_instructions(type):
     inference_instructions = f"""
     You are an AI assistant specializing in text analysis. Study the article thoroughly and provide the following information in a JSON format:
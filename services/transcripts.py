@@ -0,0 +1,94 @@
+import hashlib
+import io
+import zlib
+
+import config
+from lib import aws, db, log, metrics
+from services import util
+
+logger = log.setup_logger()
+
+# Storage of the transcripts, out of the summary items. The items are read on every request, for their summaries,
+# and the transcript is only needed to summarize the article again.
+#  - A transcript up to TRANSCRIPT_INLINE_MAX_BYTES once compressed is kept in the item, zlib compressed, as transcript_z
+#  - A larger one goes to S3, under transcripts/<sha256 of the text>, and the item keeps its url as transcript_ref.
+#    The same text is uploaded once
+# Items written before have a plain transcript attribute. It is still read, until migrate() moves it
+STORED_FIELDS = ("transcript_z", "transcript_ref")
+FIELDS = ("transcript",) + STORED_FIELDS
+
+
+def transcript_key(transcript):
+    return f"transcripts/{hashlib.sha256(transcript.encode('utf-8')).hexdigest()}.z"
+
+
+# Stores the transcript, and returns the fields that reference it in the item
+def store(transcript):
+    data = zlib.compress(transcript.encode("utf-8"), config.TRANSCRIPT_COMPRESSION_LEVEL)
+    if len(data) <= config.TRANSCRIPT_INLINE_MAX_BYTES:
+        metrics.incr("transcripts.inline")
+        return {"transcript_z": data}
+
+    bucket, key = config.S3_BUCKET_TRANSCRIPTS, transcript_key(transcript)
+    if util.s3_object_exists(bucket, key):
+        metrics.incr("transcripts.s3_reused")
+        return {"transcript_ref": util.s3_url(bucket, key)}
+    metrics.incr("transcripts.s3")
+    return {"transcript_ref": util.upload_stream_to_s3(io.BytesIO(data), bucket, key, content_type="application/zlib")}
+
+
+# Whether the item already references its transcript, in any layout
+def is_stored(item):
+    return any(field in item for field in FIELDS)
+
+
+# The item as persisted: the transcript in memory is replaced by the fields of store()
+def stored_item(item):
+    stored = {k: v for k, v in item.items() if k != "transcript"}
+    if item.get("transcript"):
+        stored.update(store(item["transcript"]))
+    return stored
+
+
+# The transcript of an item, read from S3 only when it is not in the item. None if the item has none
+def load(item):
+    if item.get("transcript"):
+        return item["transcript"]
+    if item.get("transcript_z"):
+        data = item["transcript_z"]
+        return zlib.decompress(getattr(data, "value", data)).decode("utf-8")  # boto3 returns a Binary
+    if item.get("transcript_ref"):
+        metrics.incr("transcripts.s3_load")
+        bucket, key = util.parse_s3_url(item["transcript_ref"])
+        data = aws.get_client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+        return zlib.decompress(data).decode("utf-8")
+    return None
+
+
+# Moves the plain transcripts of the summary table to the layout above. Returns a report of the items and of the
+# read units of a GetItem on them (see db.read_units), before and after
+def migrate(dry_run=False, segments=1, max_read_units=None):
+    table = db.get_summary_table()
+    report = {"items": 0, "migrated": 0, "inline": 0, "s3": 0, "read_units_before": 0.0, "read_units_after": 0.0}
+    for item in table.list(segments=segments, max_read_units=max_read_units):
+        report["items"] += 1
+        report["read_units_before"] += db.read_units(item)
+        if not item.get("transcript"):
+            report["read_units_after"] += db.read_units(item)
+            continue
+
+        if dry_run:
+            data = zlib.compress(item["transcript"].encode("utf-8"), config.TRANSCRIPT_COMPRESSION_LEVEL)
+            fields = {"transcript_z": data} if len(data) <= config.TRANSCRIPT_INLINE_MAX_BYTES \
+                else {"transcript_ref": util.s3_url(config.S3_BUCKET_TRANSCRIPTS, transcript_key(item["transcript"]))}
+        else:
+            fields = store(item["transcript"])
+            if table.update(item["id"], fields, remove=["transcript"]) is None:
+                logger.error(f"Error migrating the transcript of {item['id']}")
+                continue
+        migrated = {k: v for k, v in item.items() if k != "transcript"}
+        migrated.update(fields)
+        report["migrated"] += 1
+        report["inline" if "transcript_z" in fields else "s3"] += 1
+        report["read_units_after"] += db.read_units(migrated)
+    return report
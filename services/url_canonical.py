@@ -0,0 +1,81 @@
+import functools
+import re
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit, urlunsplit
+
+import config
+
+# Canonical form of an article url, used for the article id. Variants of the same article
+# (tracking params, www, fragments, AMP pages, trailing slashes...) get the same id, hence the same cached summary.
+#  - scheme and host are lowercased, www. and the default port are dropped
+#  - the query is dropped, except the params kept by config.URL_QUERY_PARAMS for the host
+#  - the fragment is dropped, except for config.URL_KEEP_FRAGMENT hosts and #! / #/ routes
+#  - AMP pages are mapped to the regular page, and the trailing slash of the path is dropped
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Tracking params, dropped even when a site keeps all its params
+TRACKING_PARAMS = re.compile(r"^(utm_.*|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|igshid|_ga|_gl|yclid|ref|ref_src|ref_url|cmpid|smid|ncid|sr_share|amp|outputtype)$", re.IGNORECASE)
+# AMP urls wrapping another url: www.google.com/amp/s/<url> and <site>.cdn.ampproject.org/c/s/<url>
+AMP_VIEWER = re.compile(r"^(?:(?:www\.)?google\.[a-z.]+/amp/|[a-z0-9-]+\.cdn\.ampproject\.org/(?:[a-z]/)?)(s/)?(.+)$", re.IGNORECASE)
+# AMP versions of a page: /amp, /amp/, /amp.html, .amp.html, .amp suffixes and /amp/ prefix
+AMP_PATH = re.compile(r"(?:/amp/?|/amp\.html|\.amp\.html|\.amp)$|^/amp(?=/)", re.IGNORECASE)
+
+
+# The host and its parent domains, e.g. www.youtube.com, youtube.com, com
+def site_hosts(host):
+    labels = host.split(".")
+    return [".".join(labels[i:]) for i in range(len(labels))]
+
+
+def canonical_query(host, query):
+    keep = next((config.URL_QUERY_PARAMS[site] for site in site_hosts(host) if site in config.URL_QUERY_PARAMS), None)
+    if not keep or not query:
+        return ""
+    params = [(name, value) for name, value in parse_qsl(query, keep_blank_values=True)
+              if (keep == "*" or name in keep) and not TRACKING_PARAMS.match(name)]
+    return urlencode(sorted(params))
+
+
+def canonical_fragment(host, fragment):
+    if fragment and (any(site in config.URL_KEEP_FRAGMENT for site in site_hosts(host)) or fragment.startswith(("!", "/"))):
+        return fragment
+    return ""
+
+
+def canonical_path(path):
+    path = AMP_PATH.sub("", re.sub(r"/{2,}", "/", path or "/")) or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    return path
+
+
+@functools.lru_cache(maxsize=config.URL_CANONICAL_CACHE_SIZE)
+def canonicalize(url):
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if scheme not in DEFAULT_PORTS or not host:
+        # e.g. file:// or chrome-extension:// urls, kept as they are except the query
+        return urlunsplit(parts._replace(query=""))
+
+    viewer = AMP_VIEWER.match(f"{host}{parts.path}")
+    if viewer and "." in viewer.group(2).split("/")[0]:
+        target = unquote(viewer.group(2))
+        return canonicalize(f"{'https' if viewer.group(1) else 'http'}://{target}")
+
+    if host.startswith("www."):
+        host = host[4:]
+    if host.startswith("amp.") and host.count(".") > 1:
+        host = host[4:]
+    netloc = host if port in (None, DEFAULT_PORTS[scheme]) else f"{host}:{port}"
+    return urlunsplit((scheme, netloc, canonical_path(parts.path), canonical_query(host, parts.query),
+                       canonical_fragment(host, parts.fragment)))
+
+
+# The url as it was keyed before the canonicalisation: only the query was dropped
+def legacy(url):
+    return urlunsplit(urlsplit(url)._replace(query=""))
@@ -2,17 +2,24 @@ import os
 import hashlib
 import time
 import json
-import concurrent.futures
-from urllib.parse import urlparse, urlunparse, quote
+from decimal import Decimal
+from urllib.parse import quote
 from flask import make_response, jsonify, Response
 import re
 import requests
 
-import boto3
 from botocore.exceptions import NoCredentialsError, ClientError
 
+# orjson is optional. Without it, responses are serialized with json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import config
-from lib import log
+from services import blocklist, url_canonical
+from lib import activity_log, aws, db, log, metrics, secret_store
+from lib.cache import TTLCache
 
 logger = log.setup_logger()
 stage = os.environ.get("STAGE", "dev")
@@ -23,7 +30,7 @@ stage = os.environ.get("STAGE", "dev")
 # TODO implement this later
 def is_worth(id, url):
     # If the url is in the list of blacklist, don't proceed
-    return not match_regex_list(config.BLACKLIST_URLS, url)
+    return not blocklist.get_blocklist().matches(url)
 
 
 def match_regex_list(regex_list, input_string):
@@ -34,30 +41,24 @@ def match_regex_list(regex_list, input_string):
 
 
 # log user activity to DB
-def log_user_activity(user_id, article_id, article_url, activity="READ", comments=None):
+def log_user_activity(user_id, article_id, article_url, activity="READ", comments=None, source_url=None):
     # persist the user_activity output
     item = {
         "user_id": user_id or config.DEFAULT_USERNAME,
         "article_id": article_id,
         "article_url": article_url,
+        # The url as requested, before clean_url. Lets us replay the logs through new url rules
+        "source_url": source_url,
         "activity": activity,
         "comments": comments,
         "dateCreated": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
     }
-    bucket_name = config.S3_BUCKET_ACTIVITY_LOGS
-    folder_by_day = time.strftime("%Y-%m-%d", time.localtime())  # One folder per day
-    s3_key = time.strftime("%Y%m%d%H%M%S%f", time.localtime())[
-        :-3
-    ]  # current timestamp will the key for the log record
-    # Writing to logs in the background, without waiting
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-        executor.submit(
-            append_logs_to_s3, item, bucket_name, f"{folder_by_day}/{s3_key}"
-        )
+    # Buffered and written to S3 in batches, in the background
+    activity_log.get_activity_log().append(item)
 
 
 def append_logs_to_s3(item, bucket_name, key):
-    s3 = boto3.client("s3")
+    s3 = aws.get_client("s3")
     json_data = json.dumps(item)
     # Appending the stage to folder path
     s3.put_object(
@@ -65,6 +66,25 @@ def append_logs_to_s3(item, bucket_name, key):
     )
 
 
+# Formats a payload as a server-sent event. Multi-line data is split into several data fields as per the SSE spec
+def sse_event(data, event=None):
+    if not isinstance(data, str):
+        data = json_dumps(data)
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+# An event of POST /stream, framed like the others of the response: with stream_tokens (config.STREAM_TOKENS when
+# None) the client parses SSE, so every event goes through sse_event. Plain json otherwise
+def stream_event(data, stream_tokens=None, event="item"):
+    if stream_tokens is None:
+        stream_tokens = config.STREAM_TOKENS
+    if stream_tokens:
+        return sse_event(data, event)
+    return data if isinstance(data, str) else json_dumps(data)
+
+
 # File for misc utility methods
 def is_non_empty_array(obj):
     return isinstance(obj, list) and len(obj) > 0
@@ -73,7 +93,7 @@ def is_non_empty_array(obj):
 # utility to upload to s3. Index is needed only for storing the chunks to remember the insertion order for sorting
 def upload_to_s3(file_path, bucket_name, s3_key, index=0):
     try:
-        s3_client = boto3.client("s3")
+        s3_client = aws.get_client("s3")
         s3_client.upload_file(file_path, bucket_name, f"{stage}/{s3_key}")
         url = f"s3://{bucket_name}/{stage}/{s3_key}"
         print(f"File {file_path} uploaded to {url}")
@@ -84,13 +104,74 @@ def upload_to_s3(file_path, bucket_name, s3_key, index=0):
         print("Credentials not available")
 
 
+def s3_url(bucket_name, s3_key):
+    return f"s3://{bucket_name}/{stage}/{s3_key}"
+
+
+# Whether the object exists, under the stage folder like the uploads
+def s3_object_exists(bucket_name, s3_key):
+    try:
+        aws.get_client("s3").head_object(Bucket=bucket_name, Key=f"{stage}/{s3_key}")
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+# Uploads a file-like object to S3 without a local copy. Data is read in S3_UPLOAD_PART_SIZE parts, and sent as one
+# put_object when it fits in a part, or as a multipart upload otherwise. The multipart upload is aborted on errors
+def upload_stream_to_s3(stream, bucket_name, s3_key, content_type="audio/mpeg", part_size=None):
+    s3_client = aws.get_client("s3")
+    part_size = part_size or config.S3_UPLOAD_PART_SIZE
+    key = f"{stage}/{s3_key}"
+    url = s3_url(bucket_name, s3_key)
+
+    part = read_part(stream, part_size)
+    if len(part) < part_size:
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=part, ContentType=content_type)
+        metrics.incr("s3.upload_stream.put")
+        logger.info(f"Stream uploaded to {url}, {len(part)} bytes")
+        return url
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=key, ContentType=content_type)["UploadId"]
+    parts = []
+    size = 0
+    try:
+        while part:
+            response = s3_client.upload_part(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                             PartNumber=len(parts) + 1, Body=part)
+            parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+            size += len(part)
+            part = read_part(stream, part_size)
+        s3_client.complete_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id,
+                                            MultipartUpload={"Parts": parts})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+        raise
+    metrics.incr("s3.upload_stream.multipart")
+    logger.info(f"Stream uploaded to {url}, {size} bytes in {len(parts)} parts")
+    return url
+
+
+# Reads up to size bytes. Streams like the Polly AudioStream may return less than asked before the end
+def read_part(stream, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = stream.read(size - len(buffer))
+        if not chunk:
+            break
+        buffer += chunk
+    return bytes(buffer)
+
+
 def download_from_s3(s3_url):
     # Extract bucket name and file key from the S3 URL
     bucket_name = s3_url.split("/")[2]
     file_key = "/".join(s3_url.split("/")[3:])
 
-    # Create a new S3 client
-    s3 = boto3.client("s3")
+    # Get the shared S3 client
+    s3 = aws.get_client("s3")
 
     # Generate a local filename
     local_filename = f"/tmp/{file_key.split('/')[-1]}"
@@ -116,10 +197,8 @@ def parse_s3_url(url):
 
 
 def clean_url(url):
-    # Parse the URL
-    parsed_url = urlparse(url)
-    # Rebuild the URL without query parameters
-    return urlunparse(parsed_url._replace(query=""))
+    # Canonical form of the url: no tracking params, www, AMP... See services.url_canonical
+    return url_canonical.canonicalize(url)
 
 def shorten_url(url):
     api_url = "http://tinyurl.com/api-create.php"
@@ -148,9 +227,56 @@ def generate_id(url, instructions="default", include_audio="false"):
     return hash_object.hexdigest()
 
 
+# Id of the article before the canonical urls, see url_canonical.legacy
+def legacy_id(url, instructions="default", include_audio="false"):
+    key_to_hash = url_canonical.legacy(url) + instructions + include_audio
+    return hashlib.sha256(key_to_hash.encode()).hexdigest()
+
+
+# Fields of a legacy article that are not copied to its new id. The serialized response has the old id
+LEGACY_NOT_COPIED = ("id", "url", "response_blob")
+
+
+# Articles summarized under their legacy id, for the given {id: url} of the missing ones. Each one found is copied to
+# its new id, unless it was written meanwhile, so the next requests find it directly. Returns the copies by new id
+def find_legacy_articles(urls_by_id, instructions="default", include_audio="false"):
+    if not config.LEGACY_ID_FALLBACK:
+        return {}
+    new_ids = {legacy_id(url, instructions, include_audio): id for id, url in urls_by_id.items()}
+    new_ids = {old_id: id for old_id, id in new_ids.items() if old_id != id}
+    if not new_ids:
+        return {}
+
+    table = db.get_summary_table()
+    articles = {}
+    for old_id, legacy in table.batch_get(list(new_ids)).items():
+        if not legacy.get("text_summary"):
+            continue
+        id = new_ids[old_id]
+        item = {k: v for k, v in legacy.items() if k not in LEGACY_NOT_COPIED}
+        item.update({"id": id, "url": clean_url(urls_by_id[id])})
+        table.update(id, item, condition="attribute_not_exists(id)")
+        metrics.incr("articles.legacy_id")
+        articles[id] = item
+    return articles
+
+
+# The summary item of an article, or of its legacy id (see find_legacy_articles). None if neither exists
+def get_article(id, url, instructions="default", include_audio="false"):
+    item = db.get_summary_table().get(id)
+    if item is None:
+        item = find_legacy_articles({id: url}, instructions, include_audio).get(id)
+    return item
+
+
+# Presigned URLs keyed by bucket, key and expiration. Each is reused until PRESIGNED_URL_SAFETY_MARGIN_IN_SEC before it expires
+_presigned_urls = TTLCache("presigned_url", config.PRESIGNED_URL_CACHE_MAX_ITEMS, config.PRESIGNED_URL_SAFETY_MARGIN_IN_SEC)
+
+
 def generate_presigned_url(bucket_name, object_key, expiration=3600):
     """
     Generate a presigned URL for an S3 object.
+    A URL signed earlier for the same object and expiration is reused, while it is valid for longer than the safety margin.
 
     Args:
     - bucket_name (str): The name of the S3 bucket.
@@ -160,12 +286,47 @@ def generate_presigned_url(bucket_name, object_key, expiration=3600):
     Returns:
     - str: A presigned URL to access the S3 object.
     """
-    s3_client = boto3.client("s3")
+    presigned_url, expires_at = presign(bucket_name, object_key, expiration)
+    return presigned_url
+
+
+# Returns the presigned URL and the epoch time it expires at
+def presign(bucket_name, object_key, expiration=3600):
+    cache_key = (bucket_name, object_key, expiration)
+    hit, entry = _presigned_urls.lookup(cache_key)
+    if hit:
+        return entry
+
+    signed_at = int(time.time())
+    s3_client = aws.get_client("s3")
     presigned_url = s3_client.generate_presigned_url(
         "get_object",
         Params={"Bucket": bucket_name, "Key": object_key},
         ExpiresIn=expiration,
     )
+    entry = (presigned_url, signed_at + expiration)
+    reuse_for = expiration - config.PRESIGNED_URL_SAFETY_MARGIN_IN_SEC
+    if reuse_for > 0:
+        _presigned_urls.set(cache_key, entry, ttl=reuse_for)
+    return entry
+
+
+# Presigned URL of the audio summary of an item.
+# With PRESIGNED_URL_ON_ITEM, the URL is also stored on the item, so that cold containers can reuse it
+def presigned_audio_url(id, item):
+    file_source = item["audio_summary_url"]
+    stored = item.get("audio_url_presigned")
+    if stored and stored.get("source") == file_source \
+            and stored["expires_at"] - config.PRESIGNED_URL_SAFETY_MARGIN_IN_SEC > time.time():
+        metrics.incr("presigned_url.item_hit")
+        return stored["url"]
+
+    bucket_name, object_key = parse_s3_url(file_source)
+    presigned_url, expires_at = presign(bucket_name, object_key)
+    if config.PRESIGNED_URL_ON_ITEM:
+        db.get_summary_table().update(id, {
+            "audio_url_presigned": {"source": file_source, "url": presigned_url, "expires_at": expires_at}
+        })
     return presigned_url
 
 
@@ -187,70 +348,118 @@ def generate_audio_url_public(file_source):
         return None
 
 
-def build_response(id, item):
-    if item:
-        file_source = item["audio_summary_url"]
-        if file_source:
-            if file_source.startswith("s3://"):
-                try:
-                    # Assuming parse_s3_url is defined elsewhere to extract bucket and key
-                    bucket_name, object_key = parse_s3_url(file_source)
-                    audio_url = generate_presigned_url(bucket_name, object_key)
-                except Exception as e:
-                    print(f"Error generating S3 presigned URL: {e}")
-                    return None  # Handle error appropriately
-            else:
-                # Handle local files differently, e.g., by uploading them to S3 first or using a different strategy
-                print("Local files need to be handled differently.")
-                return None
-        else:
-            audio_url = None
+# JSON encoding of the responses, with orjson when installed, compact either way. Numbers read from DynamoDB
+# come as Decimal
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default).decode("utf-8")
+    return json.dumps(obj, default=_json_default, separators=(",", ":"))
 
-        # Prepare the response as JSON
-        response_body = {
-            "id": id,
-            "audio_url": audio_url,
-            **({"tone": item["tone"]} if "tone" in item else {}),
-            **({"sentiment": item["sentiment"]} if "sentiment" in item else {}),
-            **({"key_topics": item["key_topics"]} if "key_topics" in item else {}),
-            **({"text_summary": item["text_summary"]} if "text_summary" in item else {}),
-            **({"summary_bullets": item["summary_bullets"]} if "summary_bullets" in item else {}),
-            **({"time_saved": item["time_saved"]} if "time_saved" in item else {}),
-            "clean_url": item["url"],
-        }
 
-        return json.dumps(response_body)
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def build_response(id, item):
+    if item:
+        audio_url = audio_response_url(id, item)
+        if audio_url is False:
+            return None
+        return patch_response_blob(response_blob(id, item), audio_url, item.get("audio_status"))
     else:
         error_response = {"message": "Error, article could not be summarized"}
         return json.dumps(error_response)
 
-# Utility to retrieve the secrets like credentials, etc from AWS secret manager
-def get_secret(secret_name="OPENAI_API_KEY"):
-    region_name = "us-west-1"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+# The fields of a summarized article sent to the client. None if the audio url can't be generated
+def summary_response(id, item):
+    audio_url = audio_response_url(id, item)
+    if audio_url is False:
+        return None
+    return {
+        "id": id,
+        "audio_url": audio_url,
+        **stable_response_fields(item),
+        **({"audio_status": item["audio_status"]} if "audio_status" in item else {}),
+        "clean_url": item["url"],
+    }
+
 
-    # Retrieve the secret value
+# Presigned URL of the audio of the item, None without audio, False if it can't be generated
+def audio_response_url(id, item):
+    file_source = item.get("audio_summary_url")
+    if not file_source:
+        return None
+    if not file_source.startswith("s3://"):
+        # Handle local files differently, e.g., by uploading them to S3 first or using a different strategy
+        print("Local files need to be handled differently.")
+        return False
     try:
-        response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
+        return presigned_audio_url(id, item)
+    except Exception as e:
+        print(f"Error generating S3 presigned URL: {e}")
+        return False  # Handle error appropriately
+
+
+# Fields of the response that change only with a new revision of the article
+RESPONSE_FIELDS = ["tone", "sentiment", "key_topics", "text_summary", "summary_bullets", "time_saved"]
+
+
+def stable_response_fields(item):
+    return {field: item[field] for field in RESPONSE_FIELDS if field in item}
+
+
+# The response of a cache hit is serialized once per revision of the article (see summarizer.save_changes), with
+# placeholders for the fields that change between requests: the presigned audio url and the audio job status.
+# Blobs are kept in memory, and with RESPONSE_BLOB_ON_ITEM also on the item, for cold containers
+AUDIO_URL_PLACEHOLDER = "__audio_url__"
+AUDIO_STATUS_PLACEHOLDER = "__audio_status__"
+AUDIO_URL_TOKEN = '"__audio_url__"'
+AUDIO_STATUS_TOKEN = '"__audio_status__"'
+AUDIO_STATUS_FIELD = ',"audio_status":"__audio_status__"'
+_response_blobs = TTLCache("response_blob", config.RESPONSE_BLOB_CACHE_MAX_ITEMS, config.RESPONSE_BLOB_CACHE_TTL_IN_SEC)
 
-    # Extract the secret value
-    if "SecretString" in response:
-        secret = response["SecretString"]
+
+def response_blob(id, item):
+    revision = item.get("revision", 0)
+    hit, blob = _response_blobs.lookup((id, revision))
+    if hit:
+        return blob
+
+    stored = item.get("response_blob")
+    if stored and stored.get("revision") == revision:
+        metrics.incr("response_blob.item_hit")
+        blob = stored["body"]
+    else:
+        blob = json_dumps({
+            "id": id,
+            "audio_url": AUDIO_URL_PLACEHOLDER,
+            "audio_status": AUDIO_STATUS_PLACEHOLDER,
+            **stable_response_fields(item),
+            "clean_url": item["url"],
+        })
+        if config.RESPONSE_BLOB_ON_ITEM:
+            db.get_summary_table().update(id, {"response_blob": {"revision": revision, "body": blob}})
+    _response_blobs.set((id, revision), blob)
+    return blob
+
+
+# Fills the placeholders of a blob. They come before the article fields, so their first occurrence is the placeholder.
+# Without an audio job, audio_status is left out, like in summary_response
+def patch_response_blob(blob, audio_url, audio_status=None):
+    if audio_status is None:
+        blob = blob.replace(AUDIO_STATUS_FIELD, "", 1)
     else:
-        # Handle binary secrets
-        secret = response["SecretBinary"]
+        blob = blob.replace(AUDIO_STATUS_TOKEN, json_dumps(audio_status), 1)
+    return blob.replace(AUDIO_URL_TOKEN, "null" if audio_url is None else json_dumps(audio_url), 1)
 
-    # Return the secret. Secret is stored as a key-value pair.
-    # We are using the convention to have the key same as the secret name for simplicity.
-    secret_dict = json.loads(secret)
-    return secret_dict[secret_name]
+# Utility to retrieve the secrets like credentials, etc. Cached, see lib/secret_store.py
+def get_secret(secret_name="OPENAI_API_KEY"):
+    return secret_store.get_secret(secret_name)
 
 
 def count_words(text):
@@ -1,9 +1,27 @@
 import unittest
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 from urllib.parse import urlparse, urlunparse, quote
 
+import copy
+import io
+import json
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+from werkzeug.datastructures import Headers
+
+import config
+import serverless_wsgi
+
+from lib import activity_log, aws, db, log, metrics, profiling, secret_store
+from lib.cache import TTLCache
+from lib.singleflight import LeaseRenewer, SingleFlight
+from services import audio_processor, chunking, fingerprint, jobs, preprocess, summarizer, transcripts, url_canonical, util
+from services.blocklist import BlocklistMatcher
 
 
 def count_words_simple(text):
@@ -78,6 +96,1077 @@ class TestMatchRegexList(unittest.TestCase):
         self.assertFalse(match_regex_list(regex_list, 'https://support.google.com/chrome_webstore/answer/2664769?hl=en-GB'))
         self.assertEqual(clean_url("https://mail.google.com/mail/u/0/#inbox/FMfcgzGxStspstDVKXJDvplKFDgVvDGf"), "https://mail.google.com/mail/u/0/#inbox/FMfcgzGxStspstDVKXJDvplKFDgVvDGf")
 
+class TestCanonicalUrl(unittest.TestCase):
+    def test_variants_share_the_canonical_url(self):
+        variants = [
+            "https://www.example.com/news/story-1",
+            "https://EXAMPLE.com:443/news/story-1/",
+            "https://example.com/news/story-1?utm_source=twitter&fbclid=abc#comments",
+            "https://example.com/news/story-1/amp",
+            "https://www.google.com/amp/s/www.example.com/news/story-1.amp",
+        ]
+        self.assertEqual({url_canonical.canonicalize(url) for url in variants}, {"https://example.com/news/story-1"})
+
+    def test_per_site_rules(self):
+        self.assertEqual(url_canonical.canonicalize("https://news.ycombinator.com/item?utm_source=x&id=123"), "https://news.ycombinator.com/item?id=123")
+        self.assertEqual(url_canonical.canonicalize("https://mail.google.com/mail/u/0/#inbox/FMfcgzGxStspstDVKXJDvplKFDgVvDGf"), "https://mail.google.com/mail/u/0#inbox/FMfcgzGxStspstDVKXJDvplKFDgVvDGf")
+        self.assertEqual(url_canonical.canonicalize("https://app.example.com/#/docs/intro"), "https://app.example.com/#/docs/intro")
+        self.assertEqual(url_canonical.canonicalize("http://example.com:8080/"), "http://example.com:8080/")
+
+class TestUploadStreamToS3(unittest.TestCase):
+    def test_small_stream_is_one_put(self):
+        with patch("lib.aws.get_client") as get_client:
+            url = util.upload_stream_to_s3(io.BytesIO(b"x" * 10), "bucket", "a.mp3", part_size=16)
+        s3 = get_client.return_value
+        self.assertEqual(url, f"s3://bucket/{util.stage}/a.mp3")
+        self.assertEqual(s3.put_object.call_args.kwargs["Body"], b"x" * 10)
+        s3.create_multipart_upload.assert_not_called()
+
+    def test_large_stream_is_uploaded_in_parts(self):
+        with patch("lib.aws.get_client") as get_client:
+            s3 = get_client.return_value
+            s3.create_multipart_upload.return_value = {"UploadId": "u1"}
+            s3.upload_part.side_effect = lambda **kwargs: {"ETag": f"e{kwargs['PartNumber']}"}
+            util.upload_stream_to_s3(io.BytesIO(b"x" * 40), "bucket", "a.mp3", part_size=16)
+        self.assertEqual([len(call.kwargs["Body"]) for call in s3.upload_part.call_args_list], [16, 16, 8])
+        self.assertEqual(s3.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"],
+                         [{"PartNumber": 1, "ETag": "e1"}, {"PartNumber": 2, "ETag": "e2"}, {"PartNumber": 3, "ETag": "e3"}])
+
+    def test_failed_multipart_upload_is_aborted(self):
+        with patch("lib.aws.get_client") as get_client:
+            s3 = get_client.return_value
+            s3.create_multipart_upload.return_value = {"UploadId": "u1"}
+            s3.upload_part.side_effect = IOError("connection reset")
+            with self.assertRaises(IOError):
+                util.upload_stream_to_s3(io.BytesIO(b"x" * 40), "bucket", "a.mp3", part_size=16)
+        s3.abort_multipart_upload.assert_called_once_with(Bucket="bucket", Key=f"{util.stage}/a.mp3", UploadId="u1")
+        s3.complete_multipart_upload.assert_not_called()
+
+class TestPollyChunks(unittest.TestCase):
+    class FlakyPolly(object):
+        def __init__(self, failures):
+            self.failures = failures
+
+        def synthesize_speech(self, Text, **kwargs):
+            if self.failures.get(Text):
+                self.failures[Text] -= 1
+                raise IOError("connection reset")
+            return {"AudioStream": io.BytesIO(Text.encode())}
+
+    def test_chunks_are_joined_in_order_and_retried(self):
+        chunks = chunking.split_text("First sentence. Second one is longer. Third.", 25, count=len)
+        self.assertEqual(chunks, ["First sentence.", "Second one is longer.", "Third."])
+        polly = self.FlakyPolly({"First sentence.": 1})
+        with patch("config.POLLY_RETRY_BACKOFF_IN_SEC", 0):
+            audio = audio_processor.synthesize_chunks(chunks, polly)
+        self.assertEqual(audio, b"First sentence.Second one is longer.Third.")
+
+    def test_audio_key_is_content_addressed(self):
+        key = audio_processor.audio_key("Hello   world.\n", "Matthew", "neural", "mp3")
+        self.assertEqual(key, audio_processor.audio_key("Hello world.", "Matthew", "neural", "mp3"))
+        self.assertNotEqual(key, audio_processor.audio_key("Hello world.", "Joanna", "neural", "mp3"))
+        self.assertNotEqual(key, audio_processor.audio_key("Hello world.", "Matthew", "standard", "mp3"))
+        self.assertTrue(key.startswith("audio/") and key.endswith(".mp3"))
+
+    def test_chunk_fails_after_max_attempts(self):
+        polly = self.FlakyPolly({"Third.": 10})
+        with patch("config.POLLY_RETRY_BACKOFF_IN_SEC", 0), self.assertRaises(IOError):
+            audio_processor.synthesize_chunks(["First.", "Third."], polly)
+
+class TestJobs(unittest.TestCase):
+    def test_sqs_event_reports_failed_messages(self):
+        done = []
+        def handler(id, payload):
+            if payload.get("fail"):
+                raise ValueError("failed")
+            done.append(id)
+        jobs.register("test", handler)
+        records = [{"eventSource": "aws:sqs", "messageId": f"m{i}", "body": json.dumps({"kind": "test", "id": f"a{i}", "payload": {"fail": i == 1}})}
+                   for i in range(3)]
+        self.assertTrue(jobs.is_sqs_event({"Records": records}))
+        self.assertEqual(jobs.handle_sqs_event({"Records": records}), {"batchItemFailures": [{"itemIdentifier": "m1"}]})
+        self.assertEqual(done, ["a0", "a2"])
+
+    def test_in_process_queue_runs_the_job(self):
+        done = []
+        jobs.register("test", lambda id, payload: done.append((id, payload)))
+        jobs.InProcessQueue(1).enqueue("test", "a1", {"text": "hello"}).result()
+        self.assertEqual(done, [("a1", {"text": "hello"})])
+
+    def test_stream_handler_runs_sqs_events(self):
+        import app
+        jobs.register("test", lambda id, payload: None)
+        written = []
+        stream = Mock(write=written.append)
+        records = [{"eventSource": "aws:sqs", "messageId": "m0", "body": json.dumps({"kind": "test", "id": "a0", "payload": {}})}]
+        with patch("serverless_wsgi.handle_request_streaming") as handle_request_streaming:
+            app.stream_handler({"Records": records}, None, stream)
+        handle_request_streaming.assert_not_called()
+        self.assertEqual(json.loads("".join(written)), {"batchItemFailures": []})
+
+    def test_stream_handler_warms_the_tables(self):
+        import app
+        with patch("lib.db.warm_tables") as warm_tables, patch("serverless_wsgi.handle_request_streaming"):
+            app.stream_handler({"source": "serverless-plugin-warmup"}, None, Mock())
+        warm_tables.assert_called_once()
+
+def parse_streamed_response(data):
+    prelude, body = data.split(serverless_wsgi.STREAMING_PRELUDE_DELIMITER, 1)
+    return json.loads(prelude), body
+
+class TestResponseStreaming(unittest.TestCase):
+    def setUp(self):
+        self.headers = Headers([("Content-Type", "text/event-stream"), ("X-Tag", "1"), ("X-Tag", "2"),
+                                ("Set-Cookie", "a=1"), ("Set-Cookie", "b=2")])
+
+    def test_prelude_v1_headers(self):
+        prelude, body = parse_streamed_response(serverless_wsgi.generate_streaming_prelude("200 OK", self.headers, {"headers": {}}))
+        self.assertEqual(body, b"")
+        self.assertEqual(prelude["statusCode"], 200)
+        self.assertNotIn("multiValueHeaders", prelude)
+        headers = prelude["headers"]
+        self.assertEqual(headers["Content-Type"], "text/event-stream")
+        # Repeated headers are passed with a different casing each
+        self.assertEqual(sorted(v for k, v in headers.items() if k.lower() == "x-tag"), ["1", "2"])
+        self.assertEqual(sorted(v for k, v in headers.items() if k.lower() == "set-cookie"), ["a=1", "b=2"])
+
+    def test_prelude_v1_multi_value_headers(self):
+        event = {"multiValueHeaders": {"Host": ["example.com"]}}
+        prelude, _ = parse_streamed_response(serverless_wsgi.generate_streaming_prelude("404 NOT FOUND", self.headers, event))
+        self.assertEqual(prelude["statusCode"], 404)
+        self.assertNotIn("headers", prelude)
+        self.assertEqual(prelude["multiValueHeaders"], {"Content-Type": ["text/event-stream"], "X-Tag": ["1", "2"],
+                                                        "Set-Cookie": ["a=1", "b=2"]})
+
+    def test_prelude_v2_cookies(self):
+        prelude, _ = parse_streamed_response(serverless_wsgi.generate_streaming_prelude("201 CREATED", self.headers, {"version": "2.0"}))
+        self.assertEqual(prelude, {"statusCode": 201, "cookies": ["a=1", "b=2"],
+                                   "headers": {"Content-Type": "text/event-stream", "X-Tag": "1, 2"}})
+
+    def test_chunks_are_written_as_they_are_produced(self):
+        from flask import Flask, Response
+        stream = Mock()
+        written = []
+        stream.write.side_effect = written.append
+        written_before_chunk = []
+        test_app = Flask(__name__)
+
+        @test_app.route("/stream")
+        def generate():
+            def chunks():
+                for chunk in ["a", "b", "c"]:
+                    written_before_chunk.append(len(written))
+                    yield chunk
+            return Response(chunks(), mimetype="text/event-stream")
+
+        event = {"version": "2.0", "rawPath": "/stream", "headers": {"host": "example.com"},
+                 "requestContext": {"http": {"method": "GET"}}}
+        serverless_wsgi.handle_request_streaming(test_app, event, None, stream)
+        # The prelude is written before the first chunk is produced, and each chunk before the next one
+        self.assertEqual(written_before_chunk, [1, 2, 3])
+        self.assertEqual(written[1:], [b"a", b"b", b"c"])
+        self.assertEqual(stream.flush.call_count, 4)
+        prelude, _ = parse_streamed_response(written[0])
+        self.assertEqual(prelude["statusCode"], 200)
+        self.assertTrue(prelude["headers"]["Content-Type"].startswith("text/event-stream"))
+
+class TestAudioRetry(unittest.TestCase):
+    def test_failed_audio_is_due_after_the_backoff(self):
+        now = 100000
+        self.assertTrue(audio_processor.audio_due({}, now))
+        self.assertFalse(audio_processor.audio_due({"audio_summary_url": "s3://a"}, now))
+        failed = {"audio_status": audio_processor.AUDIO_FAILED, "audio_attempts": 2}
+        self.assertFalse(audio_processor.audio_due({**failed, "audio_status_at": now - 10}, now))
+        self.assertTrue(audio_processor.audio_due({**failed, "audio_status_at": now - audio_processor.retry_backoff(2) - 1}, now))
+        capped = {**failed, "audio_attempts": config.AUDIO_MAX_ATTEMPTS, "audio_status_at": 0}
+        self.assertFalse(audio_processor.audio_due(capped, now))
+        self.assertFalse(audio_processor.audio_due({"audio_status": audio_processor.AUDIO_QUEUED, "audio_status_at": now}, now))
+
+    def test_cache_hit_only_requests_audio_when_due(self):
+        import app
+        table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", table)
+        self.addCleanup(db.set_table, "summary", previous)
+        patch("services.util.log_user_activity").start()
+        request_audio = patch("services.audio_processor.request_audio", return_value=True).start()
+        self.addCleanup(patch.stopall)
+        url = "https://example.com/audio-failed"
+        id = util.generate_id(url, "default", "true")
+        table.items[id] = {"id": id, "url": url, "text_summary": "A summary.", "audio_status": audio_processor.AUDIO_FAILED,
+                           "audio_status_at": int(time.time()), "audio_attempts": 1}
+
+        body = {"url": url, "transcript": "text " * 30, "instructions": "default", "audio": "true", "stream_tokens": False}
+        self.assertEqual(app.app.test_client().post("/stream", json=body).status_code, 200)
+        request_audio.assert_not_called()
+
+        table.items[id]["audio_status_at"] = 0
+        app.app.test_client().post("/stream", json=body)
+        request_audio.assert_called_once_with(id, "A summary.", 1)
+
+
+class TestStreamEvents(unittest.TestCase):
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        patch("services.util.log_user_activity").start()
+        self.addCleanup(patch.stopall)
+
+    def add_item(self, url):
+        id = util.generate_id(url, "default", "")
+        self.table.items[id] = {"id": id, "url": url, "text_summary": "A summary."}
+        return id
+
+    def test_cache_hit_is_an_sse_event_with_stream_tokens(self):
+        import app
+        url = "https://example.com/cached"
+        self.add_item(url)
+        body = {"url": url, "transcript": "text " * 30, "instructions": "default", "audio": "", "stream_tokens": True}
+        data = app.app.test_client().post("/stream", json=body).get_data(as_text=True)
+        self.assertTrue(data.startswith("event: item\ndata: {"))
+        self.assertEqual(json.loads(data.split("data: ", 1)[1])["text_summary"], "A summary.")
+
+    def test_result_of_the_in_flight_request_is_an_sse_event(self):
+        id = self.add_item("https://example.com/in-flight")
+        self.assertIsNone(summarizer._in_flight.acquire(id))
+        self.addCleanup(summarizer._in_flight.release, id)
+        with patch("config.SUMMARY_WAIT_IN_SEC", 0):
+            events = list(summarizer.process_once(None, id, "https://example.com/in-flight", "text", "default", "", None, stream_tokens=True))
+        self.assertEqual(len(events), 1)
+        self.assertTrue(events[0].startswith("event: item\ndata: "))
+        self.assertTrue(events[0].endswith("\n\n"))
+
+
+class TestChunkSummaries(unittest.TestCase):
+    def test_expired_chunk_record_is_summarized_again(self):
+        table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", table)
+        self.addCleanup(db.set_table, "summary", previous)
+        chunk = "An expired chunk of a long document."
+        with patch("services.summarizer.gpt_with_openai", return_value="Stale summary."):
+            summarizer.summarize_chunk(chunk)
+        key = next(id for id in table.items if id.startswith("chunk#"))
+        table.items[key]["expires_at"] = int(time.time()) - 1
+        summarizer._chunk_summaries.clear()
+
+        with patch("services.summarizer.gpt_with_openai", return_value="Fresh summary.") as gpt:
+            self.assertEqual(summarizer.summarize_chunk(chunk), "Fresh summary.")
+        gpt.assert_called_once()
+        self.assertGreater(table.items[key]["expires_at"], time.time())
+
+    def test_condense_keeps_the_text_when_the_summaries_are_longer(self):
+        patch.object(config, "LONG_DOC_MODE", True).start()
+        patch.object(config, "LONG_DOC_THRESHOLD_TOKENS", 10).start()
+        patch.object(config, "LONG_DOC_CHUNK_TOKENS", 20).start()
+        self.addCleanup(patch.stopall)
+        text = "\n\n".join(f"Paragraph {i} of a long document." for i in range(6))
+        with patch("services.summarizer.summarize_chunk", side_effect=lambda chunk, model: chunk + " And more.") as summarize_chunk:
+            self.assertEqual(summarizer.condense(text), text)
+        self.assertGreater(summarize_chunk.call_count, 1)
+        with patch("services.summarizer.summarize_chunk", return_value="Short.") as summarize_chunk:
+            condensed = summarizer.condense(text)
+        self.assertEqual(condensed, "\n\n".join(["Short."] * summarize_chunk.call_count))
+
+
+class TestLegacyIds(unittest.TestCase):
+    URL = "https://www.example.com/news/story-1/?utm_source=twitter"
+
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        self.old_id = util.legacy_id(self.URL)
+        self.table.items[self.old_id] = {"id": self.old_id, "url": "https://www.example.com/news/story-1/",
+                                         "text_summary": "A summary.", "response_blob": {"revision": 0, "body": "{}"}}
+
+    def test_article_is_found_under_its_legacy_id_and_copied(self):
+        id = util.generate_id(self.URL)
+        self.assertNotEqual(id, self.old_id)
+        item = util.get_article(id, self.URL)
+        self.assertEqual((item["id"], item["text_summary"]), (id, "A summary."))
+        self.assertEqual(self.table.items[id]["url"], "https://example.com/news/story-1")
+        self.assertNotIn("response_blob", self.table.items[id])
+
+    def test_fallback_can_be_turned_off(self):
+        with patch("config.LEGACY_ID_FALLBACK", False):
+            self.assertIsNone(util.get_article(util.generate_id(self.URL), self.URL))
+
+    def test_batch_finds_legacy_articles(self):
+        import app
+        patch("services.util.log_user_activity").start()
+        self.addCleanup(patch.stopall)
+        response = app.app.test_client().post("/batch", json={"urls": [self.URL]})
+        self.assertEqual(response.get_json()["results"][0]["status"], "done")
+
+
+class TestColdStart(unittest.TestCase):
+    def test_setup_logger_adds_one_handler(self):
+        self.assertIs(log.setup_logger(), log.setup_logger())
+        self.assertEqual(len(log.setup_logger().handlers), 1)
+
+    def test_summarize_import_times(self):
+        stderr = "\n".join([
+            "import time: self [us] | cumulative | imported package",
+            "import time:       300 |        300 |     botocore.compat",
+            "import time:       200 |        500 |   botocore",
+            "import time:       100 |        600 | boto3",
+            "import time:        50 |         50 | json",
+        ])
+        report = profiling.summarize_import_times(stderr)
+        self.assertEqual(report["total_us"], 650)
+        self.assertEqual(report["top_level"], [(600, "boto3"), (50, "json")])
+        self.assertEqual(report["packages"], [(500, "botocore"), (100, "boto3"), (50, "json")])
+
+class TestSecretStore(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.store = secret_store.SecretStore("us-east-1", ttl=100, refresh_ahead=10, clock=lambda: self.now)
+        self.client = patch("lib.aws.get_client").start().return_value
+        self.client.get_secret_value.return_value = {"SecretString": json.dumps({"TEST_SECRET": "v1"})}
+        self.addCleanup(patch.stopall)
+
+    def test_secret_is_cached_until_it_expires(self):
+        self.assertEqual(self.store.get("TEST_SECRET"), "v1")
+        self.now = 50
+        self.assertEqual(self.store.get("TEST_SECRET"), "v1")
+        self.assertEqual(self.client.get_secret_value.call_count, 1)
+        self.now = 150
+        self.client.get_secret_value.return_value = {"SecretString": json.dumps({"TEST_SECRET": "v2"})}
+        self.assertEqual(self.store.get("TEST_SECRET"), "v2")
+
+    def test_expired_secret_is_kept_when_secrets_manager_fails(self):
+        self.store.get("TEST_SECRET")
+        self.now = 150
+        self.client.get_secret_value.side_effect = IOError("timeout")
+        self.assertEqual(self.store.get("TEST_SECRET"), "v1")
+
+    def test_environment_variable_is_used_as_is(self):
+        with patch.dict("os.environ", {"TEST_SECRET": "local"}):
+            self.assertEqual(self.store.get("TEST_SECRET"), "local")
+        self.client.get_secret_value.assert_not_called()
+
+class TestTableRegistry(unittest.TestCase):
+    def test_table_is_opened_once_across_threads(self):
+        self.addCleanup(db._tables.pop, "user", None)
+        opened = []
+        def open_table(kind, check=False):
+            time.sleep(0.01)
+            opened.append(kind)
+            return object()
+        with patch("lib.db.open_table", side_effect=open_table):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                tables = list(pool.map(lambda _: db.get_user_table(), range(8)))
+        self.assertEqual(opened, ["user"])
+        self.assertEqual(len({id(table) for table in tables}), 1)
+
+# In-memory summary table. Conditions are not evaluated
+class MemoryTable(db.DB):
+    def __init__(self):
+        self.items = {}
+
+    def get(self, id, consistent_read=False):
+        return copy.deepcopy(self.items.get(id))
+
+    def batch_get(self, ids, consistent_read=False):
+        return {id: copy.deepcopy(self.items[id]) for id in ids if id in self.items}
+
+    def update(self, id, fields, condition=None, condition_names=None, condition_values=None, remove=()):
+        item = self.items.setdefault(id, {"id": id})
+        item.update(copy.deepcopy(fields))
+        for name in remove:
+            item.pop(name, None)
+        return fields
+
+    def add_to_set(self, id, field, values, max_size=None):
+        values_set = self.items.setdefault(id, {"id": id}).setdefault(field, set())
+        if max_size is not None and len(values_set) >= max_size:
+            return False
+        values_set.update(values)
+        return True
+
+    # Same conditions as DynamoDBImpl: free or expired to acquire, held by the owner to release
+    def acquire_lease(self, key, owner, ttl):
+        lease = self.items.get(db.internal_key("lease", key))
+        if lease and lease["expires_at"] >= time.time():
+            return False
+        self.items[db.internal_key("lease", key)] = {"owner": owner, "expires_at": time.time() + ttl}
+        return True
+
+    def release_lease(self, key, owner):
+        if self.items.get(db.internal_key("lease", key), {}).get("owner") != owner:
+            return False
+        del self.items[db.internal_key("lease", key)]
+        return True
+
+    def renew_lease(self, key, owner, ttl):
+        lease = self.items.get(db.internal_key("lease", key))
+        if not lease or lease["owner"] != owner:
+            return False
+        lease["expires_at"] = time.time() + ttl
+        return True
+
+
+class TestAwsClients(unittest.TestCase):
+    def setUp(self):
+        aws.reset()
+        self.addCleanup(aws.reset)
+        self.session = Mock()
+        self.session.client.side_effect = lambda *args, **kwargs: Mock()
+        self.session.resource.side_effect = lambda *args, **kwargs: Mock()
+        patch("lib.aws._get_session", return_value=self.session).start()
+        self.addCleanup(patch.stopall)
+
+    def test_client_is_created_once_per_key(self):
+        s3 = aws.get_client("s3")
+        self.assertIs(aws.get_client("s3"), s3)
+        self.assertIs(aws.get_client("s3", region_name=None), s3)
+        self.assertEqual(self.session.client.call_count, 1)
+
+    def test_different_keys_get_different_clients(self):
+        clients = [aws.get_client("s3"), aws.get_client("sqs"), aws.get_client("s3", region_name="us-east-1"),
+                   aws.get_client("s3", endpoint_url="http://localhost:4566")]
+        self.assertEqual(len(set(map(id, clients))), 4)
+        self.assertIs(aws.get_client("s3", endpoint_url="http://localhost:4566"), clients[3])
+        self.assertEqual(self.session.client.call_count, 4)
+
+    def test_concurrent_first_use_creates_one_client(self):
+        with ThreadPoolExecutor(8) as executor:
+            clients = list(executor.map(lambda _: aws.get_client("dynamodb", region_name="us-west-1"), range(32)))
+        self.assertTrue(all(client is clients[0] for client in clients))
+        self.assertEqual(self.session.client.call_count, 1)
+
+    def test_resources_are_cached_apart_from_clients(self):
+        resource = aws.get_resource("dynamodb")
+        self.assertIs(aws.get_resource("dynamodb"), resource)
+        self.assertIsNot(aws.get_client("dynamodb"), resource)
+        self.assertIsNot(aws.get_resource("dynamodb", region_name="us-east-1"), resource)
+        self.assertEqual(self.session.resource.call_count, 2)
+
+class TestBatchEndpoint(unittest.TestCase):
+    TRANSCRIPT = "The coalition agreement was supposed to stabilise the government. " * 20
+
+    def setUp(self):
+        import app
+        self.client = app.app.test_client()
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        self.enqueue = patch("services.jobs.enqueue").start()
+        patch("services.util.log_user_activity").start()
+        patch("services.summarizer.gpt", lambda text, instructions: '{"tone": "formal"}' if "JSON" in instructions else "A summary.").start()
+        self.addCleanup(patch.stopall)
+
+    def test_batch_reports_the_real_status(self):
+        item = {"url": "https://example.com/failed-article", "transcript": self.TRANSCRIPT}
+        self.enqueue.side_effect = IOError("SQS is down")
+        response = self.client.post("/batch", json={"items": [item]})
+        self.assertEqual(response.get_json()["results"][0]["status"], "failed")
+
+        # Summarized elsewhere between the batch get and the request of the job
+        id = util.generate_id(item["url"], "default", "false")
+        self.table.items[id].update({"text_summary": "A summary.", "summary_status": "done"})
+        with patch.object(self.table, "batch_get", return_value={}), \
+                patch("services.summarizer.request_summary", return_value=(summarizer.SUMMARY_DONE, False)):
+            response = self.client.post("/batch", json={"items": [item]})
+        result = response.get_json()["results"][0]
+        self.assertEqual((result["status"], result["text_summary"]), ("done", "A summary."))
+
+        with patch("services.util.audio_response_url", return_value=False):
+            response = self.client.post("/batch", json={"items": [item]})
+        self.assertEqual(response.get_json()["results"][0]["status"], "error")
+
+    def test_article_queued_by_batch_can_be_streamed(self):
+        url = "https://example.com/queued-article"
+        response = self.client.post("/batch", json={"items": [{"url": url, "transcript": self.TRANSCRIPT}]})
+        self.assertEqual(response.get_json()["results"][0]["status"], "queued")
+        self.enqueue.assert_called_once()
+
+        response = self.client.post("/stream", json={"url": url, "transcript": self.TRANSCRIPT, "instructions": "default",
+                                                     "audio": "false", "fan_out": False, "stream_tokens": False})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("A summary.", response.get_data(as_text=True))
+
+class TestSummaryCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.table = MemoryTable()
+        self.cached = db.CachedDB(self.table, TTLCache("test", 10, 300, clock=lambda: self.now), complete=db.is_summarized)
+
+    def test_items_without_a_summary_are_cached_briefly(self):
+        self.table.items["queued"] = {"id": "queued", "summary_status": "queued"}
+        self.table.items["done"] = {"id": "done", "text_summary": "A summary."}
+        self.cached.batch_get(["queued", "done"])
+        # Summarized by a job in another container
+        self.table.items["queued"]["text_summary"] = "Their summary."
+        self.table.items["done"]["text_summary"] = "Changed elsewhere."
+        self.now = config.SUMMARY_CACHE_NEGATIVE_TTL_IN_SEC + 1
+        self.assertEqual(self.cached.get("queued")["text_summary"], "Their summary.")
+        self.assertEqual(self.cached.get("done")["text_summary"], "A summary.")
+
+
+class TestFanOut(unittest.TestCase):
+    TRANSCRIPT = "The coalition agreement was supposed to stabilise the government. " * 20
+    INFERENCE = '{"tone": "formal", "depth": 0.5}'
+
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        self.updates = []
+        update = self.table.update
+        def recorded_update(id, fields, *args, **kwargs):
+            self.updates.append(dict(fields))
+            return update(id, fields, *args, **kwargs)
+        self.table.update = recorded_update
+
+    def summarize(self, id, fan_out):
+        return list(summarizer.process_in_stream(None, id, "example.com/a", self.TRANSCRIPT, "default", None, None,
+                                                 fan_out=fan_out, stream_tokens=False))
+
+    def test_inference_finishing_first_persists_the_serial_record(self):
+        inference_done = threading.Event()
+        def gpt(text, instructions):
+            if "JSON" in instructions:
+                inference_done.set()
+                return self.INFERENCE
+            # The summary finishes after the inference
+            inference_done.wait(5)
+            time.sleep(0.05)
+            return "A summary."
+
+        with patch("services.summarizer.gpt", gpt):
+            self.summarize("fan-out", True)
+        fan_out_updates, self.updates = self.updates, []
+        with patch("services.summarizer.gpt", lambda text, instructions: self.INFERENCE if "JSON" in instructions else "A summary."):
+            self.summarize("serial", False)
+
+        # One write per step, in the order they finished
+        self.assertEqual(len(fan_out_updates), 2)
+        self.assertEqual(fan_out_updates[0]["tone"], "formal")
+        self.assertNotIn("text_summary", fan_out_updates[0])
+        self.assertEqual(fan_out_updates[1]["text_summary"], "A summary.")
+        self.assertNotIn("tone", fan_out_updates[1])
+        # The item is rebuilt in STEP_ORDER, so the record is the same as the serial flow's
+        ignored = ("id", "dateCreated")
+        fan_out = {k: v for k, v in self.table.items["fan-out"].items() if k not in ignored}
+        serial = {k: v for k, v in self.table.items["serial"].items() if k not in ignored}
+        self.assertEqual(fan_out, serial)
+        self.assertEqual((fan_out["text_summary"], fan_out["depth"]), ("A summary.", Decimal("0.5")))
+
+class TestTokenStream(unittest.TestCase):
+    TRANSCRIPT = "The coalition agreement was supposed to stabilise the government. " * 20
+
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        # Writes and events of the response, in the order they happen
+        self.log = []
+        update = self.table.update
+        def recorded_update(id, fields, *args, **kwargs):
+            self.log.append(("update", sorted(fields)))
+            return update(id, fields, *args, **kwargs)
+        self.table.update = recorded_update
+        patch("services.summarizer.gpt", lambda text, instructions: '{"tone": "formal"}').start()
+        self.addCleanup(patch.stopall)
+
+    def stream(self, id, deltas):
+        with patch("services.summarizer.gpt_stream", lambda text, instructions: deltas()):
+            for event in summarizer.process_in_stream(None, id, "example.com/a", self.TRANSCRIPT, "default", None, None,
+                                                      stream_tokens=True):
+                name = event.split("\n", 1)[0][len("event: "):]
+                data = json.loads(event.split("data: ", 1)[1])
+                self.log.append((name, data.get("delta") or data.get("text_summary") or data.get("message")))
+
+    def test_deltas_are_sent_and_the_summary_is_written_once_at_the_end(self):
+        def deltas():
+            yield "A "
+            yield "summary."
+        self.stream("streamed", deltas)
+        self.assertEqual([entry for entry in self.log if entry[0] == "summary_delta"],
+                         [("summary_delta", "A "), ("summary_delta", "summary.")])
+        summary_writes = [i for i, entry in enumerate(self.log) if entry[0] == "update" and "text_summary" in entry[1]]
+        self.assertEqual(len(summary_writes), 1)
+        last_delta = max(i for i, entry in enumerate(self.log) if entry[0] == "summary_delta")
+        self.assertGreater(summary_writes[0], last_delta)
+        self.assertIn(("item", "A summary."), self.log)
+        self.assertEqual(self.table.items["streamed"]["text_summary"], "A summary.")
+
+    def test_stream_failing_midway_stores_no_partial_summary(self):
+        def deltas():
+            yield "A partial"
+            raise IOError("connection reset")
+        self.stream("failed", deltas)
+        self.assertIn(("summary_delta", "A partial"), self.log)
+        self.assertIn(("error", "Error, article could not be summarized"), self.log)
+        self.assertFalse(any(entry[0] == "update" and "text_summary" in entry[1] for entry in self.log))
+        self.assertNotIn("text_summary", self.table.items["failed"])
+
+
+class TestFloatFields(unittest.TestCase):
+    def test_inference_floats_are_written_as_decimal(self):
+        fields = summarizer.parse_inference('{"depth": 3.5, "tone": "formal", "scores": [0.25, 1]}')
+        self.assertEqual(fields["depth"], Decimal("3.5"))
+        table = Mock()
+        table.update_item.return_value = {"Attributes": {}}
+        db.DynamoDBImpl(table).update("a", {**fields, "nested": {"ratio": 0.5}})
+        values = table.update_item.call_args.kwargs["ExpressionAttributeValues"]
+        self.assertEqual(sorted(values.values(), key=str), sorted([Decimal("3.5"), "formal", [Decimal("0.25"), 1], {"ratio": Decimal("0.5")}], key=str))
+        self.assertFalse(any(isinstance(v, float) for v in values.values()))
+
+class TestStripForTransport(unittest.TestCase):
+    def test_internal_fields_are_not_sent(self):
+        item = {"id": "a", "url": "example.com/a", "transcript": "text", "text_summary": "A summary.", "simhash": "00ff",
+                "variant": "c6d6", "revision": 2, "transcript_z": b"x"}
+        self.assertEqual(summarizer.strip_for_transport(item),
+                         {"id": "a", "url": "example.com/a", "transcript": None, "text_summary": "A summary.", "audio_summary_url": None})
+        self.assertEqual(item["simhash"], "00ff")
+
+class TestNearDuplicates(unittest.TestCase):
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        self.variant = fingerprint.variant("default", "false")
+
+    def index(self, id, value, **fields):
+        self.table.items[id] = {"id": id, "text_summary": "s", "simhash": fingerprint.to_hex(value), "variant": self.variant, **fields}
+        fingerprint.index_article(id, value)
+
+    def test_fingerprints_within_max_distance_share_a_key(self):
+        value = 0x0123456789abcdef
+        for bits in [(0,), (5, 40), (1, 22, 63), (10, 11, 12)]:
+            near = value
+            for bit in bits:
+                near ^= 1 << bit
+            self.assertTrue(set(fingerprint.band_keys(value, 3)) & set(fingerprint.band_keys(near, 3)), bits)
+
+    def test_closest_article_is_found(self):
+        value = 0x0123456789abcdef
+        self.index("three-bits", value ^ 0b111)
+        self.index("one-bit", value ^ 1 << 40)
+        self.index("other-variant", value, variant="other")
+        self.index("far", value ^ 0xffff)
+        self.assertEqual(fingerprint.find_similar("new", value, self.variant)["id"], "one-bit")
+
+    def test_index_records_are_capped(self):
+        with patch("config.NEAR_DUP_BAND_MAX_IDS", 3):
+            for i in range(5):
+                fingerprint.index_article(f"a{i}", 0x0123456789abcdef ^ 1 << i)
+        self.assertTrue(all(len(record["ids"]) <= 3 for record in self.table.items.values()))
+
+    def test_candidates_are_ranked_by_distance(self):
+        entries = [fingerprint.index_entry("b", 0b11), fingerprint.index_entry("a", 0b1), "legacy-id", fingerprint.index_entry("c", 0xff)]
+        self.assertEqual(fingerprint.rank_candidates("new", 0, entries, 3), ["a", "b"])
+
+class TestSingleFlight(unittest.TestCase):
+    def test_followers_wait_for_the_leader(self):
+        flight = SingleFlight()
+        self.assertIsNone(flight.acquire("a"))
+        done = flight.acquire("a")
+        self.assertFalse(done.is_set())
+        self.assertIsNone(flight.acquire("b"))
+        flight.release("a")
+        self.assertTrue(done.is_set())
+        self.assertFalse(flight.in_flight("a"))
+        self.assertIsNone(flight.acquire("a"))
+
+class TestLease(unittest.TestCase):
+    TRANSCRIPT = "The coalition agreement was supposed to stabilise the government. " * 20
+
+    def setUp(self):
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+        patch("services.summarizer.gpt", lambda text, instructions: '{"tone": "formal"}' if "JSON" in instructions else "A summary.").start()
+        patch("config.SLEEP_TIME_IN_SEC", 0).start()
+        self.addCleanup(patch.stopall)
+
+    def summarize(self, id):
+        return "".join(summarizer.process_once(None, id, "example.com/a", self.TRANSCRIPT, "default", None, None,
+                                               fan_out=False, stream_tokens=False))
+
+    def test_expired_lease_is_taken_over(self):
+        # A container died while summarizing the article
+        self.table.items[db.internal_key("lease", "expired")] = {"owner": "dead", "expires_at": time.time() - 1}
+        self.assertIn("A summary.", self.summarize("expired"))
+        self.assertEqual(self.table.items["expired"]["text_summary"], "A summary.")
+        self.assertNotIn(db.internal_key("lease", "expired"), self.table.items)
+
+    def test_article_finished_before_the_lease_is_acquired(self):
+        # The other container summarized the article and released its lease after our first read
+        self.table.items["finished"] = {"id": "finished", "url": "example.com/a", "text_summary": "Their summary."}
+        with patch("services.summarizer.process_in_stream") as process_in_stream:
+            self.assertIn("Their summary.", self.summarize("finished"))
+        process_in_stream.assert_not_called()
+        self.assertNotIn(db.internal_key("lease", "finished"), self.table.items)
+
+    def test_poll_gives_up_after_the_summary_wait(self):
+        self.table.items[db.internal_key("lease", "busy")] = {"owner": "other", "expires_at": time.time() + 60}
+        with patch("config.SUMMARY_WAIT_IN_SEC", 0):
+            self.assertIn("could not be summarized", self.summarize("busy"))
+
+    def test_lease_is_renewed_until_stopped(self):
+        self.table.acquire_lease("long", "me", 1)
+        renewer = LeaseRenewer(self.table, "long", "me", 60, 0.01).start()
+        time.sleep(0.05)
+        renewer.stop()
+        self.assertGreater(self.table.items[db.internal_key("lease", "long")]["expires_at"], time.time() + 30)
+
+    def test_dynamodb_lease_renewal(self):
+        table = Mock()
+        self.assertTrue(db.DynamoDBImpl(table).renew_lease("live", "me", 60))
+        self.assertEqual(table.update_item.call_args.kwargs["ExpressionAttributeValues"][":owner"], "me")
+        table.update_item.side_effect = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem")
+        self.assertFalse(db.DynamoDBImpl(table).renew_lease("live", "me", 60))
+
+    def test_dynamodb_lease_errors(self):
+        table = Mock()
+        condition_failed = ClientError({"Error": {"Code": "ConditionalCheckFailedException"}}, "PutItem")
+        table.put_item.side_effect = condition_failed
+        self.assertFalse(db.DynamoDBImpl(table).acquire_lease("live", "me", 60))
+        table.delete_item.side_effect = condition_failed
+        self.assertFalse(db.DynamoDBImpl(table).release_lease("live", "me"))
+        # Releasing never fails the caller, the lease expires anyway
+        table.delete_item.side_effect = ClientError({"Error": {"Code": "InternalServerError"}}, "DeleteItem")
+        self.assertFalse(db.DynamoDBImpl(table).release_lease("live", "me"))
+
+    def test_add_or_update_swallows_errors(self):
+        table = Mock()
+        table.get_item.return_value = {}
+        table.put_item.side_effect = TypeError("Float types are not supported. Use Decimal types instead.")
+        self.assertIsNone(db.DynamoDBImpl(table).addOrUpdate({"id": "a", "depth": 3.5}))
+
+class TestBatchGet(unittest.TestCase):
+    def test_chunks_and_retries_unprocessed_keys(self):
+        calls = []
+        class FakeClient(object):
+            def batch_get_item(self, RequestItems):
+                keys = RequestItems["summary"]["Keys"]
+                calls.append(len(keys))
+                # The first call leaves its last key unprocessed
+                unprocessed = {"summary": {"Keys": keys[-1:]}} if len(calls) == 1 else {}
+                done = keys[:-1] if unprocessed else keys
+                return {"Responses": {"summary": [{"id": key["id"]} for key in done]}, "UnprocessedKeys": unprocessed}
+        table = type("Table", (object,), {"name": "summary", "meta": type("Meta", (object,), {"client": FakeClient()})})()
+        ids = [f"id-{i}" for i in range(150)]
+        with patch("config.DB_BATCH_BACKOFF_IN_SEC", 0):
+            items = db.DynamoDBImpl(table).batch_get(ids + ids[:10])
+        self.assertEqual(calls, [100, 1, 50])
+        self.assertEqual(set(items), set(ids))
+
+    def test_batch_write_chunks_retries_and_converts_floats(self):
+        calls = []
+        class FakeClient(object):
+            def batch_write_item(self, RequestItems):
+                requests = RequestItems["summary"]
+                calls.append(requests)
+                # The first call leaves its last request unprocessed
+                return {"UnprocessedItems": {"summary": requests[-1:]} if len(calls) == 1 else {}}
+        table = type("Table", (object,), {"name": "summary", "meta": type("Meta", (object,), {"client": FakeClient()})})()
+        items = [{"id": f"id-{i}", "depth": 3.5, "scores": [0.25]} for i in range(30)]
+        with patch("config.DB_BATCH_BACKOFF_IN_SEC", 0):
+            left = db.DynamoDBImpl(table).batch_write(items, delete_ids=["old"])
+        self.assertEqual(left, 0)
+        self.assertEqual([len(requests) for requests in calls], [25, 1, 6])
+        put = calls[0][0]["PutRequest"]["Item"]
+        self.assertEqual((put["depth"], put["scores"]), (Decimal("3.5"), [Decimal("0.25")]))
+        self.assertEqual(calls[-1][-1], {"DeleteRequest": {"Key": {"id": "old"}}})
+
+class TestScan(unittest.TestCase):
+    # Scans 25 items, 10 per page, split in segments by the last digit of their id
+    class FakeTable(object):
+        def __init__(self):
+            self.calls = []
+            self.ids = [f"id-{i}" for i in range(25)] + ["lease#id-1"]
+
+        def scan(self, **kwargs):
+            self.calls.append(kwargs)
+            segment, segments = kwargs.get("Segment", 0), kwargs.get("TotalSegments", 1)
+            ids = [id for id in self.ids if int(id[-1]) % segments == segment]
+            start = kwargs.get("ExclusiveStartKey", {}).get("id", 0)
+            response = {"Items": [{"id": id} for id in ids[start:start + 10]], "ConsumedCapacity": {"CapacityUnits": 5.0}}
+            if start + 10 < len(ids):
+                response["LastEvaluatedKey"] = {"id": start + 10}
+            return response
+
+    def test_follows_last_evaluated_key_and_skips_internal_records(self):
+        table = self.FakeTable()
+        items = list(db.DynamoDBImpl(table).list(projection=["url"]))
+        self.assertEqual([item["id"] for item in items], [f"id-{i}" for i in range(25)])
+        self.assertEqual(len(table.calls), 3)
+        self.assertEqual(table.calls[0]["ExpressionAttributeNames"], {"#p0": "id", "#p1": "url"})
+
+    def test_parallel_scan_reads_every_segment(self):
+        table = self.FakeTable()
+        items = list(db.DynamoDBImpl(table).list(segments=3))
+        self.assertEqual(sorted(item["id"] for item in items), sorted(f"id-{i}" for i in range(25)))
+        self.assertEqual({call["Segment"] for call in table.calls}, {0, 1, 2})
+
+    def test_rate_limiter_waits_for_the_units_consumed(self):
+        now, waits = [0.0], []
+        limiter = db.ReadRateLimiter(10, clock=lambda: now[0], sleep=waits.append)
+        limiter.consume(5)
+        now[0] = 0.2
+        limiter.consume(5)
+        self.assertEqual(waits, [0.5, 0.8])
+
+class TestTranscripts(unittest.TestCase):
+    def test_small_transcript_is_compressed_in_the_item(self):
+        transcript = "The coalition agreement was supposed to stabilise the party. " * 20
+        fields = transcripts.store(transcript)
+        self.assertEqual(list(fields), ["transcript_z"])
+        self.assertLess(len(fields["transcript_z"]), len(transcript) / 4)
+        self.assertEqual(transcripts.load(fields), transcript)
+
+    def test_large_transcript_goes_to_s3_by_content_hash(self):
+        transcript = " ".join(f"{i * 7919 % 104729}" for i in range(5000))
+        with patch("services.util.s3_object_exists", return_value=False), \
+                patch("services.util.upload_stream_to_s3", return_value="s3://bucket/dev/key") as upload:
+            fields = transcripts.store(transcript)
+        self.assertEqual(fields, {"transcript_ref": "s3://bucket/dev/key"})
+        self.assertEqual(upload.call_args[0][2], transcripts.transcript_key(transcript))
+        self.assertEqual(transcripts.load({"transcript": "legacy", **fields}), "legacy")
+
+class TestResponseBlob(unittest.TestCase):
+    def item(self, **fields):
+        return {"id": "article", "url": "example.com/a", "text_summary": "A \"quoted\" summary", "tone": "formal",
+                "key_topics": ["budget"], "time_saved": Decimal(3), "audio_summary_url": "s3://bucket/dev/audio/a.mp3", **fields}
+
+    def test_blob_matches_summary_response(self):
+        with patch("services.util.presigned_audio_url", return_value="https://bucket/a.mp3?signed"):
+            for item in [self.item(), self.item(audio_status="queued"), self.item(audio_summary_url=None, revision=Decimal(2))]:
+                self.assertEqual(json.loads(util.build_response("article", item)), json.loads(util.json_dumps(util.summary_response("article", item))))
+
+    def test_new_revision_is_serialized_again(self):
+        with patch("services.util.presigned_audio_url", return_value=None):
+            util.build_response("revised", self.item(revision=1))
+            response = json.loads(util.build_response("revised", self.item(revision=2, text_summary="Summarized again")))
+        self.assertEqual(response["text_summary"], "Summarized again")
+
+class TestPresignedUrls(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000
+        self.signed = []
+
+        def generate_presigned_url(operation, Params, ExpiresIn):
+            self.signed.append(Params["Key"])
+            return f"https://{Params['Bucket']}/{Params['Key']}?signature={len(self.signed)}"
+
+        client = patch("lib.aws.get_client").start().return_value
+        client.generate_presigned_url.side_effect = generate_presigned_url
+        patch.object(util, "time", Mock(time=lambda: self.now)).start()
+        patch.object(util, "_presigned_urls", TTLCache("test", 16, 600, clock=lambda: self.now)).start()
+        patch.object(config, "PRESIGNED_URL_SAFETY_MARGIN_IN_SEC", 600).start()
+        self.addCleanup(patch.stopall)
+        self.table = MemoryTable()
+        previous = db._tables.get("summary")
+        db.set_table("summary", self.table)
+        self.addCleanup(db.set_table, "summary", previous)
+
+    def test_cached_url_is_reused_until_the_safety_margin(self):
+        url, expires_at = util.presign("bucket", "a.mp3", 3600)
+        self.assertEqual(expires_at, self.now + 3600)
+        self.now += 3600 - 600 - 1
+        self.assertEqual(util.presign("bucket", "a.mp3", 3600), (url, expires_at))
+        self.assertEqual(len(self.signed), 1)
+        self.now += 1
+        new_url, new_expires_at = util.presign("bucket", "a.mp3", 3600)
+        self.assertNotEqual(new_url, url)
+        self.assertEqual(new_expires_at, self.now + 3600)
+        self.assertEqual(len(self.signed), 2)
+
+    def test_short_expiration_is_not_cached(self):
+        util.presign("bucket", "a.mp3", 600)
+        util.presign("bucket", "a.mp3", 600)
+        self.assertEqual(len(self.signed), 2)
+
+    def test_url_on_the_item_is_reused_when_its_source_matches(self):
+        patch.object(config, "PRESIGNED_URL_ON_ITEM", True).start()
+        stored = {"source": "s3://bucket/a.mp3", "url": "https://bucket/a.mp3?stored", "expires_at": self.now + 3000}
+        item = {"audio_summary_url": "s3://bucket/a.mp3", "audio_url_presigned": stored}
+        self.assertEqual(util.presigned_audio_url("article", item), stored["url"])
+        self.assertEqual(self.signed, [])
+        self.assertNotIn("article", self.table.items)
+
+        # The audio was regenerated under another key
+        item["audio_summary_url"] = "s3://bucket/b.mp3"
+        url = util.presigned_audio_url("article", item)
+        self.assertEqual(self.signed, ["b.mp3"])
+        self.assertEqual(self.table.items["article"]["audio_url_presigned"],
+                         {"source": "s3://bucket/b.mp3", "url": url, "expires_at": self.now + 3600})
+
+    def test_url_on_the_item_is_not_reused_within_the_safety_margin(self):
+        stored = {"source": "s3://bucket/a.mp3", "url": "https://bucket/a.mp3?stored", "expires_at": self.now + 600}
+        item = {"audio_summary_url": "s3://bucket/a.mp3", "audio_url_presigned": stored}
+        self.assertNotEqual(util.presigned_audio_url("article", item), stored["url"])
+        self.assertEqual(self.signed, ["a.mp3"])
+        self.assertNotIn("article", self.table.items)  # PRESIGNED_URL_ON_ITEM is off by default
+
+class TestBlocklistMatcher(unittest.TestCase):
+    def test_same_cases_as_match_regex_list(self):
+        matcher = BlocklistMatcher([r"google\.com/search", r"youtube\.com/", r"linkedin\.com/feed/", r"mail\.google\.com/mail/u/0/#inbox(?!/)"])
+        self.assertTrue(matcher.matches('https://mail.google.com/mail/u/0/#inbox'))
+        self.assertFalse(matcher.matches('https://mail.google.com/mail/u/0/#inbox/FMfcgzGxStqZFTjmXvVTcxxGkGZHNhXq'))
+        self.assertFalse(matcher.matches('https://chat.openai.com/c/15102225-7925-440b-80d0-232f572d82ba'))
+        self.assertTrue(matcher.matches('https://www.google.com/search?q=blacklist+url&sca_esv'))
+        self.assertTrue(matcher.matches('https://www.youtube.com/watch?v=1ZQ33OnGFWE'))
+        self.assertTrue(matcher.matches('https://www.linkedin.com/feed/'))
+        self.assertFalse(matcher.matches('https://support.google.com/chrome_webstore/answer/2664769?hl=en-GB'))
+
+    def test_patterns_without_a_host_run_for_every_url(self):
+        matcher = BlocklistMatcher([r"web.whatsapp\.com", r"^file://", r"/wp-admin/"])
+        self.assertTrue(matcher.matches("https://web.whatsapp.com/"))
+        self.assertTrue(matcher.matches("file:///tmp/article.html"))
+        self.assertTrue(matcher.matches("https://blog.example.com/wp-admin/post.php"))
+        self.assertFalse(matcher.matches("https://example.com/article"))
+
+    def test_top_level_alternation_matches_every_side(self):
+        patterns = [r"example\.com/a|other\.org/b"]
+        self.assertTrue(match_regex_list(patterns, "https://other.org/b"))
+        self.assertTrue(BlocklistMatcher(patterns).matches("https://other.org/b"))
+        self.assertTrue(BlocklistMatcher(patterns).matches("https://example.com/a"))
+        self.assertFalse(BlocklistMatcher(patterns).matches("https://other.org/a"))
+
+    def test_blocked_host_in_a_redirect_parameter(self):
+        matcher = BlocklistMatcher([r"youtube\.com/"])
+        self.assertTrue(matcher.matches("https://r.example.net/out?to=https://youtube.com/watch?v=1"))
+        self.assertTrue(matcher.matches("https://r.example.net/out?to=https%3A%2F%2Fm.youtube.com/watch"))
+        self.assertFalse(matcher.matches("https://r.example.net/out?to=https://example.com/"))
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache("test", max_size=2, ttl=10, clock=lambda: self.now)
+
+    def test_expires_after_ttl(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.lookup("a"), (True, 1))
+        self.now = 11
+        self.assertEqual(self.cache.lookup("a"), (False, None))
+
+    def test_caches_none_with_its_own_ttl(self):
+        self.cache.set("missing", None, ttl=1)
+        self.assertEqual(self.cache.lookup("missing"), (True, None))
+        self.now = 2
+        self.assertEqual(self.cache.lookup("missing"), (False, None))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+
+class TestActivityLog(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.s3 = Mock()
+        self.log = activity_log.ActivityLog("bucket", max_events=5, batch_size=3, flush_interval=60, idle_interval=10,
+                                            s3_client=self.s3, clock=lambda: self.now)
+
+    def uploaded_batches(self):
+        return [call.kwargs["Body"] for call in self.s3.put_object.call_args_list]
+
+    def test_flushes_when_the_batch_size_is_reached(self):
+        self.log.append({"n": 1})
+        self.log.append({"n": 2})
+        self.log.flush_if_due()
+        self.s3.put_object.assert_not_called()
+        self.log.append({"n": 3})
+        self.log.flush_if_due()
+        self.assertEqual(len(self.uploaded_batches()), 1)
+        self.assertEqual(self.log.pending(), 0)
+
+    def test_flushes_when_the_oldest_event_reaches_the_interval(self):
+        self.log.batch_size = self.log.max_events = 100
+        for _ in range(9):
+            self.log.append({"n": self.now})
+            self.log.flush_if_due()
+            self.now += 7  # Never idle
+        self.s3.put_object.assert_not_called()
+        self.log.append({"n": self.now})
+        self.log.flush_if_due()
+        self.assertEqual(len(self.uploaded_batches()), 1)
+
+    def test_flushes_when_idle(self):
+        self.log.append({"n": 1})
+        self.now = 9
+        self.log.flush_if_due()
+        self.s3.put_object.assert_not_called()
+        self.now = 10
+        self.log.flush_if_due()
+        self.assertEqual(len(self.uploaded_batches()), 1)
+
+    def test_counts_the_dropped_events(self):
+        dropped = metrics.get("activity_log.dropped")
+        results = [self.log.append({"n": n}) for n in range(7)]
+        self.assertEqual(results, [True] * 5 + [False] * 2)
+        self.assertEqual(metrics.get("activity_log.dropped"), dropped + 2)
+
+    def test_interval_restarts_after_a_partial_flush(self):
+        self.log.idle_interval = 100
+        self.log.append({"n": 1})
+        self.now = 50
+        self.log.append({"n": 2})
+        self.log._events.popleft()  # Taken by a flush running at the same time
+        self.now = 70
+        self.log.flush_if_due()
+        self.s3.put_object.assert_not_called()
+        self.now = 110
+        self.log.flush_if_due()
+        self.assertEqual(len(self.uploaded_batches()), 1)
+
+    def test_flushes_everything_pending_after_an_invocation(self):
+        patch.object(activity_log, "_ACTIVITY_LOG", self.log).start()
+        self.addCleanup(patch.stopall)
+        self.log.append({"n": 1})
+        patch.object(config, "ACTIVITY_LOG_FLUSH_EACH_INVOCATION", False).start()
+        activity_log.flush_after_invocation()
+        self.s3.put_object.assert_not_called()
+        patch.object(config, "ACTIVITY_LOG_FLUSH_EACH_INVOCATION", True).start()
+        activity_log.flush_after_invocation()
+        self.assertEqual(len(self.uploaded_batches()), 1)
+
+class TestSplitText(unittest.TestCase):
+    def test_chunks_fit_and_keep_all_the_text(self):
+        text = "\n\n".join(("Sentence number %d is here. " % i) * 60 for i in range(40))
+        chunks = chunking.split_text(text, 500)
+        self.assertTrue(all(chunking.count_tokens(chunk) <= 500 for chunk in chunks))
+        self.assertEqual("".join(text.split()), "".join("".join(chunks).split()))
+
+    def test_splits_long_paragraphs_on_sentences(self):
+        chunks = chunking.split_text("First sentence here. " * 200, 100)
+        self.assertTrue(all(chunk.strip().endswith(".") for chunk in chunks))
+
+class TestNormalizeTranscript(unittest.TestCase):
+    def test_removes_whitespace_duplicates_and_boilerplate(self):
+        paragraph = "The Bute House agreement was supposed to stabilise the SNP, brokered by Nicola Sturgeon in August 2021."
+        transcript = "Skip to content\n" + paragraph.replace(" ", "   ") + "\n\n" + paragraph + "\nAll rights reserved 2024"
+        cleaned, stats = preprocess.normalize(transcript)
+        self.assertEqual(cleaned, paragraph)
+        self.assertEqual(stats["boilerplate"], 2)
+        self.assertEqual(stats["duplicates"], 1)
+
+    def test_keeps_sentences_starting_with_boilerplate_words(self):
+        sentences = ["Recommended daily doses of vitamin D have doubled.", "Newsletter publishers saw record growth.",
+                     "Read more books, the minister urged."]
+        transcript = "\n".join(["Recommended for you"] + sentences + ["Read more »", "Sign up for our newsletter",
+                                                                      "© 2024 Example Media Inc. All rights reserved."])
+        cleaned, stats = preprocess.normalize(transcript)
+        self.assertEqual(cleaned, "\n\n".join(sentences))
+        self.assertEqual(stats["boilerplate"], 4)
+
 # if __name__ == '__main__':
 #     unittest.main()
 
@@ -106,6 +106,11 @@ def handler(event, context):
         return serverless_wsgi.handle_request(wsgi_app, event, context)
 
 
+def stream_handler(event, context, response_stream):
+    """Lambda response streaming handler, writes the WSGI response to the stream as it is produced"""
+    return serverless_wsgi.handle_request_streaming(wsgi_app, event, context, response_stream)
+
+
 def _create_app():
     return wsgi_app
 